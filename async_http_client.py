@@ -0,0 +1,487 @@
+import asyncio
+import socket
+import time
+
+import dns.asyncresolver
+import dns.exception
+import dns.resolver
+
+import fields as fs
+from http_client import Util, Request, Response, ResponseParser, Connection, ConnectionPool, TLSConfig, ContentDecoder, \
+    CookieJar, Metrics, Timings, Timeout, Session, HTTPCache, RedirectCache, Scheduler
+
+
+class AsyncConnection(Connection):
+    """
+    基于 asyncio streams 的连接，接收缓冲区、Keep-Alive 判断这些逻辑全部沿用 Connection
+    这样就可以直接放进 ConnectionPool 里面复用，取连接的时候不阻塞，在途请求数由 AsyncSession 的信号量限制
+    """
+
+    def __init__(self, key, reader, writer):
+        Connection.__init__(self, key, writer.get_extra_info("socket"))
+        self.reader = reader
+        self.writer = writer
+
+    def set_timeout(self, timeout):
+        """
+        和 Connection.set_timeout 一样记下读超时和截止时间，asyncio 的套接字是非阻塞的，超时在 fill 里面用 wait_for 实现
+        """
+        self.read_timeout = timeout.read
+        self.deadline = None if timeout.total is None else time.monotonic() + timeout.total
+
+    async def fill(self):
+        """
+        从 StreamReader 收一次数据追加到接收缓冲区，返回收到的字节数，0表示对端已经关闭连接
+        """
+        if self.rend == self.rbuf.__len__():
+            n = self.rend - self.rstart
+            self.rbuf[:n] = bytes(self.rview[self.rstart: self.rend])
+            self.rstart, self.rend = 0, n
+        timeout = self.read_timeout
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("请求超时!")
+            timeout = remaining if timeout is None else min(remaining, timeout)
+        read = self.reader.read(self.rbuf.__len__() - self.rend)
+        if timeout is None:
+            data = await read
+        else:
+            try:
+                data = await asyncio.wait_for(read, timeout)
+            except asyncio.TimeoutError:
+                raise socket.timeout("读取超时!") from None
+        n = data.__len__()
+        self.rbuf[self.rend: self.rend + n] = data
+        self.rend += n
+        self.bytes_in += n
+        return n
+
+    async def send_request(self, request):
+        """
+        发送请求报文，和 Connection.send_request 一样分三种情况：内存主体、长度已知的文件、chunked 流式主体
+        """
+        body = request.body
+        head = request.head_bytes()
+        self.bytes_out += head.__len__()
+
+        if body.stream is None:
+            self.writer.writelines((head, body.content))
+            self.bytes_out += body.content.__len__()
+
+        elif body.length is not None:
+            self.writer.write(head)
+            await self.writer.drain()
+            if body.length:
+                loop = asyncio.get_running_loop()
+                self.bytes_out += await loop.sendfile(self.writer.transport, body.stream, body.stream_start,
+                                                      body.length)
+
+        else:
+            self.writer.write(head)
+            for chunk in self._iter_stream(body.stream):
+                if chunk.__len__():
+                    self.writer.writelines((b"%x\r\n" % chunk.__len__(), chunk, b"\r\n"))
+                    self.bytes_out += chunk.__len__()
+                    await self.writer.drain()
+            self.writer.write(b"0\r\n\r\n")
+
+        await self.writer.drain()
+
+    def is_dropped(self):
+        """
+        对端关闭连接的时候 StreamReader 会收到EOF，不需要 select
+        """
+        if self.writer is None or self.rstart != self.rend:
+            return True
+        return self.reader.at_eof() or self.writer.is_closing()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.socket = None
+        self.reusable = False
+
+
+class AsyncSession:
+
+    """
+    Session 的异步版本，get/post/put/delete/head/options 全部是协程，用法与 Session 一致：
+
+        async with AsyncSession() as s:
+            resp = await s.get("http://www.httpbin.org/get")
+
+    请求报文和响应报文仍然使用 Request/Response/Headers，解析用的也是同一个 ResponseParser
+    每个主机同时在途的请求数由信号量限制，超过 max_per_host 的请求排队等待，所有主机加起来不超过 max_total；
+    连接池的 get 用 block=False 不会替我们检查这两个上限，全靠这里的信号量
+    timeout 和 Session 一样是 Timeout 对象或者数字，get/post 等方法也可以用 timeout 参数单独指定，超时抛出 socket.timeout
+    scheduler 和 Session 一样，传 Scheduler 对象（True 用默认参数）开启按主机的限速和优先级排队，可以和 Session 共用一个
+    """
+
+    def __init__(self, max_per_host=10, max_total=100, idle_timeout=60, tls=None, decompress=True,
+                 max_decompressed_size=None, max_redirects=10, timeout=None, scheduler=None):
+        self.tls = tls or TLSConfig.default()           # 与 Session 共用 SSLContext，asyncio 不支持传入TLS会话，没有会话恢复
+        self.pool = ConnectionPool(max_per_host=max_per_host, max_total=max_total, idle_timeout=idle_timeout)
+        self.timeout = Timeout.of(timeout) or Timeout()
+        self.semaphores = {}                            # (protocol, host, port) -> asyncio.Semaphore(pool.max_per_host)
+        self.total_semaphore = None                     # asyncio.Semaphore(pool.max_total)，第一次发请求的时候再建
+        self.resolving = {}                             # 正在解析的域名 -> Future，同一个域名只查一次
+        self.decompress = decompress                    # 和 Session 一样自动协商压缩并解压主体
+        self.max_decompressed_size = max_decompressed_size
+        self.cookies = CookieJar()
+        self.scheduler = Scheduler() if scheduler is True else scheduler
+        self.metrics = Metrics(self.pool, Util.dns_cache, scheduler=self.scheduler)   # 和 Session 一样的汇总统计
+        self.max_redirects = max_redirects              # 跳转规则和 Session 相同，见 Session.redirect_request
+        self.redirects = RedirectCache()
+
+        self.last_request = None
+        self.last_response = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        self.pool.close()
+
+    async def get_dns(self, host):
+        """
+        异步DNS解析，结果和 Session 共用 Util.dns_cache 缓存
+        同一个域名同时有多个请求在解析的时候，只发一次查询，其余的等待同一个结果
+        """
+        cache = Util.dns_cache
+        addresses = cache.lookup(host)
+        if addresses is not None:
+            return cache.pick(addresses)
+        if host in self.resolving:
+            return cache.pick(await asyncio.shield(self.resolving[host]))
+
+        future = asyncio.get_running_loop().create_future()
+        self.resolving[host] = future
+        try:
+            answers = []
+            for rdtype in ("A", "AAAA"):
+                try:
+                    answers.append(await dns.asyncresolver.resolve(host, rdtype, raise_on_no_answer=False))
+                except dns.resolver.NXDOMAIN:
+                    raise
+                except dns.exception.DNSException as e:
+                    if rdtype == "AAAA" and answers:
+                        continue
+                    answers.append(e)
+            addresses, ttl = cache.collect(host, answers)
+            cache.store(host, addresses, ttl)
+            future.set_result(addresses)
+            return cache.pick(addresses)
+        except Exception as e:
+            if isinstance(e, (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)):
+                cache.store_error(host, e)
+            future.set_exception(e)
+            future.exception()                          # 没有其他等待者的时候，避免 asyncio 报告异常未被取回
+            raise
+        finally:
+            del self.resolving[host]
+
+    async def build(self, method, uri, **kwargs):
+        request = Request()
+        request.build(method, uri, resolve=False, **kwargs)
+        if not request.conn_info["ip"]:
+            request.conn_info["ip"] = await self.get_dns(request.conn_info["host"])
+        return request
+
+    async def new_connection(self, request, timeout=None):
+        """
+        新建一个到目标主机的连接，timeout.connect 包括TCP连接和TLS握手
+        """
+        ip, port = request.conn_info["ip"], request.conn_info["port"]
+        if request.conn_info["protocol"] == "https":
+            connect = asyncio.open_connection(ip, port, ssl=self.tls.context(), server_hostname=request.conn_info["host"])
+        else:
+            connect = asyncio.open_connection(ip, port)
+        try:
+            reader, writer = await asyncio.wait_for(connect, None if timeout is None else timeout.connect)
+        except asyncio.TimeoutError:
+            raise socket.timeout("连接 %s:%s 超时!" % (ip, port)) from None
+        return AsyncConnection((request.conn_info["protocol"], request.conn_info["host"], port), reader, writer)
+
+    async def send(self, request, reuse=True, timings=None, timeout=None):
+        timeout = timeout or self.timeout
+        key = (request.conn_info["protocol"], request.conn_info["host"], request.conn_info["port"])
+        conn = self.pool.get(key, block=False, reuse=reuse)
+        if conn is None:
+            start = time.perf_counter()
+            try:
+                conn = await self.new_connection(request, timeout)
+            except BaseException:
+                self.pool.cancel(key)
+                raise
+            conn.fresh = True
+            if timings is not None:
+                timings.connect = time.perf_counter() - start
+        else:
+            conn.fresh = False
+
+        conn.set_timeout(timeout)
+        sent = conn.bytes_out
+        try:
+            await conn.send_request(request)
+        except BaseException:
+            # 包括任务被取消（比如外面套了 asyncio.wait_for），发了一半的连接不能再用，也不能一直占着连接池的名额
+            self.pool.discard(conn)
+            raise
+        if timings is not None:
+            timings.sent_at = time.perf_counter()
+            timings.bytes_out = conn.bytes_out - sent
+            timings.reused = not conn.fresh
+            timings.conn_bytes_in = conn.bytes_in
+        return conn
+
+    async def recv_head(self, conn, parser, timings=None):
+        while not parser.head_done:
+            pending = conn.pending()
+            if timings is not None and timings.first_byte_at is None and pending:
+                timings.first_byte_at = time.perf_counter()
+            if pending:
+                consumed, _ = parser.feed(pending)
+                conn.consume(consumed)
+            elif not await conn.fill():
+                conn.reusable = False
+                return False
+        return True
+
+    async def recv_body(self, conn, response, parser, decoder=None):
+        """
+        接收响应主体，返回主体是否完整，有解压器的时候边收边解压
+        """
+        preallocate = decoder is None and parser.framing == "length"
+        body = bytearray(parser.remaining) if preallocate else bytearray()
+        pos = 0
+        complete = True
+        while not parser.done:
+            pending = conn.pending()
+            if pending:
+                consumed, data = parser.feed(pending)
+                if decoder is not None and data:
+                    body += decoder.decompress(data)
+                elif preallocate:
+                    body[pos: pos + data.__len__()] = data
+                    pos += data.__len__()
+                else:
+                    body += data
+                conn.consume(consumed)
+                continue
+            if not await conn.fill():
+                conn.reusable = False
+                if preallocate:
+                    del body[pos:]
+                complete = parser.feed_eof()
+                break
+        if decoder is not None:
+            body += decoder.flush()
+        response.body.parse(body)
+        return complete
+
+    def release(self, conn, response, parser, complete):
+        response.complete = complete
+        timings = response.timings
+        if timings is not None:
+            now = time.perf_counter()
+            timings.transfer = None if timings.head_at is None else now - timings.head_at
+            timings.total = now - timings.start
+            timings.bytes_in = conn.bytes_in - timings.conn_bytes_in
+        if not complete or parser.framing == "eof" or conn.pending():
+            conn.reusable = False
+        try:
+            conn.update(response)
+        finally:
+            self.pool.release(conn)
+        if timings is not None:
+            self.metrics.record(conn.key[1], response.status_line.status_code, timings.total, timings.bytes_in,
+                                timings.bytes_out, timings.reused)
+
+    async def proc(self, request, timeout=None):
+        """
+        与 Session.proc 相同的流程：发送、接收响应头、接收主体、归还连接、处理cookies和跳转
+        """
+        timeout = Timeout.of(timeout) or self.timeout
+        hops = 0
+        while self.max_redirects:
+            cached = self.redirects.lookup(HTTPCache.url(request))
+            if cached is None or (cached[1] == "301" and request.request_line.method not in ("GET", "HEAD")):
+                break
+            hops += 1
+            if hops > self.max_redirects:
+                raise Exception("重定向次数超过了%d次!" % self.max_redirects)
+            request = await self.redirect_request(request, cached[1], cached[0])
+
+        history = []
+        while True:
+            response = await self.exchange(request, timeout)
+            target = Session.redirect_target(request, response)
+            if target is None or not self.max_redirects:
+                response.history = history
+                return response
+            if history.__len__() + hops >= self.max_redirects:
+                raise Exception("重定向次数超过了%d次!" % self.max_redirects)
+
+            code = response.status_line.status_code
+            if code in ("301", "308"):
+                self.redirects.store(HTTPCache.url(request), target, code)
+            history.append(response)
+            request = await self.redirect_request(request, code, target)
+
+    async def redirect_request(self, request, code, url):
+        request = Session.redirect_request(request, code, url, resolve=False)
+        if not request.conn_info["ip"]:
+            request.conn_info["ip"] = await self.get_dns(request.conn_info["host"])
+        return request
+
+    async def exchange(self, request, timeout=None):
+        """
+        发一次请求（不跳转）
+        """
+        key = (request.conn_info["protocol"], request.conn_info["host"], request.conn_info["port"])
+        semaphore = self.semaphores.get(key)
+        if semaphore is None:
+            semaphore = self.semaphores[key] = asyncio.Semaphore(self.pool.max_per_host)
+        if self.total_semaphore is None:
+            self.total_semaphore = asyncio.Semaphore(self.pool.max_total)
+
+        if self.decompress and fs.Accept_Encoding not in request.headers:
+            request.headers[fs.Accept_Encoding] = ContentDecoder.accept_encoding
+        cookie = self.cookies.header(request)
+        if cookie is not None:
+            if fs.Cookie in request.headers:
+                cookie = request.headers[fs.Cookie] + "; " + cookie
+            request.headers[fs.Cookie] = cookie
+
+        try:
+            response = await self.transfer(request, semaphore, timeout)
+        except BaseException:
+            self.metrics.incr("errors", key[1])
+            raise
+
+        self.last_response = response
+        self.last_request = request
+
+        # 检测set-cookies
+        self.cookies.extract(request, response)
+        return response
+
+    async def transfer(self, request, semaphore, timeout=None):
+        """
+        发送请求并接收响应，复用的连接失败的时候换新连接重发
+        出错或者任务被取消的时候，手里的连接一律丢掉，不会一直占着连接池
+        开启了 Scheduler 的时候先排队，收完响应或者出错的时候还回名额，和 Session.transfer 一样
+        """
+        timings = Timings()
+        timings.dns = request.dns_time
+        if self.scheduler is None:
+            return await self.roundtrip(request, semaphore, timings, timeout)
+
+        host = request.conn_info["host"]
+        await self.scheduler.acquire_async(asyncio.get_running_loop(), host, request.priority, timings)
+        try:
+            response = await self.roundtrip(request, semaphore, timings, timeout)
+        except BaseException:
+            self.scheduler.release(host, timings)
+            raise
+        self.scheduler.release(host, timings, response)
+        return response
+
+    async def roundtrip(self, request, semaphore, timings, timeout):
+        # 先拿主机的名额再拿全局的，排队等一个慢主机的时候不占全局名额
+        async with semaphore, self.total_semaphore:
+            reuse = True
+            while True:
+                timings.first_byte_at = None
+                try:
+                    conn = await self.send(request, reuse, timings, timeout)
+                except socket.timeout:
+                    raise
+                except OSError:
+                    if not reuse or not request.body.rewind():
+                        raise
+                    reuse = False
+                    self.metrics.incr("retries", request.conn_info["host"])
+                    continue
+
+                response = Response()
+                parser = ResponseParser(response, request.request_line.method)
+                try:
+                    ok = await self.recv_head(conn, parser, timings)
+                except socket.timeout:
+                    self.pool.discard(conn)
+                    raise
+                except OSError:
+                    self.pool.discard(conn)
+                    if conn.fresh or not request.body.rewind():
+                        raise
+                    reuse = False
+                    self.metrics.incr("retries", request.conn_info["host"])
+                    continue
+                except BaseException:
+                    self.pool.discard(conn)
+                    raise
+
+                if not ok and not parser.head and not conn.fresh and request.body.rewind():
+                    self.pool.discard(conn)
+                    reuse = False
+                    self.metrics.incr("retries", request.conn_info["host"])
+                    continue
+                if not ok:
+                    self.pool.discard(conn)
+                    raise ConnectionResetError("服务端没有返回完整的响应头就关闭了连接")
+                break
+
+            timings.head_at = time.perf_counter()
+            if timings.first_byte_at is not None:
+                timings.ttfb = timings.first_byte_at - timings.sent_at
+            response.timings = timings
+
+            decoder = None
+            if self.decompress and not parser.done:
+                decoder = ContentDecoder.create(parser.header(fs.Content_Encoding), self.max_decompressed_size)
+
+            complete = True
+            try:
+                if not parser.done:
+                    complete = await self.recv_body(conn, response, parser, decoder)
+            except BaseException:
+                # 包括任务被取消，主体没收完的连接不能再用
+                complete = False
+                raise
+            finally:
+                self.release(conn, response, parser, complete)
+        return response
+
+    async def get(self, uri, **kwargs):
+        return await self.proc(await self.build("GET", uri, **kwargs), kwargs.get("timeout"))
+
+    async def post(self, uri, **kwargs):
+        return await self.proc(await self.build("POST", uri, **kwargs), kwargs.get("timeout"))
+
+    async def put(self, uri, **kwargs):
+        return await self.proc(await self.build("PUT", uri, **kwargs), kwargs.get("timeout"))
+
+    async def delete(self, uri, **kwargs):
+        return await self.proc(await self.build("DELETE", uri, **kwargs), kwargs.get("timeout"))
+
+    async def options(self, uri, **kwargs):
+        return await self.proc(await self.build("OPTIONS", uri, **kwargs), kwargs.get("timeout"))
+
+    async def head(self, uri, **kwargs):
+        return await self.proc(await self.build("HEAD", uri, **kwargs), kwargs.get("timeout"))
+
+
+if __name__ == "__main__":
+    async def main():
+        async with AsyncSession() as s:
+            responses = await asyncio.gather(*[s.get("http://www.httpbin.org/get", params={"i": i}) for i in range(10)])
+            for resp in responses:
+                print(resp.body.text())
+
+    asyncio.run(main())
@@ -0,0 +1,3 @@
+"""
+性能测试脚本，全部在本机内存里或者本机回环地址上完成，不依赖外网
+"""
@@ -0,0 +1,278 @@
+"""
+端到端的客户端性能测试，服务端是本进程里的回环服务器（见 bench/server.py），不依赖外网
+
+用法（在仓库根目录下执行）：
+    python -m bench.http_bench
+    python -m bench.http_bench --scenarios small_get concurrency --scale 0.2
+    python -m bench.http_bench --output before.json
+    python -m bench.http_bench --output after.json --compare before.json
+
+每个场景记录 请求数/秒、MB/秒、延迟的 p50/p99 和内存峰值（RSS），结果可以写成 JSON，跨提交对比
+内存峰值是整个进程的峰值，只会涨不会降，所以默认每个场景单独开一个子进程跑，--in-process 关掉这个行为
+回环服务器和客户端在同一个进程里，测到的数字包括服务端的开销，只适合前后对比，不代表绝对性能
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.server import LoopbackServer
+from http_client import Util, Session
+
+try:
+    import resource
+except ImportError:                     # Windows
+    resource = None
+
+
+UPLOAD = memoryview(b"u" * (8 << 20))
+
+
+def small_get(session, server, scale):
+    """
+    保持连接的小响应，顺序发送，主要看每个请求固定的开销
+    """
+    url = server.url("/bytes/128")
+    return [(session.get, (url,), {})] * int(2000 * scale)
+
+
+def chunked_get(session, server, scale):
+    url = server.url("/chunked/65536") + "?chunk=4096"
+    return [(session.get, (url,), {})] * int(1000 * scale)
+
+
+def no_keepalive(session, server, scale):
+    """
+    服务端每次都关闭连接，每个请求都要重新建立TCP连接
+    """
+    url = server.url("/close/128")
+    return [(session.get, (url,), {})] * int(500 * scale)
+
+
+def large_download(session, server, scale):
+    """
+    64MB 的大响应，流式读进一块复用的缓冲区，看吞吐量和内存峰值
+    """
+    buf = bytearray(1 << 20)
+
+    def download(url):
+        with session.get(url, stream=True) as response:
+            while response.readinto(buf):
+                pass
+        return response
+
+    url = server.url("/bytes/%d" % (64 << 20))
+    return [(download, (url,), {})] * max(int(10 * scale), 1)
+
+
+def upload(session, server, scale):
+    """
+    8MB 的请求主体，一半是定长的 memoryview，一半是生成器（chunked 编码）
+    """
+    url = server.url("/upload")
+
+    def chunks():
+        for i in range(0, UPLOAD.__len__(), 1 << 20):
+            yield UPLOAD[i: i + (1 << 20)]
+
+    def stream_upload(url):
+        return session.post(url, content=chunks())
+
+    count = max(int(20 * scale), 2)
+    return [(session.post, (url,), {"content": UPLOAD}), (stream_upload, (url,), {})] * (count // 2)
+
+
+def slow_drip(session, server, scale):
+    """
+    服务端每 10ms 吐一块，16个线程同时等，看慢响应会不会互相阻塞
+    """
+    url = server.url("/drip/10240") + "?chunks=10&delay=0.01"
+    return [(session.get, (url,), {})] * int(160 * scale), 16
+
+
+def many_hosts(session, server, scale):
+    """
+    100个不同的主机名（都指向127.0.0.1）轮流请求，连接池里每个主机各有自己的连接
+    """
+    hosts = ["h%d.bench.local" % i for i in range(100)]
+    for host in hosts:
+        Util.dns_cache.store(host, [(socket.AF_INET, "127.0.0.1")], 3600)
+    urls = [server.url("/bytes/128", host) for host in hosts]
+    return [(session.get, (urls[i % urls.__len__()],), {}) for i in range(int(2000 * scale))]
+
+
+def concurrency(session, server, scale):
+    """
+    32个线程共用一个 Session 发小请求，看连接池和锁的争用
+    """
+    url = server.url("/bytes/1024")
+    return [(session.get, (url,), {})] * int(4000 * scale), 32
+
+
+SCENARIOS = {
+    "small_get": small_get,
+    "chunked_get": chunked_get,
+    "no_keepalive": no_keepalive,
+    "large_download": large_download,
+    "upload": upload,
+    "slow_drip": slow_drip,
+    "many_hosts": many_hosts,
+    "concurrency": concurrency,
+}
+
+
+def peak_rss():
+    """
+    进程的内存峰值，单位字节，拿不到的平台返回None
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(int(round(q * (values.__len__() - 1))), values.__len__() - 1)]
+
+
+def run_scenario(name, scale):
+    """
+    在当前进程里跑一个场景，返回结果字典
+    """
+    with LoopbackServer() as server, Session(max_per_host=64, max_total=256) as session:
+        calls = SCENARIOS[name](session, server, scale)
+        calls, threads = calls if isinstance(calls, tuple) else (calls, 1)
+        # 先热身一次，建立连接、填好DNS缓存，不算进结果
+        func, args, kwargs = calls[0]
+        func(*args, **kwargs)
+
+        # list.append 在多线程下是安全的，字节数也按请求记下来，最后再加起来
+        latencies = []
+        transferred = []
+        errors = []
+
+        def call(item):
+            func, args, kwargs = item
+            start = time.perf_counter()
+            try:
+                response = func(*args, **kwargs)
+            except Exception as e:
+                errors.append(type(e).__name__)
+                return
+            latencies.append(time.perf_counter() - start)
+            timings = response.timings
+            if timings is not None:
+                transferred.append(timings.bytes_in + timings.bytes_out)
+            if not response.status_line.status_code.startswith("2"):
+                errors.append(response.status_line.status_code)
+
+        start = time.perf_counter()
+        if threads > 1:
+            with ThreadPoolExecutor(threads) as executor:
+                list(executor.map(call, calls))
+        else:
+            for item in calls:
+                call(item)
+        elapsed = time.perf_counter() - start
+        pool = session.pool.stats()
+
+    latencies.sort()
+    return {
+        "requests": calls.__len__(),
+        "threads": threads,
+        "errors": errors.__len__(),
+        "seconds": round(elapsed, 4),
+        "rps": round(calls.__len__() / elapsed, 1),
+        "mb_per_s": round(sum(transferred) / elapsed / (1 << 20), 2),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        "peak_rss_mb": round(peak_rss() / (1 << 20), 1) if resource is not None else None,
+        "connections_created": pool["created"],
+        "connections_reused": pool["reused"],
+    }
+
+
+def run_isolated(name, scale):
+    """
+    开一个新的解释器只跑这一个场景，内存峰值才是这个场景自己的
+    """
+    cmd = [sys.executable, "-m", "bench.http_bench", "--worker", name, "--scale", str(scale)]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(cmd, cwd=root, stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, check=True).stdout
+        return output.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def change(current, baseline):
+    if not current or not baseline:
+        return "-"
+    return "%+.1f%%" % ((current - baseline) / baseline * 100)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="回环服务器上的端到端性能测试")
+    arg_parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS),
+                            help="要跑的场景，默认全部")
+    arg_parser.add_argument("--scale", type=float, default=1.0, help="请求数的倍数，调小可以快速跑一遍")
+    arg_parser.add_argument("--output", help="结果写到这个 JSON 文件")
+    arg_parser.add_argument("--compare", help="和之前保存的 JSON 结果对比")
+    arg_parser.add_argument("--in-process", action="store_true", help="所有场景在同一个进程里跑")
+    arg_parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = arg_parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(run_scenario(args.worker, args.scale)))
+        return
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["scenarios"]
+
+    results = {}
+    print("%-16s %9s %10s %9s %9s %9s %8s %8s" % ("scenario", "requests", "req/s", "MB/s", "p50 ms", "p99 ms",
+                                                   "rss MB", "errors"))
+    for name in args.scenarios:
+        result = run_scenario(name, args.scale) if args.in_process else run_isolated(name, args.scale)
+        results[name] = result
+        print("%-16s %9d %10.1f %9.2f %9.3f %9.3f %8s %8d" % (
+            name, result["requests"], result["rps"], result["mb_per_s"], result["p50_ms"], result["p99_ms"],
+            result["peak_rss_mb"], result["errors"]))
+        if name in baseline:
+            old = baseline[name]
+            print("%-16s %9s %10s %9s %9s %9s %8s" % (
+                "  vs baseline", "", change(result["rps"], old["rps"]), change(result["mb_per_s"], old["mb_per_s"]),
+                change(result["p50_ms"], old["p50_ms"]), change(result["p99_ms"], old["p99_ms"]),
+                change(result["peak_rss_mb"], old["peak_rss_mb"])))
+
+    if args.output:
+        report = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "scale": args.scale,
+            "scenarios": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
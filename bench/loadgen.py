@@ -0,0 +1,299 @@
+"""
+开环（open-loop）压测工具，基于 Session
+
+用法（在仓库根目录下执行）：
+    python -m bench.loadgen http://127.0.0.1:8080/get --rate 500 --duration 30 --concurrency 64
+    python -m bench.loadgen --urls urls.txt --rate 200 --duration 60
+    python -m bench.loadgen --template requests.jsonl --rate 100 --duration 10 --json report.json
+    python -m bench.loadgen /bytes/128 --loopback --rate 2000 --duration 5
+
+请求来源（按顺序循环使用）：
+    - 命令行上直接给的 URL
+    - --urls：每行一个 URL，或者 "方法 URL"，# 开头的行忽略
+    - --template：每行一个 JSON 对象，{"method": "POST", "url": "...", "headers": {...}, "params": {...},
+      "data": {...}, "content": "..."}，除了 url 都可以省略
+    - --loopback：在本进程里起一个回环服务器（见 bench/server.py），以 / 开头的 URL 都发到它上面
+
+开环的意思是：第 i 个请求的计划发送时间固定是 开始时间 + i / rate，不管前面的请求有没有返回
+延迟从计划发送时间开始算，客户端来不及发（线程都忙着）的排队时间也算在里面，不会像闭环压测那样
+因为服务端变慢、客户端跟着少发请求而把慢的那部分藏起来（coordinated omission）
+
+报告里分开给出：
+    latency     计划发送时间 -> 收完响应，用户实际感受到的延迟
+    service     实际开始发送 -> 收完响应
+    lag         计划发送时间 -> 实际开始发送，纯粹是客户端自己的排队（线程不够、GIL、调度）
+    ttfb        请求发完 -> 响应第一个字节，基本就是服务端的处理时间加网络往返
+lag 大说明慢在客户端，ttfb 大说明慢在服务端
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from http_client import Session
+
+
+class Histogram:
+    """
+    HDR 风格的对数-线性直方图，记录整数微秒，相对误差不超过 1/half（默认 1/128，不到1%）
+
+    小于 2*half 的值每个值一个桶，精确记录；再往上每翻一倍分成 half 个桶
+    桶是稀疏的（字典），记录任意范围的值占用的内存都很小，合并两个直方图就是把计数加起来
+    """
+
+    def __init__(self, sub_bits=8):
+        self.sub_bits = sub_bits
+        self.half = 1 << (sub_bits - 1)
+        self.counts = {}
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def index(self, value):
+        shift = value.bit_length() - self.sub_bits
+        if shift <= 0:
+            return value
+        return (self.half << 1) + (shift - 1) * self.half + (value >> shift) - self.half
+
+    def highest(self, index):
+        """
+        桶里能放的最大值
+        """
+        if index < self.half << 1:
+            return index
+        shift, offset = divmod(index - (self.half << 1), self.half)
+        shift += 1
+        return ((self.half + offset + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = max(int(seconds * 1000000), 0)
+        index = self.index(value)
+        with self.lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.total += 1
+            self.sum += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q):
+        """
+        第 q 百分位（0~100）的值，单位微秒，返回的是所在桶的上限，不会超过记录到的最大值
+        """
+        if not self.total:
+            return None
+        rank = max(int(q / 100 * self.total + 0.5), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.highest(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.total if self.total else None
+
+    def distribution(self, steps=(50, 75, 90, 95, 99, 99.9, 99.99, 100)):
+        return [(q, self.percentile(q)) for q in steps]
+
+    def as_dict(self):
+        return {
+            "count": self.total,
+            "min_us": self.min,
+            "mean_us": round(self.mean(), 1) if self.total else None,
+            "max_us": self.max,
+            "percentiles_us": {str(q): v for q, v in self.distribution()},
+        }
+
+
+def load_requests(args, base=None):
+    """
+    把命令行上的各种请求来源整理成 (method, url, kwargs) 列表
+    """
+    items = []
+    for url in args.url:
+        items.append(("GET", url, {}))
+    if args.urls:
+        with open(args.urls) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                parts = line.split(None, 1)
+                items.append((parts[0].upper(), parts[1], {}) if parts.__len__() == 2 else ("GET", parts[0], {}))
+    if args.template:
+        with open(args.template) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                kwargs = {k: entry[k] for k in ("headers", "params", "data", "content") if k in entry}
+                items.append((entry.get("method", "GET").upper(), entry["url"], kwargs))
+    if base is not None:
+        items = [(m, base + u if u.startswith("/") else u, kw) for m, u, kw in items]
+    return items
+
+
+class LoadGenerator:
+    """
+    按固定速率把请求排进线程池，线程池的大小就是最多同时在途的请求数
+    """
+
+    def __init__(self, session, items, rate, duration, concurrency, timeout=None):
+        self.session = session
+        self.items = items
+        self.rate = rate
+        self.duration = duration
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+        self.latency = Histogram()
+        self.service = Histogram()
+        self.lag = Histogram()
+        self.ttfb = Histogram()
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.reused = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+        self.scheduled = 0
+        self.elapsed = None
+
+    def one(self, item, intended):
+        method, url, kwargs = item
+        started = time.perf_counter()
+        self.lag.record(started - intended)
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except Exception as e:
+            done = time.perf_counter()
+            with self.lock:
+                self.errors[type(e).__name__] += 1
+        else:
+            done = time.perf_counter()
+            timings = response.timings
+            with self.lock:
+                self.statuses[response.status_line.status_code] += 1
+                if timings is not None:
+                    self.bytes_in += timings.bytes_in
+                    self.bytes_out += timings.bytes_out
+                    self.reused["reused" if timings.reused else "new"] += 1
+            if timings is not None and timings.ttfb is not None:
+                self.ttfb.record(timings.ttfb)
+        self.latency.record(done - intended)
+        self.service.record(done - started)
+
+    def run(self):
+        interval = 1 / self.rate
+        total = int(self.rate * self.duration)
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix="loadgen") as executor:
+            start = time.perf_counter()
+            for i in range(total):
+                intended = start + i * interval
+                delay = intended - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                # 派发本身落后的时候不追赶也不丢弃，照样按计划时间计算延迟
+                executor.submit(self.one, self.items[i % self.items.__len__()], intended)
+                self.scheduled += 1
+        self.elapsed = time.perf_counter() - start
+        return self
+
+    def report(self):
+        pool = self.session.pool.stats()
+        completed = sum(self.statuses.values())
+        return {
+            "target_rps": self.rate,
+            "duration": self.duration,
+            "concurrency": self.concurrency,
+            "scheduled": self.scheduled,
+            "completed": completed,
+            "failed": sum(self.errors.values()),
+            "elapsed": round(self.elapsed, 3),
+            "achieved_rps": round((completed + sum(self.errors.values())) / self.elapsed, 1),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "latency": self.latency.as_dict(),
+            "service": self.service.as_dict(),
+            "lag": self.lag.as_dict(),
+            "ttfb": self.ttfb.as_dict(),
+            "statuses": dict(self.statuses),
+            "errors": dict(self.errors),
+            "connections": {
+                "reused": self.reused["reused"],
+                "new": self.reused["new"],
+                "pool_created": pool["created"],
+                "pool_reused": pool["reused"],
+                "pool_waits": pool["waits"],
+                "pool_wait_time": round(pool["wait_time"], 4),
+            },
+        }
+
+
+def ms(us):
+    return "-" if us is None else "%.3f" % (us / 1000)
+
+
+def print_report(report, out=sys.stdout):
+    print("requests  scheduled %d, completed %d, failed %d in %.2fs (target %.1f/s, achieved %.1f/s)" % (
+        report["scheduled"], report["completed"], report["failed"], report["elapsed"], report["target_rps"],
+        report["achieved_rps"]), file=out)
+    print("transfer  in %d bytes, out %d bytes" % (report["bytes_in"], report["bytes_out"]), file=out)
+    print(file=out)
+    names = ("latency", "service", "lag", "ttfb")
+    print("%-10s" % "ms" + "".join("%12s" % name for name in names), file=out)
+    for key in ("min_us", "mean_us"):
+        print("%-10s" % key[:-3] + "".join("%12s" % ms(report[name][key]) for name in names), file=out)
+    for q in report["latency"]["percentiles_us"]:
+        print("%-10s" % ("p" + q if q != "100" else "max") +
+              "".join("%12s" % ms(report[name]["percentiles_us"][q]) for name in names), file=out)
+    print(file=out)
+    print("statuses  " + (", ".join("%s: %d" % x for x in sorted(report["statuses"].items())) or "-"), file=out)
+    print("errors    " + (", ".join("%s: %d" % x for x in sorted(report["errors"].items())) or "-"), file=out)
+    conns = report["connections"]
+    print("conns     reused %d, new %d; pool created %d, waits %d (%.3fs)" % (
+        conns["reused"], conns["new"], conns["pool_created"], conns["pool_waits"], conns["pool_wait_time"]),
+        file=out)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="基于 Session 的开环压测工具")
+    arg_parser.add_argument("url", nargs="*", help="要请求的 URL，可以给多个，轮流使用")
+    arg_parser.add_argument("--urls", help="URL 列表文件，每行一个 URL 或者 \"方法 URL\"")
+    arg_parser.add_argument("--template", help="请求模板文件，每行一个 JSON 对象")
+    arg_parser.add_argument("--rate", type=float, default=100, help="目标速率，每秒请求数")
+    arg_parser.add_argument("--duration", type=float, default=10, help="持续时间，秒")
+    arg_parser.add_argument("--concurrency", type=int, default=32, help="最多同时在途的请求数")
+    arg_parser.add_argument("--timeout", type=float, help="单个请求的超时时间，秒")
+    arg_parser.add_argument("--loopback", action="store_true", help="在本进程里起一个回环服务器")
+    arg_parser.add_argument("--json", help="报告另外写成 JSON 文件")
+    args = arg_parser.parse_args(argv)
+
+    server = None
+    if args.loopback:
+        from bench.server import LoopbackServer
+        server = LoopbackServer().start()
+    try:
+        items = load_requests(args, server.url("") if server is not None else None)
+        if not items:
+            arg_parser.error("至少要给一个 URL（命令行、--urls 或者 --template）")
+        with Session(max_per_host=args.concurrency, max_total=max(args.concurrency, 100)) as session:
+            report = LoadGenerator(session, items, args.rate, args.duration, args.concurrency,
+                                   args.timeout).run().report()
+    finally:
+        if server is not None:
+            server.close()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
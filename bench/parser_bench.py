@@ -0,0 +1,148 @@
+"""
+响应接收/解析的微基准测试，对比旧的 recv_head/recv_body 字节拼接循环和新的增量解析器
+
+用法（在仓库根目录下执行）：
+    python -m bench.parser_bench
+    python -m bench.parser_bench --sizes 1024 1048576 --legacy-max 0
+
+数据由内存里的假套接字提供，测到的只是接收和解析本身的开销，没有网络的影响
+旧代码的接收是平方复杂度，100MB 的响应要跑几个小时，所以超过 --legacy-max 的大小就跳过旧代码
+"""
+import argparse
+import time
+
+from http_client import BodyReader, Connection, Response, ResponseParser
+
+
+class FakeSocket:
+    """
+    从内存里吐数据的假套接字，每次最多返回 segment 字节，模拟真实网络一次只能收到一部分
+    """
+
+    def __init__(self, data, segment=65536):
+        self.view = memoryview(data)
+        self.pos = 0
+        self.segment = segment
+
+    def recv(self, size):
+        size = min(size, self.segment)
+        data = self.view[self.pos: self.pos + size].tobytes()
+        self.pos += data.__len__()
+        return data
+
+    def recv_into(self, buf, nbytes=0):
+        size = min(buf.__len__() if not nbytes else nbytes, self.segment, self.view.__len__() - self.pos)
+        buf[:size] = self.view[self.pos: self.pos + size]
+        self.pos += size
+        return size
+
+    def close(self):
+        pass
+
+
+def build_response(size):
+    head = ("HTTP/1.1 200 OK\r\n"
+            "Content-Type: application/octet-stream\r\n"
+            "Content-Length: %d\r\n"
+            "\r\n" % size).encode()
+    return head + b"x" * size
+
+
+def legacy_recv(sock, response):
+    """
+    改动之前的 Session.recv_head / Session.recv_body，去掉了 print，其余原样保留
+    """
+    buffer = b""
+    while True:
+        d = sock.recv(1024)
+        if d:
+            buffer += d
+            if b'\r\n\r\n' in buffer:
+                response.status_line.parse(buffer[: buffer.find(b"\r\n")])
+                response.headers.parse(buffer[buffer.find(b"\r\n")+2: buffer.find(b"\r\n\r\n")])
+                break
+        else:
+            break
+    buffer = buffer[buffer.find(b"\r\n\r\n") + 4:]
+
+    while True:
+        if buffer.__len__() >= int(response.headers["Content-Length"]):
+            response.body.parse(buffer)
+            break
+        d = sock.recv(1024)
+        if d:
+            buffer += d
+        else:
+            break
+    return response
+
+
+def current_recv(conn, sock, response):
+    """
+    和 Session.recv_head / Session.recv_body 走的是同一套解析器和 BodyReader，只是没有 print
+    """
+    conn.socket = sock
+    parser = ResponseParser(response)
+    while not parser.head_done:
+        pending = conn.pending()
+        if pending:
+            consumed, _ = parser.feed(pending)
+            conn.consume(consumed)
+        elif not conn.fill():
+            break
+    if not parser.done:
+        response.body.parse(BodyReader(conn, parser).read())
+    return response
+
+
+def measure(func, raw, min_time):
+    """
+    反复执行直到累计时间超过 min_time，返回每秒处理的字节数
+    """
+    rounds, elapsed = 0, 0.0
+    while elapsed < min_time or not rounds:
+        sock = FakeSocket(raw)
+        response = Response()
+        start = time.perf_counter()
+        func(sock, response)
+        elapsed += time.perf_counter() - start
+        rounds += 1
+        assert response.body.content.__len__() + raw.find(b"\r\n\r\n") + 4 == raw.__len__()
+    return raw.__len__() * rounds / elapsed
+
+
+def human(num):
+    for unit in ("B", "KB", "MB", "GB"):
+        if num < 1024 or unit == "GB":
+            return "%.1f %s" % (num, unit)
+        num /= 1024
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="响应解析微基准测试")
+    arg_parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 1024 * 1024, 100 * 1024 * 1024],
+                            help="响应主体大小，单位字节")
+    arg_parser.add_argument("--legacy-max", type=int, default=4 * 1024 * 1024,
+                            help="超过这个大小不再测试旧代码")
+    arg_parser.add_argument("--min-time", type=float, default=1.0, help="每一项至少测试多少秒")
+    args = arg_parser.parse_args(argv)
+
+    # 连接对象在实际使用中是从连接池里复用的，接收缓冲区只分配一次，这里也一样
+    conn = Connection(("http", "bench", 80), None)
+
+    def current(sock, response):
+        current_recv(conn, sock, response)
+
+    print("%-12s %16s %16s %10s" % ("body", "legacy/s", "current/s", "speedup"))
+    for size in args.sizes:
+        raw = build_response(size)
+        new_rate = measure(current, raw, args.min_time)
+        if size <= args.legacy_max:
+            old_rate = measure(legacy_recv, raw, args.min_time)
+            print("%-12s %16s %16s %9.1fx" % (human(size), human(old_rate), human(new_rate), new_rate / old_rate))
+        else:
+            print("%-12s %16s %16s %10s" % (human(size), "skipped", human(new_rate), "-"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+跑在本进程里的回环 HTTP/1.1 服务端，给性能测试用，不依赖外网
+
+    with LoopbackServer() as server:
+        s.get(server.url("/bytes/1024"))
+
+支持的路径（n 都是主体的字节数）：
+    GET  /bytes/<n>                         Content-Length 定长主体，连接保持
+    GET  /chunked/<n>?chunk=<k>             chunked 编码，每块 k 字节
+    GET  /drip/<n>?chunks=<c>&delay=<s>     分 c 块慢慢吐出来，每块之间停 s 秒
+    GET  /close/<n>                         定长主体，发完之后关闭连接（Connection: close）
+    POST/PUT /upload                        读完请求主体（定长或者 chunked）丢掉，响应主体是收到的字节数
+
+主体内容都是从同一块预先分配好的缓冲区里切出来的，大响应不会让服务端自己的内存涨上去
+"""
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+BLOCK = memoryview(b"x" * (1 << 20))
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # 主体和首部是分开写的，不关掉 Nagle 的话小响应每个都要多等一个 ACK 的延迟
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def route(self):
+        parts = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        segments = parts.path.strip("/").split("/")
+        size = int(segments[1]) if segments.__len__() > 1 and segments[1].isdigit() else 0
+        return segments[0], size, query
+
+    def write_body(self, size):
+        while size > 0:
+            n = min(size, BLOCK.__len__())
+            self.wfile.write(BLOCK[:n])
+            size -= n
+
+    def write_chunk(self, size):
+        self.wfile.write(b"%x\r\n" % size)
+        self.write_body(size)
+        self.wfile.write(b"\r\n")
+
+    def do_GET(self):
+        name, size, query = self.route()
+        if name in ("bytes", "close"):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(size))
+            if name == "close":
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            self.write_body(size)
+        elif name in ("chunked", "drip"):
+            if name == "chunked":
+                chunk, delay = int(query.get("chunk", 8192)), 0
+            else:
+                chunks = max(int(query.get("chunks", 10)), 1)
+                chunk, delay = max(-(-size // chunks), 1), float(query.get("delay", 0.01))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            while size > 0:
+                if delay:
+                    time.sleep(delay)
+                self.write_chunk(min(chunk, size))
+                size -= chunk
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.route()[0] != "upload":
+            self.send_error(404)
+            return
+        received = 0
+        buf = bytearray(1 << 16)
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                received += self.drain(buf, size)
+                self.rfile.readline()
+                if not size:
+                    break
+        else:
+            received = self.drain(buf, int(self.headers.get("Content-Length", 0)))
+        body = str(received).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(body.__len__()))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_PUT = do_POST
+
+    def drain(self, buf, size):
+        view = memoryview(buf)
+        left = size
+        while left > 0:
+            n = self.rfile.readinto(view[:min(left, view.__len__())])
+            if not n:
+                break
+            left -= n
+        return size - left
+
+
+class LoopbackServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), Handler)
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def url(self, path="/", host=None):
+        """
+        host 可以换成别的名字（事先放进DNS缓存指向127.0.0.1），用来模拟很多个不同的主机
+        """
+        return "http://%s:%d%s" % (host or self.server_address[0], self.port, path)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        if self.thread is not None:
+            self.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
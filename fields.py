@@ -123,3 +123,11 @@ Via = "Via"
 Warning = "Warning"
 
 
+
+"""
+RFC 6265 状态管理
+cookie-header     = "Cookie:" OWS cookie-string OWS
+set-cookie-header = "Set-Cookie:" SP set-cookie-string
+"""
+Cookie = "Cookie"
+Set_Cookie = "Set-Cookie"
@@ -0,0 +1,385 @@
+"""
+HTTP/2 传输层，帧的编解码、HPACK首部压缩和流量控制交给 h2 库，这里负责套接字收发和多路复用
+一个 H2Connection 同时承载多个请求（流），多个线程可以同时在同一个连接上发请求，各自等待自己的响应
+Session(http2=True) 的时候由 Session 创建和管理，一般不需要直接使用
+"""
+import socket
+import threading
+import time
+
+# h2 不是标准库，装了才支持HTTP/2
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.exceptions
+    import h2.events
+    import h2.settings
+except ImportError:
+    h2 = None
+
+
+# RFC7540 Section 8.1.2.2：HTTP/2 里面不能出现的逐跳首部
+connection_headers = {"connection", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade", "host"}
+
+
+class H2Stream:
+    """
+    连接上的一个流，也就是一对请求和响应
+    收到的 DATA 帧先放在这里，调用者读走之后才发 WINDOW_UPDATE，调用者读得慢服务端就会被流量控制挡住，内存不会无限增长
+    """
+
+    def __init__(self, conn, stream_id):
+        self.conn = conn
+        self.stream_id = stream_id
+        self.status = None
+        self.headers = None                     # [(名字, 值)]，bytes
+        self.trailers = None
+        self.chunks = []                        # 收到还没读走的 DATA
+        self.chunk_pos = 0                      # chunks[0] 已经读到的位置
+        self.ended = False                      # 服务端已经发完了（END_STREAM）
+        self.error = None
+        self.bytes_in = 0                       # 收到的主体字节数（流量控制口径，包括填充）
+        self.bytes_out = 0
+        self.first_byte_at = None
+
+    def wait_response(self, timeout=None):
+        """
+        等待响应首部，返回 (状态码, 首部列表)
+        """
+        conn = self.conn
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with conn.lock:
+            while self.status is None:
+                if self.error is not None:
+                    raise self.error
+                conn.wait(deadline)
+        return self.status, self.headers
+
+    def readinto(self, buf, timeout=None):
+        """
+        把收到的主体数据写进buf，返回写入的字节数，返回0表示主体读完了
+        """
+        buf = memoryview(buf).cast("B")
+        conn = self.conn
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with conn.lock:
+            while not self.chunks:
+                if self.ended:
+                    return 0
+                if self.error is not None:
+                    raise self.error
+                conn.wait(deadline)
+
+            n = 0
+            while self.chunks and n < buf.__len__():
+                chunk = self.chunks[0]
+                size = min(buf.__len__() - n, chunk.__len__() - self.chunk_pos)
+                buf[n: n + size] = chunk[self.chunk_pos: self.chunk_pos + size]
+                n += size
+                self.chunk_pos += size
+                if self.chunk_pos == chunk.__len__():
+                    self.chunks.pop(0)
+                    self.chunk_pos = 0
+            conn.acknowledge(self.stream_id, n)
+        return n
+
+    def read(self, timeout=None):
+        """
+        读出剩下的全部主体
+        """
+        conn = self.conn
+        deadline = None if timeout is None else time.monotonic() + timeout
+        body = bytearray()
+        with conn.lock:
+            while True:
+                n = 0
+                if self.chunk_pos:
+                    chunk = self.chunks.pop(0)
+                    body += memoryview(chunk)[self.chunk_pos:]
+                    n += chunk.__len__() - self.chunk_pos
+                    self.chunk_pos = 0
+                for chunk in self.chunks:
+                    body += chunk
+                    n += chunk.__len__()
+                self.chunks.clear()
+                if n:
+                    conn.acknowledge(self.stream_id, n)
+                if self.ended:
+                    return body
+                if self.error is not None:
+                    raise self.error
+                conn.wait(deadline)
+
+    def close(self):
+        """
+        不再读取这个流，还没结束的话发 RST_STREAM，已经收到的数据也要算进连接的接收窗口
+        """
+        conn = self.conn
+        with conn.lock:
+            unread = sum(chunk.__len__() for chunk in self.chunks) - self.chunk_pos
+            self.chunks.clear()
+            self.chunk_pos = 0
+            if unread:
+                conn.acknowledge(self.stream_id, unread)
+            if not self.ended and self.error is None:
+                self.error = ConnectionAbortedError("流已经关闭")
+                conn.reset(self.stream_id)
+
+
+class H2Connection:
+    """
+    HTTP/2 连接，后台线程负责从套接字读帧并分发给各个流，发送在调用者自己的线程里完成，所有状态都在一把锁里面
+
+    - 同时打开的流不超过服务端 SETTINGS_MAX_CONCURRENT_STREAMS，超出的请求等待其他流结束
+    - 请求主体按对端的流量控制窗口分帧发送，窗口用完了就等 WINDOW_UPDATE
+    - 收到 GOAWAY 之后不再开新流，编号大于 last_stream_id 的流服务端没有处理，抛出 ConnectionResetError，可以安全重发
+    """
+
+    window_size = 16 << 20                      # 每个流和整个连接的接收窗口
+    read_size = 65536
+    send_timeout = 10                           # 发送帧的超时，对端一直不收的话连接当作断开
+
+    def __init__(self, key, sock, tls=None):
+        if h2 is None:
+            raise Exception("使用HTTP/2需要安装 h2: pip install h2")
+        self.key = key
+        self.socket = sock
+        self.tls = tls
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.requests = 0                       # 在这个连接上发起过的请求数
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        self.streams = {}                       # stream_id -> H2Stream
+        self.closed = False                     # 连接已经断开
+        self.goaway = False                     # 收到了 GOAWAY，不能再开新流
+        self.error = None
+        self.lock = threading.Condition()
+
+        config = h2.config.H2Configuration(client_side=True, header_encoding=None)
+        self.h2 = h2.connection.H2Connection(config)
+        self.h2.local_settings = h2.settings.Settings(client=True, initial_values={
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: self.window_size,
+            h2.settings.SettingCodes.ENABLE_PUSH: 0,
+        })
+        self.h2.initiate_connection()
+        self.h2.increment_flow_control_window(self.window_size - 65535)
+
+        # flush 是在持有锁的时候发送的，发送阻塞住会把读线程和所有的流一起挡住，所以套接字要有超时；
+        # 读线程的 recv 超时了只是继续等，各个流自己等待的时候有各自的超时
+        self.socket.settimeout(self.send_timeout)
+        self.flush()
+        self.reader = threading.Thread(target=self._read_loop, name="h2-%s:%s" % key[1:], daemon=True)
+        self.reader.start()
+
+    @property
+    def available(self):
+        """
+        还能不能在这个连接上开新流
+        """
+        return not self.closed and not self.goaway and \
+            self.h2.highest_outbound_stream_id + 2 <= self.h2.HIGHEST_ALLOWED_STREAM_ID
+
+    @property
+    def active(self):
+        return self.h2.open_outbound_streams
+
+    def request(self, headers, body=None, timeout=None):
+        """
+        开一个新流发送请求首部，body 是主体的字节串或者逐块产出字节串的迭代器，返回 H2Stream
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while self.available and self.active >= self.h2.remote_settings.max_concurrent_streams:
+                self.wait(deadline)
+            if not self.available:
+                raise self.error or ConnectionResetError("HTTP/2 连接已经关闭")
+            stream_id = self.h2.get_next_available_stream_id()
+            stream = H2Stream(self, stream_id)
+            self.streams[stream_id] = stream
+            self.requests += 1
+            self.last_used = time.monotonic()
+            self.h2.send_headers(stream_id, headers, end_stream=body is None)
+            self.flush()
+
+        if body is not None:
+            if isinstance(body, (bytes, bytearray, memoryview)):
+                body = (body,)
+            try:
+                for chunk in body:
+                    self._send_data(stream, memoryview(chunk).cast("B"), deadline)
+                with self.lock:
+                    self._check(stream)
+                    self.h2.end_stream(stream_id)
+                    self.flush()
+            except BaseException:
+                # 主体没发完（超时、读主体出错等），这个流不能留在连接上占着并发数
+                stream.close()
+                raise
+        return stream
+
+    def _send_data(self, stream, view, deadline):
+        while view.__len__():
+            with self.lock:
+                while True:
+                    self._check(stream)
+                    window = self.h2.local_flow_control_window(stream.stream_id)
+                    if window > 0:
+                        break
+                    self.wait(deadline)
+                n = min(window, self.h2.max_outbound_frame_size, view.__len__())
+                self.h2.send_data(stream.stream_id, view[:n])
+                stream.bytes_out += n
+                self.flush()
+            view = view[n:]
+
+    def _check(self, stream):
+        if stream.error is not None:
+            raise stream.error
+        if self.closed:
+            raise self.error or ConnectionResetError("HTTP/2 连接已经关闭")
+
+    def wait(self, deadline):
+        """
+        在锁里面等待读线程的通知，超过截止时间抛出 socket.timeout
+        """
+        if deadline is None:
+            self.lock.wait()
+            return
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("请求超时!")
+        self.lock.wait(remaining)
+
+    def acknowledge(self, stream_id, n):
+        """
+        调用者读走了n字节，归还流量控制窗口，调用的时候要持有锁
+        """
+        if self.closed:
+            return
+        self.h2.acknowledge_received_data(n, stream_id)
+        self.flush()
+
+    def reset(self, stream_id):
+        if self.closed:
+            return
+        try:
+            self.h2.reset_stream(stream_id, h2.errors.ErrorCodes.CANCEL)
+        except h2.exceptions.StreamClosedError:
+            pass
+        self.streams.pop(stream_id, None)
+        self.flush()
+
+    def flush(self):
+        """
+        把 h2 攒下的帧发出去，调用的时候要持有锁
+        超过 send_timeout 秒还发不出去（对端不读、网络断了）的话 socket.timeout 也是 OSError，整个连接作废
+        """
+        data = self.h2.data_to_send()
+        if data and not self.closed:
+            try:
+                self.socket.sendall(data)
+                self.bytes_out += data.__len__()
+            except OSError as e:
+                self._fail(e)
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.h2.close_connection()
+                self.flush()
+                self._fail(ConnectionResetError("HTTP/2 连接已经关闭"))
+
+    def _fail(self, error):
+        """
+        连接断开，所有还没结束的流都失败，调用的时候要持有锁
+        """
+        self.closed = True
+        self.error = self.error or error
+        for stream in self.streams.values():
+            if not stream.ended and stream.error is None:
+                stream.error = error
+        self.streams.clear()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        self.lock.notify_all()
+
+    def _read_loop(self):
+        while True:
+            try:
+                data = self.socket.recv(self.read_size)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                with self.lock:
+                    if not self.closed:
+                        self._fail(e)
+                return
+            with self.lock:
+                if self.closed:
+                    return
+                if not data:
+                    self._fail(ConnectionResetError("服务端关闭了HTTP/2连接"))
+                    return
+                self.bytes_in += data.__len__()
+                try:
+                    events = self.h2.receive_data(data)
+                except h2.exceptions.ProtocolError as e:
+                    self.flush()
+                    self._fail(ConnectionResetError("HTTP/2 协议错误: %s" % e))
+                    return
+                for event in events:
+                    self._handle(event)
+                self.flush()
+                self.lock.notify_all()
+
+    def _handle(self, event):
+        stream = self.streams.get(getattr(event, "stream_id", None))
+        if isinstance(event, h2.events.ResponseReceived):
+            if stream is not None:
+                stream.first_byte_at = time.perf_counter()
+                stream.headers = [(name, value) for name, value in event.headers if name != b":status"]
+                stream.status = dict(event.headers)[b":status"].decode()
+        elif isinstance(event, h2.events.DataReceived):
+            if stream is None:
+                # 已经关闭的流，直接归还窗口
+                self.h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            else:
+                stream.chunks.append(event.data)
+                stream.bytes_in += event.flow_controlled_length
+                # 填充的字节调用者读不到，收到的时候就归还
+                padding = event.flow_controlled_length - event.data.__len__()
+                if padding:
+                    self.h2.acknowledge_received_data(padding, event.stream_id)
+        elif isinstance(event, h2.events.TrailersReceived):
+            if stream is not None:
+                stream.trailers = list(event.headers)
+        elif isinstance(event, h2.events.StreamEnded):
+            if stream is not None:
+                stream.ended = True
+                self.streams.pop(event.stream_id, None)
+            if self.goaway and not self.streams:
+                self._fail(ConnectionResetError("HTTP/2 连接已经关闭"))
+        elif isinstance(event, h2.events.StreamReset):
+            if stream is not None:
+                code = event.error_code
+                if code == h2.errors.ErrorCodes.REFUSED_STREAM:
+                    # 服务端没有处理这个流，可以安全重发
+                    stream.error = ConnectionResetError("服务端拒绝了这个流(REFUSED_STREAM)")
+                else:
+                    stream.error = Exception("流被服务端重置: %s" % code)
+                self.streams.pop(event.stream_id, None)
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.goaway = True
+            last = event.last_stream_id or 0
+            for stream_id, stream in list(self.streams.items()):
+                if stream_id > last:
+                    stream.error = ConnectionResetError("服务端发送了GOAWAY，这个流没有被处理")
+                    self.streams.pop(stream_id)
+            if event.error_code != h2.errors.ErrorCodes.NO_ERROR or not self.streams:
+                self._fail(ConnectionResetError("服务端关闭了HTTP/2连接: %s" % event.error_code))
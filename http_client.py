@@ -1,57 +1,518 @@
 import socket
 import re
 import dns.resolver
-import copy
-from collections import UserDict
+import dns.rdatatype
+import dns.exception
+import os
+import errno
+import time
+import select
+import selectors
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from urllib.parse import urljoin
 import fields as fs
+import http2
 import ssl
+import zlib
+import mmap
+import json
+import bisect
+import random
+import heapq
+import itertools
+import hashlib
+import weakref
+import email.utils
+import logging
+
+logger = logging.getLogger(__name__)
+
+# brotli/zstd 不是标准库，装了才支持
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
-# 需要合并到Util里面
 class Cookie:
-    def __init__(self, host, port, content):
-        self.host = host
-        self.port = port
-        self.content = content
+    """
+    一条cookie，属性的含义见 RFC6265 Section 5.3
+    """
 
+    def __init__(self, name, value, domain, path="/", expires=None, secure=False, host_only=True, http_only=False):
+        self.name = name
+        self.value = value
+        self.domain = domain                    # 小写，不带开头的点
+        self.path = path
+        self.expires = expires                  # 过期时间（时间戳），None表示会话cookie
+        self.secure = secure
+        self.host_only = host_only              # 没有 Domain 属性的cookie只发给设置它的那个主机
+        self.http_only = http_only
+        self.created = time.time()
 
-class Util:
+    def __repr__(self):
+        return "<Cookie %s=%s for %s%s>" % (self.name, self.value, "" if self.host_only else ".", self.domain + self.path)
 
-    # URL编码
-    @classmethod
-    def url_encode(cls, arg_str, safe_char="", encoding="utf-8"):
-        my_map = map(lambda x: x if x in safe_char else x.encode(encoding).__str__()[2:-1].replace("\\x", "%"), arg_str)
-        res_rtn = "".join(my_map)
-        return res_rtn
+    def expired(self, now=None):
+        return self.expires is not None and self.expires <= (now or time.time())
+
+    def domain_match(self, host):
+        if self.host_only:
+            return host == self.domain
+        return host == self.domain or host.endswith("." + self.domain)
+
+    def path_match(self, path):
+        """
+        RFC6265 Section 5.1.4
+        """
+        return path == self.path or path.startswith(self.path) and (self.path[-1:] == "/" or path[self.path.__len__()] == "/")
+
+
+class CookieJar:
+    """
+    每个 Session 一个cookie罐，收到响应的时候解析 Set-Cookie 存进来，发送请求之前取出匹配的cookie拼成 Cookie 首部
+
+    cookie按 可注册域名 -> 路径 两级索引，查找的时候只看请求主机所在的那个可注册域名下面的几个路径，cookie再多也不会变慢
+    过期的cookie不会主动清理，查找的时候碰到了再删掉
+    可注册域名是近似算的（没有带公共后缀列表）：一般取最后两段，像 co.uk、com.cn 这种二级后缀取最后三段
+    """
 
-    # DNS缓存，这个地方缓存永不过期，这么干可能会有问题，但考虑到这是个微框架，且少有网站会动不动更换解析地址，暂且这么用着
-    dns_dict = {}
+    second_level = ("co", "com", "net", "org", "gov", "edu", "ac")
+
+    def __init__(self):
+        self.index = {}                         # 可注册域名 -> {path -> {(domain, name): Cookie}}
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        with self.lock:
+            cookies = [c for paths in self.index.values() for bucket in paths.values() for c in bucket.values()]
+        return iter(cookies)
 
     @classmethod
-    def get_dns(cls, host_string):
+    def registrable_domain(cls, host):
+        if Request.ip_pattern.fullmatch(host) is not None or ":" in host:
+            return host
+        labels = host.split(".")
+        n = 3 if labels.__len__() >= 3 and labels[-2] in cls.second_level and labels[-1].__len__() == 2 else 2
+        return ".".join(labels[-n:])
+
+    def set(self, cookie):
+        """
+        存入一条cookie，同域名同路径同名的会被替换，已经过期的相当于删除
+        """
+        key = self.registrable_domain(cookie.domain)
+        with self.lock:
+            bucket = self.index.setdefault(key, {}).setdefault(cookie.path, {})
+            old = bucket.pop((cookie.domain, cookie.name), None)
+            if old is not None:
+                cookie.created = old.created
+                self.count -= 1
+            if not cookie.expired():
+                bucket[(cookie.domain, cookie.name)] = cookie
+                self.count += 1
+            elif not bucket:
+                self._drop_empty(key, cookie.path)
+
+    def extract(self, request, response):
+        """
+        从响应的所有 Set-Cookie 首部里面取出cookie存起来
+        """
+        host = request.conn_info["host"].lower()
+        path = request.request_line.request_uri.split("?", 1)[0]
+        for value in response.headers.get_all("Set-Cookie"):
+            cookie = self.parse(value, host, path)
+            if cookie is not None:
+                self.set(cookie)
+
+    def header(self, request):
+        """
+        返回这个请求应该带上的 Cookie 首部的值，没有cookie的时候返回None
+        同名cookie路径长的排在前面，路径一样的先设置的排在前面，RFC6265 Section 5.4
+        """
+        host = request.conn_info["host"].lower()
+        path = request.request_line.request_uri.split("?", 1)[0] or "/"
+        secure = request.conn_info["protocol"] == "https"
+        key = self.registrable_domain(host)
+        now = time.time()
+
+        matched = []
+        with self.lock:
+            paths = self.index.get(key)
+            if not paths:
+                return None
+            for cookie_path, bucket in list(paths.items()):
+                if not (path == cookie_path or path.startswith(cookie_path)):
+                    continue
+                for k, cookie in list(bucket.items()):
+                    if cookie.expired(now):
+                        del bucket[k]
+                        self.count -= 1
+                    elif cookie.path_match(path) and cookie.domain_match(host) and (secure or not cookie.secure):
+                        matched.append(cookie)
+                if not bucket:
+                    self._drop_empty(key, cookie_path)
+
+        if not matched:
+            return None
+        matched.sort(key=lambda c: (-c.path.__len__(), c.created))
+        return "; ".join("%s=%s" % (c.name, c.value) if c.name else c.value for c in matched)
+
+    def clear(self, domain=None):
+        with self.lock:
+            if domain is None:
+                self.index.clear()
+                self.count = 0
+                return
+            domain = domain.lower().lstrip(".")
+            paths = self.index.get(self.registrable_domain(domain), {})
+            for cookie_path, bucket in list(paths.items()):
+                for k in [k for k in bucket if k[0] == domain or k[0].endswith("." + domain)]:
+                    del bucket[k]
+                    self.count -= 1
+                if not bucket:
+                    self._drop_empty(self.registrable_domain(domain), cookie_path)
+
+    def save(self, path):
+        """
+        保存成 Netscape cookies.txt 格式，一行一条，会话cookie的过期时间记为0，已经过期的不保存
+        """
+        now = time.time()
+        with open(path, "w") as f:
+            f.write("# Netscape HTTP Cookie File\n")
+            for c in self:
+                if c.expired(now):
+                    continue
+                f.write("\t".join((
+                    ("#HttpOnly_" if c.http_only else "") + ("" if c.host_only else ".") + c.domain,
+                    "FALSE" if c.host_only else "TRUE", c.path, "TRUE" if c.secure else "FALSE",
+                    str(int(c.expires or 0)), c.name, c.value)) + "\n")
+
+    def load(self, path):
+        """
+        读取 save 保存的文件，过期的cookie直接跳过
+        """
+        with open(path) as f:
+            for line in f:
+                line = line.rstrip("\n")
+                http_only = line.startswith("#HttpOnly_")
+                if http_only:
+                    line = line[10:]
+                if not line or line.startswith("#"):
+                    continue
+                fields = line.split("\t")
+                if fields.__len__() != 7:
+                    continue
+                domain, subdomains, cookie_path, secure, expires, name, value = fields
+                cookie = Cookie(name, value, domain.lstrip(".").lower(), cookie_path, int(expires) or None,
+                                secure == "TRUE", subdomains != "TRUE", http_only)
+                if not cookie.expired():
+                    self.set(cookie)
+
+    def parse(self, set_cookie, host, request_path="/"):
+        """
+        解析一条 Set-Cookie 首部，RFC6265 Section 5.2，不合法或者域名不匹配的时候返回None
+        """
+        pair, _, attrs = set_cookie.partition(";")
+        name, eq, value = pair.partition("=")
+        name, value = (name.strip(), value.strip()) if eq else ("", name.strip())
+        if not name and not value:
+            return None
+
+        domain, cookie_path, expires, max_age, secure, http_only = None, None, None, None, False, False
+        for attr in attrs.split(";"):
+            k, _, v = attr.partition("=")
+            k, v = k.strip().lower(), v.strip()
+            if k == "expires":
+                expires = self.parse_date(v)
+            elif k == "max-age":
+                if re.fullmatch("-?\d+", v) is not None:
+                    max_age = int(v)
+            elif k == "domain" and v:
+                domain = v.lstrip(".").lower()
+            elif k == "path":
+                cookie_path = v if v[:1] == "/" else None
+            elif k == "secure":
+                secure = True
+            elif k == "httponly":
+                http_only = True
+
+        if max_age is not None:
+            expires = time.time() + max_age if max_age > 0 else 0     # Max-Age 优先于 Expires
+
+        # 默认路径是请求路径最后一个斜杠之前的部分，RFC6265 Section 5.1.4
+        if cookie_path is None:
+            cookie_path = request_path[:request_path.rfind("/")] if request_path.count("/") > 1 else "/"
+
+        if domain is None or domain == host:
+            return Cookie(name, value, host, cookie_path, expires, secure, domain is None, http_only)
+        # 只能给自己或者上级域名设置cookie，不能设置到公共后缀上
+        if not host.endswith("." + domain) or "." not in domain or \
+                self.registrable_domain(domain) != self.registrable_domain(host):
+            return None
+        return Cookie(name, value, domain, cookie_path, expires, secure, False, http_only)
+
+    @staticmethod
+    def parse_date(value):
+        """
+        cookie的日期格式五花八门，常见的 "Wed, 09 Jun 2021 10:18:14 GMT" 和 "Wed, 09-Jun-2021 10:18:14 GMT" 都能解析
+        """
+        try:
+            return email.utils.parsedate_to_datetime(value.replace("-", " ")).timestamp()
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return None
+
+    def _drop_empty(self, key, path):
+        paths = self.index.get(key)
+        if paths is not None and not paths.get(path, True):
+            del paths[path]
+            if not paths:
+                del self.index[key]
+
+
+class DNSCache:
+    """
+    DNS缓存
+
+    - 按记录的TTL过期（限制在 min_ttl ~ max_ttl 之间），最多保存 max_size 个域名，超出时淘汰最久未使用的
+    - 域名不存在（NXDOMAIN）的结果也缓存 negative_ttl 秒，避免反复去查一个不存在的域名
+    - 多个线程同时查同一个没缓存的域名时，只有一个线程真正去查询，其他线程等它的结果
+    - A 和 AAAA 记录全部保存，每次取用的时候轮换顺序，实现简单的轮询
+    """
+
+    def __init__(self, max_size=1024, min_ttl=1, max_ttl=3600, negative_ttl=30):
+        self.max_size = max_size
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.resolver = None                    # 第一次用到的时候才创建，创建时会读取系统的DNS配置
+
+        self.entries = OrderedDict()            # host -> [addresses, expires, error, next]
+        self.resolving = {}                     # host -> Future，正在查询的域名
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self.entries.__len__()
+
+    def get(self, host):
+        """
+        返回一个ip，优先IPv4，多个地址的时候每次调用轮换一个
+        """
+        return self.pick(self.resolve(host))
+
+    @staticmethod
+    def pick(addresses):
+        for family, ip in addresses:
+            if family == socket.AF_INET:
+                return ip
+        return addresses[0][1]
+
+    def resolve(self, host, rotate=True):
+        """
+        返回全部地址 [(family, ip), ...]，有缓存用缓存，没有的话查询一次
+        rotate为False的时候按原始顺序返回，也不计入命中统计，用于同一个请求第二次取地址
+        """
+        with self.lock:
+            addresses = self._lookup(host, rotate)
+            if addresses is not None:
+                return addresses
+            future = self.resolving.get(host)
+            owner = future is None
+            if owner:
+                future = self.resolving[host] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            addresses, ttl = self.query(host)
+        except Exception as e:
+            with self.lock:
+                del self.resolving[host]
+                if isinstance(e, (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)):
+                    self._store(host, None, self.negative_ttl, e)
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.resolving[host]
+            self._store(host, addresses, ttl)
+        future.set_result(addresses)
+        return addresses
+
+    def lookup(self, host):
+        """
+        只查缓存：命中返回地址列表，过期或者没有返回None，命中否定缓存的话抛出之前查询时的异常
+        """
+        with self.lock:
+            return self._lookup(host)
+
+    def store(self, host, addresses, ttl):
+        """
+        存入查询结果，AsyncSession 自己做异步查询之后用这个写进同一份缓存
+        """
+        with self.lock:
+            self._store(host, addresses, ttl)
+
+    def store_error(self, host, error):
+        with self.lock:
+            self._store(host, None, self.negative_ttl, error)
+
+    def invalidate(self, host=None):
+        with self.lock:
+            if host is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(host, None)
+
+    def prewarm(self, hosts, max_workers=8):
+        """
+        启动的时候先把一批域名解析好，返回 {host: 地址列表或者异常}
+        """
+        result = {}
+
+        def resolve(host):
+            try:
+                return host, self.resolve(host)
+            except Exception as e:
+                return host, e
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for host, addresses in executor.map(resolve, hosts):
+                result[host] = addresses
+        return result
+
+    def query(self, host):
+        """
+        真正去查询 A 和 AAAA 记录，返回 (addresses, ttl)
+        """
+        if self.resolver is None:
+            self.resolver = dns.resolver.Resolver()
+        answers = []
+        for rdtype in ("A", "AAAA"):
+            try:
+                answers.append(self.resolver.resolve(host, rdtype, raise_on_no_answer=False))
+            except dns.resolver.NXDOMAIN:
+                raise
+            except dns.exception.DNSException as e:
+                # 只查到一种记录也可以用，两种都失败的时候才报错
+                if rdtype == "AAAA" and answers:
+                    continue
+                answers.append(e)
+        return self.collect(host, answers)
+
+    def collect(self, host, answers):
+        """
+        从 dnspython 的 Answer 里面取出全部地址和最短的剩余TTL，异步查询也用这个函数整理结果
+        """
+        addresses = []
+        expiration = None
+        error = None
+        for answer in answers:
+            if isinstance(answer, Exception):
+                error = answer
+                continue
+            if answer.rrset is not None:
+                family = socket.AF_INET6 if answer.rdtype == dns.rdatatype.AAAA else socket.AF_INET
+                addresses.extend((family, record.address) for record in answer.rrset)
+            expiration = answer.expiration if expiration is None else min(expiration, answer.expiration)
+
+        if not addresses:
+            raise error if error is not None else dns.resolver.NoAnswer("%s 没有A/AAAA记录" % host)
+        return addresses, expiration - time.time()
 
-        if host_string in Util.dns_dict:
-            return Util.dns_dict[host_string]
+    def _lookup(self, host, rotate=True):
+        entry = self.entries.get(host)
+        if entry is None or entry[1] <= time.monotonic():
+            self.misses += rotate
+            return None
+        self.entries.move_to_end(host)
+        self.hits += rotate
+        if entry[2] is not None:
+            raise entry[2]
+
+        # 每次取用轮换一下起始位置，同一个域名的请求轮流分散到各个地址上，IPv4 和 IPv6 各自轮换
+        addresses, start = entry[0], entry[3]
+        if rotate:
+            entry[3] = start + 1
         else:
-            ip = dns.resolver.query(host_string, 'A').response.answer[-1].items[0].address
-            Util.dns_dict.update({host_string: ip})
-            return ip
+            start = 0
+        rtn = []
+        for family in (socket.AF_INET, socket.AF_INET6):
+            group = [x for x in addresses if x[0] == family]
+            if group:
+                i = start % group.__len__()
+                rtn.extend(group[i:] + group[:i])
+        return rtn
+
+    def _store(self, host, addresses, ttl, error=None):
+        if error is None:
+            ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        self.entries[host] = [addresses, time.monotonic() + ttl, error, 0]
+        self.entries.move_to_end(host)
+        while self.entries.__len__() > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class Util:
+
+    # URL编码：RFC3986 的非保留字符（字母数字和 -._~）以及 safe_char 里的字符保持原样，其余的按 encoding 编码后逐字节转成 %XX
+    # 整个字符串只用正则扫一遍，连续的一串需要编码的字节一次替换掉，不需要编码的时候直接返回原字符串
+    url_unsafe_patterns = {}                    # safe_char -> 匹配需要编码的字节的正则
 
-    # 本地存储cookies
-    cookies = []
+    @classmethod
+    def url_encode(cls, arg_str, safe_char="", encoding="utf-8"):
+        data = arg_str.encode(encoding)
+        pattern = cls.url_unsafe_patterns.get(safe_char) or cls._unsafe_pattern(safe_char)
+        if pattern.search(data) is None:
+            return arg_str
+        return pattern.sub(cls._quote, data).decode("ascii")
 
     @classmethod
-    def append_cookies(cls, host, port, content):
-        Util.cookies.append(Cookie(host, port, content))
+    def url_encode_params(cls, params, encoding="utf-8"):
+        """
+        把字典编码成 a=1&b=2 这样的查询字符串，键和值都做URL编码
+        """
+        pattern = cls.url_unsafe_patterns.get("") or cls._unsafe_pattern("")
+        search, sub, quote = pattern.search, pattern.sub, cls._quote
+        parts = []
+        for k, v in params.items():
+            for x in (k, v):
+                x = str(x)
+                data = x.encode(encoding)
+                parts.append(x if search(data) is None else sub(quote, data).decode("ascii"))
+        return "&".join([parts[i] + "=" + parts[i + 1] for i in range(0, parts.__len__(), 2)])
 
     @classmethod
-    def get_cookies(cls, host, port):
+    def _unsafe_pattern(cls, safe_char):
+        pattern = re.compile(b"[^A-Za-z0-9\\-._~" + re.escape(safe_char.encode()) + b"]+")
+        cls.url_unsafe_patterns[safe_char] = pattern
+        return pattern
 
-        for i in Util.cookies:
-            if i.host == host and i.port == port:
-                return i
-        else:
-            return None     # 如果找不到返回一个None
+    @staticmethod
+    def _quote(match):
+        # bytes.hex 可以在每个字节之间插入分隔符，整串字节一次转换完
+        return ("%" + match.group().hex("%")).upper().encode()
+
+    # DNS缓存，按TTL过期、有大小上限，详见 DNSCache
+    dns_cache = DNSCache()
+
+    @classmethod
+    def get_dns(cls, host_string):
+        return Util.dns_cache.get(host_string)
 
 
 class RequestLine:
@@ -106,7 +567,7 @@ class StatusLine:
         pass
 
 
-class Headers(UserDict):
+class Headers(MutableMapping):
     """
     message-header = field-name ":" [ field-value ]
     field-name     = token
@@ -115,35 +576,177 @@ class Headers(UserDict):
                      and consisting of either *TEXT or combinations
                      of token, separators, and quoted-string>
 
-    继承字典类，对其进行功能增强, 这个类是整份代码里面用得最多、用得最方便的一个类
+    用起来和字典一样，这个类是整份代码里面用得最多、用得最方便的一个类
+    - 名字不区分大小写，发送的时候保留原来的写法，顺序按每个名字第一次出现的顺序
+    - 同名首部可以有多个值（比如 Set-Cookie），h[name] 返回用逗号拼起来的值（RFC7230 Section 3.2.2），get_all 返回全部的值
+    - 解析进来的值先存成 bytes，用到的时候才解码
+    - bytes() 的结果会缓存起来，首部没改过的话重发请求不用再拼一遍
     """
     def __init__(self, data=None, **kwargs):
-        UserDict.__init__(self)
-        data = {} if data is None else data
-        self.update(data)
-        self.update(kwargs)
+        self.fields = {}                        # 小写名字 -> [名字, 值, 值...]，值有可能是还没解码的 bytes
+        self.cache = None                       # bytes() 的结果，首部有改动的时候清掉
+        if data is not None:
+            self.update(data)
+        if kwargs:
+            self.update(kwargs)
+
+    def __getitem__(self, name):
+        entry = self.fields[name.lower()]
+        if entry.__len__() == 2:
+            value = entry[1]
+            if isinstance(value, bytes):
+                value = entry[1] = self._decode(value)
+            return value
+        return ", ".join(str(x) for x in self._values(entry))
+
+    def __setitem__(self, name, value):
+        self.fields[name.lower()] = [name, value]
+        self.cache = None
+
+    def __delitem__(self, name):
+        del self.fields[name.lower()]
+        self.cache = None
+
+    def __contains__(self, name):
+        return isinstance(name, str) and name.lower() in self.fields
+
+    def __iter__(self):
+        return (entry[0] for entry in list(self.fields.values()))
+
+    def __len__(self):
+        return self.fields.__len__()
+
+    def __repr__(self):
+        return "Headers(%r)" % list(self.multi_items())
 
     def __add__(self, other):
         """
-        重载加号运算符，实现字典相加。注意如果有相同字段，后者覆盖前者
+        重载加号运算符，返回合并之后的新首部，原来的两个都不变。注意如果有相同字段，后者覆盖前者
+        """
+        rtn = self.copy()
+        rtn.update(other)
+        return rtn
+
+    def __iadd__(self, other):
+        """
+        self.headers += {...} 直接在原来的首部上合并，不拷贝
+        """
+        self.update(other)
+        return self
+
+    def copy(self):
+        rtn = Headers()
+        rtn.fields = {k: list(v) for k, v in self.fields.items()}
+        rtn.cache = self.cache
+        return rtn
+
+    def update(self, other=(), **kwargs):
+        """
+        合并其他首部，另一个也是 Headers 的话多个值会原样保留
+        """
+        if isinstance(other, Headers):
+            for k, entry in other.fields.items():
+                self.fields[k] = list(entry)
+        elif hasattr(other, "keys"):
+            for k in other.keys():
+                self.fields[k.lower()] = [k, other[k]]
+        else:
+            for k, v in other:
+                self.fields[k.lower()] = [k, v]
+        for k, v in kwargs.items():
+            self.fields[k.lower()] = [k, v]
+        self.cache = None
+
+    def clear(self):
+        self.fields = {}
+        self.cache = None
+
+    def add(self, name, value):
+        """
+        追加一个值，已经有同名首部的时候不覆盖
+        """
+        entry = self.fields.get(name.lower())
+        if entry is None:
+            self.fields[name.lower()] = [name, value]
+        else:
+            entry.append(value)
+        self.cache = None
+
+    def get_all(self, name):
+        """
+        返回某个首部所有的值，名字不区分大小写，没有的话返回空列表
+        """
+        entry = self.fields.get(name.lower())
+        return [] if entry is None else self._values(entry)
+
+    def multi_items(self):
+        """
+        逐个返回 (名字, 值)，同名首部有几个值就返回几次
         """
-        rtn_dict = copy.deepcopy(Headers(self.data))
-        rtn_dict.update(other)
-        return rtn_dict
+        for entry in list(self.fields.values()):
+            for value in self._values(entry):
+                yield entry[0], value
 
     def build(self, data):
 
         # 如果传进来的是个字典，那么就直接加进去，如果是普通字符串，就解析做成字典
         if isinstance(data, str):
-            pass
+            self.parse(data.encode())
         if isinstance(data, dict):
             self.update(data)
 
     def parse(self, bytes_data):
-        self.update(dict([x.split(": ") for x in bytes_data.decode().split("\r\n")]))
+        """
+        一次扫描完成解析，值先不解码
+        冒号后面有没有空格都可以，以空白开头的行是上一行的续行（obs-fold），RFC7230 Section 3.2.4
+        """
+        data = bytes(bytes_data)
+        fields = self.fields
+        empty = not fields
+        entry = None
+        folded = False
+        for line in data.split(b"\r\n"):
+            if line[:1] in (b" ", b"\t") and entry is not None:
+                entry[-1] = entry[-1] + b" " + line.strip()
+                folded = True
+                continue
+            name, sep, value = line.partition(b":")
+            if not sep:
+                continue
+            name = name.strip().decode("latin-1")
+            key = name.lower()
+            entry = fields.get(key)
+            if entry is None:
+                entry = fields[key] = [name, value.strip()]
+            else:
+                entry.append(value.strip())
+        # 原样解析进来的首部，序列化的结果就是原来的字节流
+        self.cache = data + b"\r\n" if empty and not folded and data else None
 
     def bytes(self):
-        return "".join([k + ': ' + str(v) + '\r\n' for k, v in self.items()]).encode()
+        if self.cache is None:
+            lines = []
+            for entry in self.fields.values():
+                name = entry[0].encode()
+                for value in entry[1:]:
+                    if not isinstance(value, bytes):
+                        value = str(value).encode()
+                    lines.append(b"%s: %s\r\n" % (name, value))
+            self.cache = b"".join(lines)
+        return self.cache
+
+    def _values(self, entry):
+        for i in range(1, entry.__len__()):
+            if isinstance(entry[i], bytes):
+                entry[i] = self._decode(entry[i])
+        return entry[1:]
+
+    @staticmethod
+    def _decode(value):
+        try:
+            return value.decode()
+        except UnicodeDecodeError:
+            return value.decode("latin-1")
 
 
 class Body:
@@ -155,33 +758,95 @@ class Body:
     def __init__(self):
         self.charset = "utf-8"
         self.content = b""
+        self.stream = None                      # 流式主体（文件对象或者可迭代对象），发送的时候才读取
+        self.length = None                      # 流式主体的长度，不知道长度的时候为None，按 chunked 发送
+        self.stream_start = None                # 文件对象开始发送时的位置，重发的时候要回到这里
 
         # 这里把一部分实体首部给放进来比较合适，方便编程，发送报文的时候会将这里的内容更新到request对象的Headers里面
         # 消息长度，计算方法依据 RFC2616 Section 4.4，
-        self.part_header = Headers() + {"Content-Length": 0}
+        self.part_header = Headers({"Content-Length": 0})
 
     def build(self, string_or_bytes_data, charset="utf-8", **kwargs):
         """
         这里既可以接收字符串，也可以接收字节流
-
+        上传大文件的时候还可以接收：
+        - 支持缓冲区协议的对象（memoryview、array、mmap等），直接引用，不拷贝
+        - 文件对象，发送的时候才去读，能算出剩余长度的带上 Content-Length，否则按 chunked 发送
+        - 产生 bytes 的可迭代对象（比如生成器），按 chunked 发送
         """
         data = string_or_bytes_data
+        self.stream = None
+        self.length = None
+        self.stream_start = None
 
-        # 如果是字节类型就直接存储
-        if isinstance(data, bytes):
+        # 如果是字节类型就直接存储，接收响应时交过来的是 bytearray，同样直接存储，不再拷贝一份
+        if isinstance(data, (bytes, bytearray)):
             self.content = data
 
         # 如果是字符串就编码成字节数组再存储
-        if isinstance(data, str):
+        elif isinstance(data, str):
             self.charset = charset
             self.content = data.encode(self.charset)
 
-        # 存储之后记录下长度
-        self.part_header["Content-Length"] = self.content.__len__()
+        elif isinstance(data, memoryview) or self._is_buffer(data):
+            self.content = memoryview(data).cast("B")
+
+        # 文件对象和可迭代对象不读进内存，等到发送的时候再一块一块地读
+        elif hasattr(data, "read"):
+            self.content = b""
+            self.stream = data
+            self.length = self._remaining_length(data)
+
+        else:
+            self.content = b""
+            self.stream = iter(data)
+
+        # 存储之后记录下长度，长度未知的流式主体使用 chunked 传输
+        if self.stream is None:
+            self.part_header["Content-Length"] = self.content.__len__()
+        elif self.length is not None:
+            self.part_header["Content-Length"] = self.length
+        else:
+            self.part_header.pop("Content-Length", None)
+            self.part_header[fs.Transfer_Encoding] = "chunked"
 
         if "content_type" in kwargs:
             self.part_header["Content-Type"] = kwargs["content_type"]
 
+    @staticmethod
+    def _is_buffer(data):
+        try:
+            memoryview(data)
+        except TypeError:
+            return False
+        return True
+
+    def _remaining_length(self, f):
+        """
+        计算文件对象从当前位置到末尾还有多少字节，不能 seek 的文件返回None
+        """
+        try:
+            if not f.seekable():
+                return None
+            self.stream_start = f.tell()
+            end = f.seek(0, 2)
+            f.seek(self.stream_start)
+        except (AttributeError, OSError, ValueError):
+            return None
+        return end - self.stream_start
+
+    def rewind(self):
+        """
+        把流式主体恢复到开始发送之前的位置，复用的连接发送失败需要重发的时候调用
+        生成器之类的主体读过就没了，返回False
+        """
+        if self.stream is None:
+            return True
+        if self.stream_start is None:
+            return False
+        self.stream.seek(self.stream_start)
+        return True
+
     def parse(self, bytes_data, charset="utf-8"):
         """
         因为类型的特殊性，这里parse和build实际上已经是同一个函数了，保留这个为了语义方便理解
@@ -189,10 +854,12 @@ class Body:
         self.build(bytes_data, charset)
 
     def bytes(self):
+        if isinstance(self.content, memoryview):
+            return self.content.tobytes()
         return self.content
 
     def text(self):
-        return self.content.decode(self.charset)
+        return self.bytes().decode(self.charset)
 
 
 class Response:
@@ -211,6 +878,98 @@ class Response:
         self.status_line = StatusLine()
         self.headers = Headers()
         self.body = Body()
+        self.trailers = Headers()               # chunked 报文末尾的 trailer 首部
+
+        self.tls = None                         # https 响应所在连接的TLS信息，见 Connection.tls
+
+        # stream=True 的时候主体不会一次性读进内存，而是留在这里按需读取，读完之后连接自动还回连接池
+        self.raw = None
+        self.offset = 0                         # 非流式的响应，记录 readinto 已经读到 body.content 的哪个位置
+
+        self.complete = None                    # 主体是否按约定的长度完整收到，流式响应读完之前是None
+        self.from_cache = False                 # 是不是 HTTPCache 里面的缓存
+        self.timings = None                     # 各阶段耗时和收发字节数，见 Timings
+        self.history = []                       # 跳转过程中经过的响应，按顺序排列
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def readinto(self, buf):
+        """
+        把主体读进buf，返回读到的字节数，返回0表示读完了
+        """
+        if self.raw is not None:
+            return self.raw.readinto(buf)
+        view = memoryview(buf).cast("B")
+        data = memoryview(self.body.content)[self.offset: self.offset + view.__len__()]
+        view[:data.__len__()] = data
+        self.offset += data.__len__()
+        return data.__len__()
+
+    def iter_content(self, chunk_size=65536):
+        """
+        分块迭代主体，每次返回不超过chunk_size字节，流式响应直接从套接字读取，内存占用只有一个块的大小
+        """
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while True:
+            n = self.readinto(view)
+            if not n:
+                break
+            yield bytes(view[:n])
+
+    def iter_lines(self, chunk_size=65536, delimiter=b"\n"):
+        """
+        按行迭代主体，返回的行不带分隔符（换行符前面的\r也一并去掉）
+        """
+        pending = bytearray()
+        for chunk in self.iter_content(chunk_size):
+            pending += chunk
+            start = 0
+            while True:
+                end = pending.find(delimiter, start)
+                if end < 0:
+                    break
+                line = bytes(pending[start: end])
+                yield line[:-1] if delimiter == b"\n" and line.endswith(b"\r") else line
+                start = end + delimiter.__len__()
+            del pending[:start]
+        if pending:
+            yield bytes(pending)
+
+    def save_to(self, path, chunk_size=1 << 20):
+        """
+        把主体写进文件，整个过程只用一个chunk_size大小的缓冲区，返回写入的字节数
+        """
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        total = 0
+        with open(path, "wb") as f:
+            while True:
+                n = self.readinto(view)
+                if not n:
+                    break
+                f.write(view[:n])
+                total += n
+        return total
+
+    def read(self):
+        """
+        流式响应把剩下的主体全部读进 body，返回主体的字节流
+        """
+        if self.raw is not None and not self.raw.exhausted:
+            self.body.parse(self.raw.read())
+        return self.body.bytes()
+
+    def close(self):
+        """
+        流式响应的主体没读完就关闭的话，连接不能再复用，直接关掉
+        """
+        if self.raw is not None:
+            self.raw.close()
 
 
 class Request:
@@ -226,6 +985,10 @@ class Request:
                 [ message-body ]          ; Section 4.3
     """
 
+    uri_pattern = re.compile(r"((\w+)://)?([^/:]+)(:\d*)?([^# ]*)")
+    ip_pattern = re.compile(r"[.\d]+")
+    uri_safe = ";/?:@&=+$,%!*'()[]"             # 请求URI里面这些字符保持原样，已经编码过的 %XX 也不会再编码一次
+
     def __init__(self):
 
         self.request_line = RequestLine()               # 请求行
@@ -241,16 +1004,18 @@ class Request:
             'ip': '',
             "protocol": "http"
         }
+        self.dns_time = None                     # parse_uri 里面域名解析的耗时，没有解析的时候是None
+        self.priority = None                     # 在 Scheduler 里排队的优先级，见 Scheduler.priorities
 
-    def parse_uri(self, uri):
+    def parse_uri(self, uri, resolve=True):
         """
         这个函数是将URI解析为请求行的URI，顺便还将主机名和端口分析出来
         将ip，端口等信息存起来
+        resolve为False的时候不做DNS解析，由调用者自己填写ip（AsyncSession 用异步DNS解析）
         业界有不成文规定，（大多数）浏览器通常都会限制url长度在2K个字节，而（大多数）服务器最多处理64K大小的url。
 
         """
-        uri_pattern = "((\w+):\/\/)?([^/:]+)(:\d*)?([^# ]*)"
-        uri_match = re.match(uri_pattern, uri)
+        uri_match = self.uri_pattern.match(uri)
 
         if uri_match is None:
             raise Exception("URI不合法!")
@@ -265,29 +1030,32 @@ class Request:
             self.conn_info["protocol"] = "http"
 
         # 默认端口80/443
-        if self.conn_info["port"] is None:
+        if self.conn_info["port"] is None or self.conn_info["port"] == ":":
             self.conn_info["port"] = 443 if self.conn_info["protocol"] == "https" else 80
         else:
-            self.conn_info["port"] = self.conn_info["port"][1:]
+            self.conn_info["port"] = int(self.conn_info["port"][1:])     # 端口统一存成整数，连接池的键才能对得上
 
         # 请求URL后面补全斜杠，并处理URL编码
         if self.conn_info["request_uri"] == "":
             self.conn_info["request_uri"] = "/"
-        self.conn_info["request_uri"] = Util.url_encode(self.conn_info["request_uri"], ";/?:@&=+$,", "utf-8")
+        self.conn_info["request_uri"] = Util.url_encode(self.conn_info["request_uri"], self.uri_safe, "utf-8")
 
         # 使用DNS解析域名得到ip，注意处理纯ip网址问题，不要用DNS解析纯ip的网址
-        if re.match("[.\d]+", self.conn_info["host"]) is None:
-            self.conn_info["ip"] = Util.get_dns(self.conn_info["host"])
+        if self.ip_pattern.fullmatch(self.conn_info["host"]) is None:
+            self.conn_info["ip"] = ""
+            if resolve:
+                start = time.perf_counter()
+                self.conn_info["ip"] = Util.get_dns(self.conn_info["host"])
+                self.dns_time = time.perf_counter() - start
         else:
             self.conn_info["ip"] = self.conn_info["host"]
 
-        print(self.conn_info)
-
     def build(self, method, uri, **kwargs):
         """
         此处根据输入的参数构建请求包
         """
-        self.parse_uri(uri)
+        self.parse_uri(uri, kwargs.get("resolve", True))
+        self.priority = kwargs.get("priority")
         # print(self.conn_info)
         self.headers += {"Host": self.conn_info["host"]}       # 往请求头中加入主机名
 
@@ -299,12 +1067,11 @@ class Request:
         u = self.conn_info["request_uri"]
         if "params" in kwargs:
             u += "?" if "?" not in u else "&"
-            u += "&".join(["%s=%s" % (k, v) for k, v in kwargs["params"].items()])
+            u += Util.url_encode_params(kwargs["params"])
 
         # post请求的参数
         if "data" in kwargs:
-            temp = "&".join(["%s=%s" % (k, v) for k, v in kwargs["data"].items()])
-            self.body.build(temp)
+            self.body.build(Util.url_encode_params(kwargs["data"]))
             self.headers += self.body.part_header   # 带上首部，指定实体的长度是多少，否则服务端将不能正确识别
 
         # content这个字段，不只是put请求会用到，post请求也可以通过设置这个东西来传输原始数据
@@ -316,188 +1083,3667 @@ class Request:
         # 构建请求行
         self.request_line.build(method.upper(), u)
 
-        # 检查本地是否有cookies， 如果有就带上
-        cccc = Util.get_cookies(self.conn_info["host"], self.conn_info["port"])
-        # print(cccc)
-        # print(ck.cookies.__str__())
-        if cccc is not None:
-            self.headers += {"Cookies": cccc.content}
+    def head_bytes(self):
+        """
+        起始行 + 报文首部 + 空行，发送的时候和主体分开，主体不需要拼接进来
+        """
+        return b"".join((self.request_line.bytes(), self.headers.bytes(), b"\r\n"))
 
     def bytes(self):
 
-        # 在这种场景下，不考虑多种MIME类型的问题同时传输和数据分块的问题。在这之后可以再针对这个东西进行优化
-        rtn_bytes = b''
-        rtn_bytes += self.request_line.bytes()                   # 加入起始行
-        rtn_bytes += self.headers.bytes()                        # 拼接报文首部
-        rtn_bytes += b'\r\n'                                         # 添加空行
-        rtn_bytes += self.body.bytes()                           # 添加主体
-        return rtn_bytes
-
+        # 流式主体没法转成一整段字节流，只能交给 Connection.send_request 边读边发
+        if self.body.stream is not None:
+            raise Exception("流式主体不能转换成字节流!")
+        return b"".join((self.head_bytes(), self.body.content))
 
 
+class PreparedRequest:
+    """
+    同一个接口反复发送的时候用，URL解析、DNS解析和首部序列化只在 Session.prepare 的时候做一次：
 
-class Session:
+        p = s.prepare("GET", "http://api.example.com/items", headers={"Authorization": "..."})
+        for i in range(1000000):
+            resp = p.send(params={"page": i})
 
+    每次发送只是复制一份首部（连同序列化好的缓存），拼上新的查询字符串，需要的话再换上新的主体
+    prepare 时传入的 params/data/content 每次都会带上，send 时传入的 params 追加在后面，data/content 替换掉原来的主体
     """
-    Session对象是持续不变的，而Request对象是每一次发包都重新创建的
-    每一次都需要重新创建Request对象，是因为残留的变量实在太多了，一不小心可能会将上一次请求报文的内容又给继续带上去
-    并且为了更贴切地表示每一次发送的请求报文都是不同的个体，每条请求报文各占用一个对象，这是比较合适的
-    """
-    def __init__(self):
-        self.socket = None                              # 将套接字储存，用于持久连接和非持久连接
-        self.cookies = None                       # 将cookies保存，记录客户端状态
-        # self.request = Request()                      # 真正用来首发请求报文的是这个，这玩意每次都需要创建新的，用完即丢
 
-        self.last_request = None                      # 将上一个请求包保存下来，这样，在持久连接的问题就很好处理
-        self.last_response = None
+    def __init__(self, session, method, uri, **kwargs):
+        self.session = session
+        self.stream = kwargs.get("stream", False)
+        self.timeout = kwargs.get("timeout")
 
-    def recv_head(self, response, buffer, **kwargs):
-        print("接受响应头......")
+        template = Request()
+        template.build(method, uri, **kwargs)
+        if session.decompress and fs.Accept_Encoding not in template.headers:
+            template.headers[fs.Accept_Encoding] = ContentDecoder.accept_encoding
+        template.headers.bytes()                # 先序列化一次，之后复制出来的首部都带着这份缓存
+        self.template = template
+        self.sep = "&" if "?" in template.request_line.request_uri else "?"
 
-        while True:
+    def request(self, params=None, data=None, content=None, headers=None):
+        """
+        按模板生成一个新的 Request
+        """
+        template = self.template
+        request = Request()
+        request.conn_info = dict(template.conn_info)
+        request.headers = template.headers.copy()
+        request.priority = template.priority
 
-            d = self.socket.recv(1024)
-            if d:
-                buffer += d
-                print(buffer)
-                if b'\r\n\r\n' in buffer:
-                    response.status_line.parse(buffer[: buffer.find(b"\r\n")])    # 解析状态行
-                    response.headers.parse(buffer[buffer.find(b"\r\n")+2: buffer.find(b"\r\n\r\n")])  # 解析响应头
-                    break
-            else:
-                break       # 如果服务端已经断开连接，那就没必要再继续接收了
+        u = template.request_line.request_uri
+        if params:
+            u += self.sep + Util.url_encode_params(params)
+        request.request_line.build(template.request_line.method, u)
+
+        if data is not None or content is not None:
+            request.body.build(Util.url_encode_params(data) if data is not None else content)
+            request.headers.pop(fs.Content_Length, None)
+            request.headers.pop(fs.Transfer_Encoding, None)
+            request.headers += request.body.part_header
+        elif template.body.stream is not None:
+            raise Exception("流式主体只能发送一次，每次发送请传入新的 content!")
+        else:
+            request.body = template.body        # 内存里的主体不会被修改，直接共用
 
-        # 把报文首部截去
-        buffer = buffer[buffer.find(b"\r\n\r\n") + 4:]
-        return buffer
+        if headers:
+            request.headers += headers
+        return request
 
-    def recv_body(self, response, buffer):
-        print("接收响应主体......")
-        while True:
-            if buffer.__len__() >= int(response.headers["Content-Length"]):
-                response.body.parse(buffer)
-                break
-            d = self.socket.recv(1024)
-            if d:
-                buffer += d
-            else:
-                break
-        return buffer
+    def send(self, params=None, data=None, content=None, headers=None, stream=None, timeout=None):
+        request = self.request(params, data, content, headers)
+        return self.session.proc(request, stream=self.stream if stream is None else stream,
+                                 timeout=timeout or self.timeout)
 
-    def send(self, request):
 
-        ip, port, bytes_data = request.conn_info["ip"], request.conn_info["port"], request.bytes()
+class Pipeline:
+    """
+    HTTP/1.1 管线化：同一个主机的一批请求在一个连接上连着发出去，不用等上一个响应回来，响应按发送的顺序依次解析
 
-        print("准备发送请求报文......")
-        print("发往的ip是......", ip)
-        print("发送的字节流是\t", bytes_data)
+        with s.pipeline("http://api.example.com") as p:
+            for i in range(100):
+                p.get("/items/%d" % i)
+        for resp in p.responses:
+            ...
 
-        flag = False
+    - 只能放幂等方法的请求（RFC7230 Section 6.3.2），服务端中途关闭连接的时候，没有收到响应的请求会换一个新连接重发
+    - 主体只能是内存里的数据，文件和生成器没法重发
+    - 同时在途的请求最多 depth 个，每收到一个响应再补发一个，免得双方的发送缓冲区都写满互相等待；
+      服务端通过 Keep-Alive: max=N 告知剩余次数的时候，不会发出超过这个次数的请求
+    - 返回的是原始的响应：不查缓存，不处理跳转，Set-Cookie 照常存进 Session 的cookie罐
+    """
 
-        # 根据条件, 判断是否复用套接字
-        if self.last_response is None:
-            flag = True
-        elif "close".upper() in self.last_response.headers["Connection"].upper():
-            flag = True
-        elif ip != self.last_request.conn_info["ip"] or port != self.last_request.conn_info["port"]:
-            flag = True
+    idempotent_methods = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE")
 
-        if flag:
-            # 直接创建新的套接字，旧的那个不关闭了，有时间再回来补全关闭套接字的代码，目前这个不影响程序
+    def __init__(self, session, origin, depth=16, timeout=None):
+        self.session = session
+        self.origin = origin.rstrip("/") if "://" in origin else "http://" + origin.rstrip("/")
+        self.depth = depth
+        self.timeout = Timeout.of(timeout) or session.timeout
+        self.key = None
+        self.requests = []
+        self.responses = []
 
-            # 如果是https
-            if request.conn_info["protocol"] == "https":
+    def __enter__(self):
+        return self
 
-                context = ssl.create_default_context()
-                self.socket = context.wrap_socket(socket.socket(socket.AF_INET),
-                                                  server_hostname=request.conn_info["host"])
-                self.socket.connect((ip, port))
-            # 如果是http
-            else:
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.socket.connect((ip, port))
+    def __exit__(self, exc_type, *args):
+        if exc_type is None and self.requests:
+            self.send()
 
-        self.socket.send(bytes_data)
+    def __len__(self):
+        return self.requests.__len__()
 
-    def proc(self, request):
+    def request(self, method, uri, **kwargs):
         """
-        应该在这里调用send和recv函数，发送和接收就只管发送接收，处理业务逻辑应该就在这里完成
-        包括重定向跳转和储存cookies的过程应该最好也就在这里处理
-        :return:
+        把一个请求加入队列，uri 可以是以 / 开头的路径，也可以是同一个主机的完整URL，返回它在 responses 里面的下标
         """
-        # print("proc......")
-        self.send(request)
+        method = method.upper()
+        if method not in self.idempotent_methods:
+            raise Exception("管线化只支持幂等方法，不支持 %s!" % method)
+        request = Request()
+        request.build(method, self.origin + uri if uri.startswith("/") else uri, **kwargs)
+        if request.body.stream is not None:
+            raise Exception("管线化的请求主体只能是内存里的数据!")
 
-        # 创建Response对象用来存储返回的这些数据
-        response = Response()
-        buffer = b""
+        key = (request.conn_info["protocol"], request.conn_info["host"], request.conn_info["port"])
+        if self.key is None:
+            self.key = key
+        elif key != self.key:
+            raise Exception("管线化的请求必须发往同一个主机: %s" % uri)
 
-        # 接收响应报文头
-        buffer = self.recv_head(response, buffer)
+        session = self.session
+        if session.decompress and fs.Accept_Encoding not in request.headers:
+            request.headers[fs.Accept_Encoding] = ContentDecoder.accept_encoding
+        session.add_cookies(request)
+        self.requests.append(request)
+        return self.requests.__len__() - 1
 
-        if "Content-Length" in response.headers.keys() and request.request_line.method != "HEAD":
-            # 在这里继续接收主体（如果有主体的话）
-            self.recv_body(response, buffer)
+    def get(self, uri, **kwargs):
+        return self.request("GET", uri, **kwargs)
 
-        # print("proc done......")
-        # print(response.status_line.__dict__)
-        # print(response.headers)
-        # print(response.body.bytes())
+    def head(self, uri, **kwargs):
+        return self.request("HEAD", uri, **kwargs)
 
-        self.last_response = response
-        self.last_request = request
+    def options(self, uri, **kwargs):
+        return self.request("OPTIONS", uri, **kwargs)
 
-        # 检测set-cookies
-        if response.headers.__contains__("Set-Cookie"):
-            pass
-            # print(response.headers["Set-Cookie"])
-            ck.append(request.conn_info["host"], request.conn_info["port"], response.headers["Set-Cookie"])
-        # 检测跳转，如果有跳转，强行转化为GET方法。（这里后期要进行规则细分，不同的3xx状态码处理方式不同）
-        if re.match("3..", response.status_line.status_code) is not None:
-            if response.headers["Location"][0] != "/":
-                response.headers["Location"] = "/" + response.headers["Location"]
-            return self.get("http://" + request.headers["Host"] + response.headers["Location"])
+    def send(self):
+        """
+        发送队列里的全部请求，返回按顺序排列的响应列表
+        """
+        requests, self.requests = self.requests, []
+        responses = [None] * requests.__len__()
+        session, done, reuse = self.session, 0, True
+        while done < requests.__len__():
+            conn = self._connect(requests[done], reuse)
+            answered = done
+            try:
+                done = self._run(conn, requests, responses, done)
+            except BaseException:
+                session.pool.discard(conn)
+                raise
+            if done == answered and conn.fresh:
+                session.pool.discard(conn)
+                raise Exception("新建的连接没有返回任何响应就断开了!")
 
-        return response
+            if done < requests.__len__() or not conn.reusable or conn.pending():
+                session.pool.discard(conn)
+                if done < requests.__len__():
+                    logger.debug("管线化的连接被关闭，剩下的 %d 个请求换新连接重发", requests.__len__() - done)
+                    session.metrics.incr("retries", self.key[1], requests.__len__() - done)
+                reuse = False
+            else:
+                session.pool.release(conn)
 
-    def get(self, uri, **kwargs):
-        request = Request()
-        request.build("GET", uri, **kwargs)
-        return self.proc(request)
+        self.responses = responses
+        return responses
 
-    def post(self, uri, **kwargs):
-        request = Request()
-        request.build("POST", uri, **kwargs)
-        return self.proc(request)
+    def _connect(self, request, reuse):
+        session = self.session
+        conn = session.pool.get(self.key, reuse=reuse)
+        if conn is not None:
+            conn.fresh = False
+        else:
+            try:
+                conn = session.new_connection(request, self.timeout)
+            except BaseException:
+                session.pool.cancel(self.key)
+                raise
+            conn.fresh = True
+        conn.set_timeout(self.timeout)
+        return conn
 
-    def put(self, uri, **kwargs):
-        request = Request()
-        request.build("PUT", uri, **kwargs)
-        return self.proc(request)
+    def _run(self, conn, requests, responses, start):
+        """
+        从 start 开始在 conn 上发送并接收，返回第一个没有收到响应的请求的下标
+        开启了 Scheduler 的时候每个请求发出去之前都要排队，收到响应的时候还回名额：
+        手里没有在途请求的时候等着排队，有的话只发现在能发的，发不了就先去收响应，免得自己占着名额等自己
+        """
+        session, sent, i = self.session, start, start
+        scheduler, host = session.scheduler, self.key[1]
+        held, broken = {}, False                # 已经发出去（或者拿到了名额）还没收到响应的请求 -> Timings
+        batch_start = time.perf_counter()
+        try:
+            while i < requests.__len__():
+                end = min(requests.__len__(), i + self.depth)
+                if conn.keep_alive_max is not None:
+                    end = min(end, i + max(conn.keep_alive_max, 1))
+                if sent < end and not broken:
+                    buffers = []
+                    for j in range(sent, end):
+                        timings = Timings()
+                        if scheduler is not None and \
+                                scheduler.acquire(host, requests[j].priority, timings, block=j == i) is None:
+                            end = j
+                            break
+                        held[j] = timings
+                        head, content = requests[j].head_bytes(), requests[j].body.content
+                        buffers += (head, content)
+                        timings.start = batch_start
+                        timings.reused = not conn.fresh or j > start
+                        timings.bytes_out = head.__len__() + content.__len__()
+                    try:
+                        if buffers:
+                            conn.sendmsg(buffers)
+                        sent = end
+                    except socket.timeout:
+                        raise
+                    except OSError:
+                        # 写不进去了，已经发出去的请求的响应可能还在接收缓冲区里，先把它们收完
+                        broken = True
+                        conn.reusable = False
+                    now = time.perf_counter()
+                    for j in range(i, sent):
+                        if held[j].sent_at is None:
+                            held[j].sent_at = now
+                if i >= sent:
+                    return i
 
-    def delete(self, uri, **kwargs):
-        request = Request()
-        request.build("DELETE", uri, **kwargs)
-        return self.proc(request)
+                request, timings = requests[i], held[i]
+                timings.conn_bytes_in = conn.bytes_in
+                response = Response()
+                response.tls = conn.tls
+                parser = ResponseParser(response, request.request_line.method)
+                try:
+                    ok = session.recv_head(conn, parser, timings)
+                except socket.timeout:
+                    raise
+                except OSError:
+                    ok = False
+                if not ok:
+                    conn.reusable = False
+                    return i
 
-    def options(self, uri, **kwargs):
-        request = Request()
-        request.build("OPTIONS", uri, **kwargs)
-        return self.proc(request)
+                timings.head_at = time.perf_counter()
+                if timings.first_byte_at is not None:
+                    timings.ttfb = timings.first_byte_at - timings.sent_at
+                response.timings = timings
+                decoder = None
+                if session.decompress and not parser.done:
+                    decoder = ContentDecoder.create(parser.header(fs.Content_Encoding), session.max_decompressed_size)
+                complete = parser.done or session.recv_body(conn, response, parser, decoder)
 
-    def head(self, uri, **kwargs):
-        request = Request()
-        request.build("HEAD", uri, **kwargs)
-        return self.proc(request)
+                response.complete = complete
+                if not complete or parser.framing == "eof":
+                    conn.reusable = False
+                conn.update(response)
 
-    def connect(self):
-        pass
+                now = time.perf_counter()
+                timings.transfer = now - timings.head_at
+                timings.total = now - batch_start
+                timings.bytes_in = conn.bytes_in - timings.conn_bytes_in
+                del held[i]
+                if scheduler is not None:
+                    scheduler.release(host, timings, response)
+                session.metrics.record(host, response.status_line.status_code, timings.total, timings.bytes_in,
+                                       timings.bytes_out, timings.reused)
+                session.cookies.extract(request, response)
+                session.emit("on_complete", request, response, timings)
+                responses[i] = response
+                i += 1
+                if not conn.reusable:
+                    break
+            return i
+        finally:
+            # 没收到响应的请求会换连接重发，重发的时候重新排队
+            if scheduler is not None:
+                for timings in held.values():
+                    scheduler.release(host, timings)
 
-    def trace(self):
-        pass
 
+class Download:
+    """
+    分段并发下载，由 Session.download 调用：
+
+        s.download("http://example.com/big.iso", "big.iso", segments=8)
+
+    - 先发 HEAD，服务端支持 Accept-Ranges: bytes 并且给出了长度的时候，按字节范围切成 segments 段，用连接池里的多个连接同时下载
+    - 数据写进预先分配好大小的 path + ".part"，每一段用 os.pwrite 直接写到自己的位置，全部完成之后再改名成 path
+    - 进度保存在 path + ".part.json"，中断之后再次调用从断点继续；续传的请求带上 If-Range（ETag，没有的话用 Last-Modified），
+      服务端的文件已经变了的话会返回整个文件（200），这时丢掉已下载的部分从头开始
+    - 某一段的连接断了，从这一段已经下载到的位置重试，最多 retries 次
+    - 服务端不支持范围请求、或者不知道长度的时候，退化成单个连接下载，不能续传
+    """
+
+    min_segment = 1 << 20                       # 每段至少这么大，小文件不切太多段
+    buffer_size = 1 << 20
+    save_interval = 1.0                         # 最多每隔这么多秒保存一次进度
+
+    def __init__(self, session, uri, path, segments=4, retries=2, timeout=None, headers=None):
+        self.session = session
+        self.uri = uri
+        self.path = path
+        self.part_path = path + ".part"
+        self.state_path = path + ".part.json"
+        self.segments = segments
+        self.retries = retries
+        self.timeout = timeout
+        # 按字节范围下载，不能让服务端压缩
+        self.headers = Headers({fs.Accept_Encoding: "identity"})
+        if headers:
+            self.headers += headers
+
+        self.state = None
+        self.fd = None
+        self.lock = threading.Lock()
+        self.saved_at = 0
+        self.changed = False                    # 下载过程中发现服务端的文件变了
+
+    def run(self):
+        """
+        返回文件的大小
+        """
+        self.state = self._load_state()
+        if self.state is None:
+            self.state = self._probe()
+        if self.state is None:
+            return self._single()
+
+        size = self._segmented()
+        if self.changed:
+            # 文件变了，从头再来一次，这次不用旧的进度
+            logger.debug("%s 在服务端已经改变，重新下载", self.uri)
+            self._remove(self.state_path)
+            self.state, self.changed = self._probe(), False
+            if self.state is None:
+                return self._single()
+            size = self._segmented()
+            if self.changed:
+                raise Exception("下载过程中文件一直在变: %s" % self.uri)
+        return size
+
+    def _probe(self):
+        """
+        HEAD 探测长度和是否支持范围请求，不支持分段的时候返回None
+        """
+        response = self.session.head(self.uri, headers=self.headers, timeout=self.timeout)
+        size = response.headers.get(fs.Content_Length)
+        if response.status_line.status_code != "200" or size is None or not size.isdigit() or \
+                "bytes" not in (response.headers.get(fs.Accept_Ranges) or "").lower():
+            return None
+
+        # 弱 ETag 不能用在 If-Range 里面（RFC7233 Section 3.2）
+        validator = response.headers.get(fs.ETag)
+        if validator is None or validator.startswith("W/"):
+            validator = response.headers.get(fs.Last_Modified)
+
+        size = int(size)
+        count = max(1, min(self.segments, size // self.min_segment))
+        step = -(-size // count) if size else 0
+        return {"uri": self.uri, "size": size, "validator": validator,
+                "segments": [[start, min(start + step, size) - 1, 0] for start in range(0, size, step or 1)]}
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get("uri") != self.uri or not os.path.exists(self.part_path):
+            return None
+        return state
+
+    def _save_state(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.saved_at < self.save_interval:
+            return
+        self.saved_at = now
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_path)
+
+    def _single(self):
+        response = self.session.get(self.uri, stream=True, headers=self.headers, timeout=self.timeout)
+        with response:
+            if response.status_line.status_code[:1] != "2":
+                raise Exception("下载失败，状态码 %s" % response.status_line.status_code)
+            size = response.save_to(self.part_path)
+        if response.complete is False:
+            raise Exception("下载不完整: %s" % self.uri)
+        os.replace(self.part_path, self.path)
+        return size
+
+    def _segmented(self):
+        size = self.state["size"]
+        mode = "r+b" if os.path.exists(self.part_path) and os.path.getsize(self.part_path) == size else "w+b"
+        with open(self.part_path, mode) as f:
+            if mode == "w+b":
+                for segment in self.state["segments"]:
+                    segment[2] = 0
+                f.truncate(size)
+            self.fd = f.fileno()
+            self._save_state(force=True)
+
+            pending = [x for x in self.state["segments"] if x[2] < x[1] - x[0] + 1]
+            errors = []
+            if pending:
+                with ThreadPoolExecutor(max_workers=pending.__len__()) as executor:
+                    for future in [executor.submit(self._fetch, x) for x in pending]:
+                        if future.exception() is not None:
+                            errors.append(future.exception())
+            with self.lock:
+                self._save_state(force=True)
+            if self.changed:
+                return size
+            if errors:
+                raise errors[0]
+            f.flush()
+            os.fsync(self.fd)
+
+        os.replace(self.part_path, self.path)
+        self._remove(self.state_path)
+        return size
+
+    def _fetch(self, segment):
+        """
+        下载一段，segment 是 [起始位置, 结束位置, 已经下载的字节数]
+        """
+        start, end = segment[0], segment[1]
+        buf = bytearray(self.buffer_size)
+        view = memoryview(buf)
+        failures = 0
+        while segment[2] < end - start + 1 and not self.changed:
+            offset = start + segment[2]
+            headers = self.headers.copy()
+            headers[fs.Range] = "bytes=%d-%d" % (offset, end)
+            if self.state["validator"]:
+                headers[fs.If_Range] = self.state["validator"]
+            try:
+                response = self.session.get(self.uri, stream=True, headers=headers, timeout=self.timeout)
+                with response:
+                    code = response.status_line.status_code
+                    if code == "200":
+                        self.changed = True
+                        return
+                    if code != "206" or not (response.headers.get(fs.Content_Range) or "").startswith(
+                            "bytes %d-" % offset):
+                        raise Exception("范围请求失败，状态码 %s，Content-Range: %s" %
+                                        (code, response.headers.get(fs.Content_Range)))
+                    while not self.changed:
+                        n = response.readinto(view[:min(buf.__len__(), end + 1 - offset)])
+                        if not n:
+                            break
+                        self._write(view[:n], offset)
+                        offset += n
+                        with self.lock:
+                            segment[2] = offset - start
+                            self._save_state()
+                        if offset > end:
+                            break
+            except (OSError, socket.timeout):
+                failures += 1
+                if failures > self.retries:
+                    raise
+                logger.debug("第 %d-%d 字节下载出错，从 %d 重试", start, end, start + segment[2])
+                continue
+            if offset <= end and not self.changed:
+                failures += 1
+                if failures > self.retries:
+                    raise Exception("第 %d-%d 字节下载不完整" % (start, end))
+
+    def _write(self, data, offset):
+        if hasattr(os, "pwrite"):
+            while data.__len__():
+                n = os.pwrite(self.fd, data, offset)
+                data, offset = data[n:], offset + n
+        else:
+            with self.lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                os.write(self.fd, data)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class ResponseParser:
+    """
+    push式的增量响应解析器，本身不碰套接字，调用者把收到的数据一段一段喂进来即可
+
+    状态变化：head（接收首部） -> body（接收主体） -> done（报文结束）
+    首部阶段只扫描新到的字节寻找空行，不会每收到一段就把整个缓冲区重新查一遍
+    主体阶段不做任何拷贝，feed 返回的主体数据就是传入数据的切片
+
+    主体长度的确定方法依据 RFC7230 Section 3.3.3：
+    none：HEAD请求、1xx/204/304响应，没有主体
+    chunked：Transfer-Encoding 最后一项是 chunked，按分块接收，分块之后可能还跟着 trailer 首部
+    length：按 Content-Length 接收
+    eof：以上都不是，一直读到对端关闭连接为止，这种连接不能再复用
+    """
+
+    max_head_size = 1 << 20                     # 响应首部的大小上限，防止对端发来无穷无尽的首部
+    max_line_size = 8192                        # 分块长度行、trailer 首部行的长度上限
+
+    def __init__(self, response, method="GET"):
+        self.response = response
+        self.method = method
+        self.state = "head"
+        self.framing = None                     # none / chunked / length / eof，见上面的说明
+        self.chunk_state = None                 # chunked模式下的子状态：size / data / crlf / trailer
+        self.remaining = 0                      # length模式下还剩多少字节没收，chunked模式下当前分块还剩多少字节没收
+        self.head = bytearray()
+        self.line = bytearray()                 # chunked模式下还没收完整的一行
+
+    @property
+    def head_done(self):
+        return self.state != "head"
+
+    @property
+    def done(self):
+        return self.state == "done"
+
+    def feed(self, data):
+        """
+        喂入一段数据，返回 (consumed, body)
+        consumed 是这一次消耗掉的字节数，没消耗的部分留给下一次调用（比如首部之后紧跟着的主体）
+        body 是其中属于报文主体的部分，是传入数据的切片，没有拷贝
+        chunked模式下每次调用最多处理一个分块的一部分，调用者需要循环调用直到数据消耗完
+        """
+        if self.state == "head":
+            return self._feed_head(data), b""
+        if self.state != "body":
+            return 0, b""
+
+        if self.framing == "length":
+            n = min(self.remaining, data.__len__())
+            self.remaining -= n
+            if not self.remaining:
+                self.state = "done"
+            return n, data[:n]
+
+        if self.framing == "eof":
+            return data.__len__(), data
+
+        return self._feed_chunked(data)
+
+    def raw_limit(self):
+        """
+        接下来最多有多少字节可以原样当作主体，调用者可以据此直接 recv_into 到目标缓冲区，省掉一次拷贝
+        """
+        if self.state != "body":
+            return 0
+        if self.framing == "length":
+            return self.remaining
+        if self.framing == "eof":
+            return 1 << 30
+        if self.chunk_state == "data":
+            return self.remaining
+        return 0
+
+    def feed_eof(self):
+        """
+        对端关闭了连接，返回报文是否完整
+        """
+        if self.state == "body" and self.framing == "eof":
+            self.state = "done"
+        return self.done
+
+    def _feed_head(self, data):
+        old = self.head.__len__()
+        self.head += data
+        # 空行有可能被切成两半，所以往前多看3个字节
+        end = self.head.find(b"\r\n\r\n", max(old - 3, 0))
+        if end < 0:
+            if self.head.__len__() > self.max_head_size:
+                raise Exception("响应首部过大!")
+            return data.__len__()
+
+        end += 4
+        del self.head[end:]
+        self._parse_head(self.head)
+        return end - old
+
+    def _parse_head(self, head):
+        response = self.response
+        line_end = head.find(b"\r\n")
+        response.status_line.parse(head[:line_end])                    # 解析状态行
+        if line_end + 2 < head.__len__() - 2:
+            response.headers.parse(head[line_end + 2: -4])             # 解析响应头
+
+        code = response.status_line.status_code
+
+        # 1xx是临时响应（比如100 Continue），后面还会跟着真正的响应，丢掉重新解析
+        if code[:1] == "1" and code != "101":
+            response.headers = Headers()
+            self.head = bytearray()
+            return
+
+        self.head = bytearray()
+        self.state = "body"
+        transfer_encoding = self.header(fs.Transfer_Encoding)
+        content_length = self.header(fs.Content_Length)
+
+        if self.method == "HEAD" or code[:1] == "1" or code in ("204", "304"):
+            self.framing = "none"
+            self.state = "done"
+        elif transfer_encoding is not None:
+            # 有 Transfer-Encoding 的时候忽略 Content-Length；最后一项不是 chunked 的话只能读到连接关闭
+            codings = [x.strip().lower() for x in transfer_encoding.split(",")]
+            if codings[-1] == "chunked":
+                self.framing = "chunked"
+                self.chunk_state = "size"
+            else:
+                self.framing = "eof"
+        elif content_length is not None:
+            # 重复的 Content-Length 只要值都一样就可以接受，比如 "5, 5"
+            values = set(x.strip() for x in content_length.split(","))
+            if values.__len__() != 1 or not next(iter(values)).isdigit():
+                raise Exception("Content-Length不合法!")
+            self.framing = "length"
+            self.remaining = int(values.pop())
+            if not self.remaining:
+                self.state = "done"
+        else:
+            self.framing = "eof"
+
+    def header(self, name):
+        return self.response.headers.get(name)
+
+    def _feed_chunked(self, data):
+        """
+        chunked-body   = *chunk
+                         last-chunk
+                         trailer-part
+                         CRLF
+
+        chunk          = chunk-size [ chunk-ext ] CRLF
+                         chunk-data CRLF
+        chunk-size     = 1*HEXDIG
+        last-chunk     = 1*("0") [ chunk-ext ] CRLF
+        trailer-part   = *( header-field CRLF )
+        """
+        if self.chunk_state == "data":
+            n = min(self.remaining, data.__len__())
+            self.remaining -= n
+            if not self.remaining:
+                self.chunk_state = "crlf"
+            return n, data[:n]
+
+        consumed, line = self._feed_line(data)
+        if line is None:
+            return consumed, b""
+
+        if self.chunk_state == "size":
+            size = line.split(b";", 1)[0].strip()              # 分块扩展直接忽略
+            try:
+                self.remaining = int(size, 16)
+            except ValueError:
+                raise Exception("分块长度不合法!")
+            self.chunk_state = "data" if self.remaining else "trailer"
+
+        elif self.chunk_state == "crlf":
+            if line.strip():
+                raise Exception("分块数据后面缺少CRLF!")
+            self.chunk_state = "size"
+
+        elif self.chunk_state == "trailer":
+            if line.strip():
+                name, _, value = bytes(line).decode("latin-1").partition(":")
+                self.response.trailers[name.strip()] = value.strip()
+            else:
+                self.state = "done"
+        return consumed, b""
+
+    def _feed_line(self, data):
+        """
+        收集一行，返回 (consumed, line)，行还没收完整的时候 line 为None
+        只往后看有限的字节，不会把后面的分块数据也拷贝进来
+        """
+        old = self.line.__len__()
+        self.line += data[:self.max_line_size]
+        end = self.line.find(b"\n", old)
+        if end < 0:
+            if self.line.__len__() >= self.max_line_size:
+                raise Exception("分块长度行过长!")
+            return self.line.__len__() - old, None
+
+        line = self.line[:end].rstrip(b"\r")
+        self.line = bytearray()
+        return end + 1 - old, line
+
+
+class DecompressionLimitError(ValueError):
+    """
+    解压出来的主体超过了 max_decompressed_size，多半是压缩炸弹，重试也没有用，RetryPolicy 不会重试
+    """
+
+
+class ContentDecoder:
+    """
+    按 Content-Encoding 增量解压响应主体，压缩数据一段一段喂进来，解压结果一段一段返回，不需要先把整个主体收完
+
+    gzip/deflate 用标准库的 zlib，br 需要安装 brotli，zstd 需要安装 zstandard，没装的编码不会出现在 Accept-Encoding 里面
+    有多重编码的时候（比如 "gzip, br"）按相反的顺序逐层解开
+    每一层解压出来的总大小都不能超过 max_size，超过了抛出 DecompressionLimitError，防止几KB的压缩炸弹解压出几个G把内存撑爆；
+    每个解压器每一步的输出都是有限的，不会先全部解压出来再检查
+    """
+
+    codings = ("gzip", "x-gzip", "deflate") + (("br",) if brotli else ()) + (("zstd",) if zstandard else ())
+    accept_encoding = ", ".join(x for x in codings if x != "x-gzip")
+    max_size = 1 << 30                          # 默认解压后最多1G
+
+    def __init__(self, codings, max_size=None):
+        self.max_size = max_size or self.max_size
+        self.names = list(reversed(codings))
+        self.steps = [self._decompressor(i, x) for i, x in enumerate(self.names)]
+        self.totals = [0] * self.steps.__len__()
+
+    @classmethod
+    def create(cls, content_encoding, max_size=None):
+        """
+        根据 Content-Encoding 的值创建解压器，没有编码、identity 或者有不支持的编码时返回None，主体原样保留
+        """
+        if not content_encoding:
+            return None
+        codings = [x.strip().lower() for x in content_encoding.split(",")]
+        codings = [x for x in codings if x and x != "identity"]
+        if not codings or any(x not in cls.codings for x in codings):
+            return None
+        return cls(codings, max_size)
+
+    def _decompressor(self, i, coding):
+        if coding == "br":
+            return brotli.Decompressor()
+        if coding == "zstd":
+            return ZstdStep(lambda data: self._check(i, data))
+        if coding == "deflate":
+            # 按规范 deflate 是带 zlib 头的，但不少服务端发的是裸 deflate 数据，第一次解压失败的时候再换过来
+            return zlib.decompressobj(zlib.MAX_WBITS)
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        """
+        喂入一段压缩数据，返回这一段能解压出来的数据（可能为空）
+        """
+        for i in range(self.steps.__len__()):
+            if not data:
+                return b""
+            data = self._decompress(i, data)
+        return data
+
+    def flush(self):
+        """
+        主体收完之后调用，取出解压器里面剩下的数据
+        """
+        data = b""
+        for i, step in enumerate(self.steps):
+            if data:
+                data = self._decompress(i, data)
+            if hasattr(step, "flush"):
+                data += self._check(i, step.flush())
+        return data
+
+    def _decompress(self, i, data):
+        step, coding = self.steps[i], self.names[i]
+        if coding == "br":
+            # 每次最多输出到超出上限为止，输出缓冲区满了的话，解压器里还有数据，用空的输入接着取
+            out = self._check(i, step.process(data, output_buffer_limit=self.max_size - self.totals[i] + 1))
+            while not step.can_accept_more_data():
+                out += self._check(i, step.process(b"", output_buffer_limit=self.max_size - self.totals[i] + 1))
+            return out
+        if coding == "zstd":
+            return step.decompress(data)
+
+        # zlib 可以限制输出的长度，超出上限的数据根本不会解压出来
+        limit = self.max_size - self.totals[i] + 1
+        try:
+            return self._check(i, step.decompress(data, limit))
+        except zlib.error:
+            if coding != "deflate" or self.totals[i]:
+                raise
+            step = self.steps[i] = zlib.decompressobj(-zlib.MAX_WBITS)
+            self.names[i] = "raw-deflate"
+            return self._check(i, step.decompress(data, limit))
+
+    def _check(self, i, data):
+        self.totals[i] += data.__len__()
+        if self.totals[i] > self.max_size:
+            raise DecompressionLimitError("解压后的主体超过%d字节!" % self.max_size)
+        return data
+
+
+class ZstdStep:
+    """
+    zstd 的一层解压：zstandard 的 decompressobj 不能限制输出长度，改用 stream_writer，
+    解压出来的数据每 write_size 字节交给 write 一次，在这里检查上限，超过了马上抛出异常，不会继续解压下去
+    """
+
+    write_size = 1 << 16
+
+    def __init__(self, check):
+        self.check = check
+        self.out = bytearray()
+        self.writer = zstandard.ZstdDecompressor().stream_writer(self, write_size=self.write_size, closefd=False)
+
+    def write(self, data):
+        self.out += self.check(data)
+        return data.__len__()
+
+    def decompress(self, data):
+        self.writer.write(data)
+        out, self.out = bytes(self.out), bytearray()
+        return out
+
+
+class BodyReader:
+    """
+    从连接里面把报文主体读出来，主体数据尽量直接 recv_into 到调用者给的缓冲区
+    主体读完（或者对端提前断开）的时候调用一次 on_finish(complete)，Session 在这里把连接还回连接池
+    传入 decoder 的时候读出来的是解压之后的数据，见 ContentDecoder
+    """
+
+    def __init__(self, conn, parser, on_finish=None, decoder=None):
+        self.conn = conn
+        self.parser = parser
+        self.on_finish = on_finish
+        self.complete = parser is not None and parser.done  # 报文是否按照约定的长度完整接收
+        self.finished = False
+
+        self.decoder = decoder
+        self.decoded = b""                      # 已经解压出来、还没交给调用者的数据
+        self.decoded_pos = 0
+        self.flushed = False                    # 解压器里剩下的数据是否已经取出来了
+        self.raw_buf = None                     # 解压之前的数据先收到这里
+
+    @property
+    def exhausted(self):
+        """
+        主体数据是否已经全部交给调用者了，有解压器的时候连接上的数据收完了，解压出来的数据不一定取完了
+        """
+        if self.decoder is None:
+            return self.finished
+        return self.flushed and self.decoded_pos >= self.decoded.__len__()
+
+    def readinto(self, buf):
+        """
+        读取主体数据写入buf，返回写入的字节数，返回0表示主体已经读完（或者对端提前断开了）
+        """
+        if self.decoder is None:
+            return self._readinto(buf)
+
+        buf = memoryview(buf).cast("B")
+        while self.decoded_pos >= self.decoded.__len__():
+            if self.flushed:
+                return 0
+            if self.raw_buf is None:
+                self.raw_buf = bytearray(Connection.buffer_size)
+            n = self._readinto(self.raw_buf)
+            if n:
+                self.decoded = self.decoder.decompress(memoryview(self.raw_buf)[:n])
+            else:
+                self.decoded = self.decoder.flush()
+                self.flushed = True
+            self.decoded_pos = 0
+
+        n = min(buf.__len__(), self.decoded.__len__() - self.decoded_pos)
+        buf[:n] = self.decoded[self.decoded_pos: self.decoded_pos + n]
+        self.decoded_pos += n
+        return n
+
+    def _readinto(self, buf):
+        if self.finished:
+            return 0
+        buf = memoryview(buf).cast("B")
+        parser, conn = self.parser, self.conn
+        while not parser.done:
+            pending = conn.pending()
+            if pending:
+                consumed, data = parser.feed(pending[:buf.__len__()])
+                conn.consume(consumed)
+                if data:
+                    n = data.__len__()
+                    buf[:n] = data
+                    self._check_done()
+                    return n
+                continue
+
+            limit = parser.raw_limit()
+            if limit:
+                n = conn.recv_into(buf[:min(limit, buf.__len__())])
+                if n:
+                    parser.feed(buf[:n])
+                    self._check_done()
+                    return n
+            elif conn.fill():
+                continue
+
+            # 对端断开了连接
+            conn.reusable = False
+            self._finish(parser.feed_eof())
+            return 0
+        self._check_done()
+        return 0
+
+    def read(self):
+        """
+        读出全部主体，长度已知的时候预先分配好缓冲区，数据直接收进去，不做拼接
+        有解压器的时候和 readinto 一样每次收一个缓冲区的压缩数据喂给解压器，每一步都会检查解压后的大小
+        """
+        if self.decoder is None:
+            return self._read()
+
+        body = bytearray(self.decoded[self.decoded_pos:])
+        self.decoded, self.decoded_pos = b"", 0
+        if not self.flushed:
+            if self.raw_buf is None:
+                self.raw_buf = bytearray(Connection.buffer_size)
+            while True:
+                n = self._readinto(self.raw_buf)
+                if not n:
+                    break
+                body += self.decoder.decompress(memoryview(self.raw_buf)[:n])
+            body += self.decoder.flush()
+            self.flushed = True
+        return body
+
+    def _read(self):
+        if self.parser.framing == "length" and not self.finished:
+            # 小响应的主体通常已经跟着首部一起收到了，直接取出来
+            pending = self.conn.pending()
+            if pending.__len__() >= self.parser.remaining:
+                consumed, data = self.parser.feed(pending)
+                body = bytearray(data)
+                self.conn.consume(consumed)
+                self._check_done()
+                return body
+
+            body = bytearray(self.parser.remaining)
+            view = memoryview(body)
+            pos = 0
+            while pos < body.__len__():
+                n = self._readinto(view[pos:])
+                if not n:
+                    break
+                pos += n
+            view.release()
+            if pos < body.__len__():
+                del body[pos:]
+            return body
+
+        body = bytearray()
+        chunk = bytearray(Connection.buffer_size)
+        while True:
+            n = self._readinto(chunk)
+            if not n:
+                return body
+            body += memoryview(chunk)[:n]
+
+    def close(self):
+        """
+        主体还没读完就不要了，剩下的数据没法跳过，这个连接只能关掉
+        """
+        if not self.finished:
+            self.conn.reusable = False
+            self._finish(False)
+
+    def _check_done(self):
+        if self.parser.done:
+            self._finish(True)
+
+    def _finish(self, complete):
+        if self.finished:
+            return
+        self.finished = True
+        self.complete = complete
+        if self.on_finish is not None:
+            self.on_finish(complete)
+
+
+class H2BodyReader(BodyReader):
+    """
+    HTTP/2 响应的主体，从 http2.H2Stream 里面读，解压和 on_finish 的处理与 BodyReader 相同
+    读的时候出错（包括超时）先关闭流：发 RST_STREAM、归还已经收到的数据占用的接收窗口，不然这个流会一直占着连接
+    """
+
+    def __init__(self, stream, timeout=None, on_finish=None, decoder=None):
+        BodyReader.__init__(self, None, None, on_finish, decoder)
+        self.stream = stream
+        self.timeout = timeout
+
+    def _readinto(self, buf):
+        if self.finished:
+            return 0
+        try:
+            n = self.stream.readinto(buf, self.timeout)
+        except BaseException:
+            self.stream.close()
+            self._finish(False)
+            raise
+        if not n:
+            self._finish(True)
+        return n
+
+    def _read(self):
+        if self.finished:
+            return bytearray()
+        try:
+            body = self.stream.read(self.timeout)
+        except BaseException:
+            self.stream.close()
+            self._finish(False)
+            raise
+        self._finish(True)
+        return body
+
+    def close(self):
+        if not self.finished:
+            self.stream.close()
+            self._finish(False)
+
+
+class Connection:
+    """
+    对套接字的简单封装，连接池里面存的就是这个对象
+    除了套接字本身，还记录了连接所属的主机、最后使用时间，以及服务端通过 Keep-Alive 首部告知的超时时间和剩余可用次数
+    """
+
+    buffer_size = 65536                         # 接收缓冲区大小
+
+    def __init__(self, key, sock):
+        self.key = key                          # (protocol, host, port)，连接池按这个分组
+        self.socket = sock
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.requests = 0                       # 已经在这个连接上完成的请求数
+        self.fresh = True                       # 是否是刚新建的连接，复用的连接发送失败可以换新连接重试
+        self.reusable = True                    # 服务端要求关闭，或者报文没有接收完整时置为False
+        self.keep_alive_timeout = None          # Keep-Alive: timeout=N，服务端保持空闲连接的秒数
+        self.keep_alive_max = None              # Keep-Alive: max=N，服务端还允许在这个连接上发的请求数
+        self.read_timeout = None
+        self.deadline = None                    # 当前请求的截止时间，Timeout.total
+        self.tls = None                         # https 连接的TLS信息：版本、密码套件、ALPN、握手耗时、是否会话恢复
+        self.bytes_in = 0                       # 这个连接上累计收到、发出的字节数
+        self.bytes_out = 0
+
+        # 预先分配好的接收缓冲区，recv_into 直接往里面收，rstart/rend 之间是还没有处理的数据
+        self.rbuf = bytearray(self.buffer_size)
+        self.rview = memoryview(self.rbuf)
+        self.rstart = 0
+        self.rend = 0
+
+    def set_timeout(self, timeout):
+        """
+        每个请求开始的时候设置读超时和这个请求的截止时间
+        """
+        self.read_timeout = timeout.read
+        self.deadline = None if timeout.total is None else time.monotonic() + timeout.total
+        self.socket.settimeout(timeout.read)
+
+    def check_deadline(self):
+        """
+        有总超时的时候，每次收数据之前把套接字的超时缩短到截止时间为止
+        """
+        if self.deadline is None:
+            return
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("请求超时!")
+        self.socket.settimeout(remaining if self.read_timeout is None else min(remaining, self.read_timeout))
+
+    def sendall(self, bytes_data):
+        self.socket.sendall(bytes_data)
+
+    def sendmsg(self, buffers):
+        """
+        scatter-gather 发送，多段数据一次系统调用发出去，不需要先拼接成一整段
+        SSL套接字不支持 sendmsg，小数据拼起来发一次，大数据分段发送
+        """
+        buffers = [memoryview(b).cast("B") for b in buffers if b.__len__()]
+        self.bytes_out += sum(b.nbytes for b in buffers)
+        if isinstance(self.socket, ssl.SSLSocket) or not hasattr(self.socket, "sendmsg"):
+            if sum(b.nbytes for b in buffers) <= self.buffer_size:
+                self.socket.sendall(b"".join(buffers))
+            else:
+                for b in buffers:
+                    self.socket.sendall(b)
+            return
+
+        while buffers:
+            sent = self.socket.sendmsg(buffers)
+            # 没发完的话把已经发出去的部分去掉，剩下的继续发
+            while buffers and sent >= buffers[0].nbytes:
+                sent -= buffers.pop(0).nbytes
+            if buffers and sent:
+                buffers[0] = buffers[0][sent:]
+
+    def send_request(self, request):
+        """
+        发送请求报文
+        - 内存里的主体和首部一起用一次 sendmsg 发出去
+        - 长度已知的文件对象先发首部，主体用 sendfile 由内核直接从文件拷到套接字（https 会自动退化成读一块发一块）
+        - 长度未知的流式主体按 chunked 编码一块一块地发
+        """
+        body = request.body
+        head = request.head_bytes()
+
+        if body.stream is None:
+            self.sendmsg((head, body.content))
+
+        elif body.length is not None:
+            self.sendmsg((head,))
+            if body.length:
+                self.bytes_out += self.socket.sendfile(body.stream, offset=body.stream_start, count=body.length)
+
+        else:
+            self.sendmsg((head,))
+            for chunk in self._iter_stream(body.stream):
+                if chunk.__len__():
+                    self.sendmsg((b"%x\r\n" % chunk.__len__(), chunk, b"\r\n"))
+            self.sendmsg((b"0\r\n\r\n",))
+
+    @staticmethod
+    def _iter_stream(stream):
+        if not hasattr(stream, "read"):
+            for chunk in stream:
+                yield chunk.encode() if isinstance(chunk, str) else chunk
+            return
+        while True:
+            chunk = stream.read(65536)
+            if not chunk:
+                return
+            yield chunk
+
+    def pending(self):
+        """
+        接收缓冲区里面已经收到、但还没有被解析器消耗掉的数据
+        """
+        return self.rview[self.rstart: self.rend]
+
+    def consume(self, n):
+        self.rstart += n
+        if self.rstart == self.rend:
+            self.rstart = self.rend = 0
+
+    def fill(self):
+        """
+        从套接字收一次数据追加到接收缓冲区，返回收到的字节数，0表示对端已经关闭连接
+        """
+        if self.rend == self.rbuf.__len__():
+            # 缓冲区尾部没有空间了，把还没处理的数据挪到开头
+            n = self.rend - self.rstart
+            self.rbuf[:n] = bytes(self.rview[self.rstart: self.rend])
+            self.rstart, self.rend = 0, n
+        self.check_deadline()
+        n = self.socket.recv_into(self.rview[self.rend:])
+        self.rend += n
+        self.bytes_in += n
+        return n
+
+    def recv_into(self, buf):
+        """
+        绕过接收缓冲区，直接把数据收进调用者的缓冲区，只能在接收缓冲区为空的时候用
+        """
+        self.check_deadline()
+        n = self.socket.recv_into(buf)
+        self.bytes_in += n
+        return n
+
+    def update(self, response):
+        """
+        根据响应报文的 Connection / Keep-Alive 首部，判断这个连接之后还能不能复用
+        RFC7230 Section 6.3：HTTP/1.1 默认持久连接，HTTP/1.0 只有明确带上 keep-alive 才是持久连接
+        """
+        self.requests += 1
+        self.last_used = time.monotonic()
+
+        connection = response.headers.get(fs.Connection, "").lower()
+        if "close" in connection:
+            self.reusable = False
+        elif response.status_line.http_version.upper() == "HTTP/1.0" and "keep-alive" not in connection:
+            self.reusable = False
+
+        keep_alive = response.headers.get("Keep-Alive", "")
+        for item in keep_alive.split(","):
+            name, _, value = item.strip().partition("=")
+            if not value.strip().isdigit():
+                continue
+            if name.strip().lower() == "timeout":
+                self.keep_alive_timeout = int(value)
+            elif name.strip().lower() == "max":
+                self.keep_alive_max = int(value)
+
+        if self.keep_alive_max is not None and self.keep_alive_max <= 0:
+            self.reusable = False
+
+    def expired(self, idle_timeout, now=None):
+        """
+        空闲时间超过连接池的限制，或者超过服务端告知的 Keep-Alive 超时时间，就认为连接已经过期
+        服务端的超时时间留出1秒的余量，免得刚好在服务端关闭连接的时候把请求发出去
+        """
+        now = time.monotonic() if now is None else now
+        idle = now - self.last_used
+        if idle_timeout is not None and idle >= idle_timeout:
+            return True
+        if self.keep_alive_timeout is not None and idle >= self.keep_alive_timeout - 1:
+            return True
+        return False
+
+    def is_dropped(self):
+        """
+        空闲连接理应不可读，如果报告可读，说明对端已经关闭（读到EOF）或者发来了不该有的数据，都不能再用
+        有 poll 的平台用 poll：select.select 遇到超过1024（FD_SETSIZE）的文件描述符会抛 ValueError，
+        那样的话所有空闲连接都会被当成已经断开，连接池就白用了
+        """
+        if self.socket is None or self.rstart != self.rend:
+            return True
+        try:
+            if hasattr(select, "poll"):
+                poller = select.poll()
+                poller.register(self.socket, select.POLLIN)
+                return bool(poller.poll(0))
+            readable, _, _ = select.select([self.socket], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+            self.socket = None
+        self.reusable = False
+
+
+class Timeout:
+    """
+    超时设置，单位秒，None表示不限制
+
+    - connect：建立连接的超时，包括TCP连接（所有地址加起来）和TLS握手
+    - read：两次收到数据之间的最长间隔
+    - total：一次请求从发出到接收完毕的总时间
+    """
+
+    def __init__(self, connect=10, read=None, total=None):
+        self.connect = connect
+        self.read = read
+        self.total = total
+
+    @classmethod
+    def of(cls, value):
+        """
+        get/post 等方法的 timeout 参数可以是 Timeout 对象，也可以是一个数字（同时作为连接超时和读超时）
+        """
+        if value is None or isinstance(value, Timeout):
+            return value
+        return cls(connect=value, read=value)
+
+
+class Timings:
+    """
+    一次请求各个阶段的耗时（秒），没有经历的阶段是None，比如复用的连接没有 connect/tls
+
+    - dns：构建请求时域名解析的耗时（命中缓存的时候接近0）
+    - connect：TCP连接耗时，tls：TLS握手耗时
+    - ttfb：请求发送完毕到收到响应第一个字节
+    - transfer：响应头收完到主体收完
+    - total：从开始处理到主体收完，命中缓存的响应只有这一项
+    - bytes_in/bytes_out：这次请求在连接上收发的字节数（主体压缩过的话是压缩后的大小）
+    - reused：是否复用了连接池里的连接
+    - queue：在 Scheduler 里排队等待的时间，没有开启调度的时候是None；total 里面包括这段时间
+    """
+
+    def __init__(self):
+        self.dns = None
+        self.connect = None
+        self.tls = None
+        self.ttfb = None
+        self.transfer = None
+        self.total = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.reused = False
+        self.queue = None
+
+        # 各个时间点，time.perf_counter() 的值
+        self.start = time.perf_counter()
+        self.sent_at = None
+        self.first_byte_at = None
+        self.head_at = None
+        self.conn_bytes_in = 0                  # 开始接收的时候连接上已经收过的字节数
+        self.conn = None                        # 这次请求所用的连接（HTTP/2 是流），对冲请求输掉的一方要把它关掉
+        self.cancelled = False
+        self.scheduled = False                  # 是否还占着 Scheduler 里的一个在途名额
+
+    def __repr__(self):
+        return "Timings(%s)" % ", ".join("%s=%s" % (k, v) for k, v in self.as_dict().items())
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in ("dns", "connect", "tls", "ttfb", "transfer", "total",
+                                              "bytes_in", "bytes_out", "reused", "queue")}
+
+
+class MetricsShard:
+    """
+    Metrics 里一个线程自己的计数器和直方图，结构见 Metrics.incr/observe
+    只有线程自己的 threading.local 引用它，Metrics.shards 里放的是它的两个字典，线程退出的时候它就会被释放
+    """
+    __slots__ = ("counters", "histograms", "__weakref__")
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def merge(self, counters, histograms):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, h in histograms.items():
+            total = self.histograms.get(key)
+            if total is None:
+                self.histograms[key] = list(h)
+            else:
+                for i, n in enumerate(h):
+                    total[i] += n
+
+
+class Metrics:
+    """
+    Session 级别的汇总统计：按主机的计数器，按 (主机, 状态码类别) 的固定分桶延迟直方图，以及连接池和DNS缓存的状态
+
+    - 计数器：requests、errors、retries、hedges、bytes_in、bytes_out、reused、cached
+    - 直方图：从开始处理到主体收完的总耗时，分桶上限见 buckets（秒），超出最后一个上限的算在 +Inf 里
+    更新的时候只写当前线程自己的分片（threading.local），不需要加锁，也不会和其他线程抢；
+    snapshot 的时候再把所有线程的分片加起来，只有线程第一次写入、登记分片的时候才用到锁；
+    线程退出的时候它的分片合并进 base 再删掉，线程池换了多少批线程，分片的个数也只跟同时活着的线程数有关
+    """
+
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    counter_names = ("requests", "errors", "retries", "hedges", "bytes_in", "bytes_out", "reused", "cached")
+
+    def __init__(self, pool=None, dns_cache=None, buckets=None, scheduler=None):
+        self.pool = pool
+        self.dns_cache = dns_cache
+        self.scheduler = scheduler
+        self.bounds = tuple(buckets or self.buckets)
+        self.local = threading.local()
+        self.base = MetricsShard()              # 已经退出的线程留下的统计
+        self.shards = [(self.base.counters, self.base.histograms)]     # base 加上每个活着的线程一个 (counters, histograms)
+        self.lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = MetricsShard()
+            with self.lock:
+                self.shards.append((shard.counters, shard.histograms))
+            # 线程退出的时候 threading.local 释放它的分片，这时候再合并；只持有 Metrics 的弱引用，不会让它一直活着
+            weakref.finalize(shard, Metrics._retire, weakref.ref(self), shard.counters, shard.histograms)
+        return shard
+
+    @staticmethod
+    def _retire(ref, counters, histograms):
+        metrics = ref()
+        if metrics is None:
+            return
+        with metrics.lock:
+            metrics.shards = [shard for shard in metrics.shards if shard[0] is not counters]
+            metrics.base.merge(counters, histograms)
+
+    def incr(self, name, host, value=1):
+        counters = self._shard().counters
+        key = (name, host)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, host, status_code, seconds):
+        """
+        记录一次请求的耗时，直方图每一项是各个桶的计数，最后两个元素是 +Inf 桶和耗时总和
+        """
+        histograms = self._shard().histograms
+        key = (host, status_code[:1] + "xx")
+        h = histograms.get(key)
+        if h is None:
+            h = histograms[key] = [0] * (self.bounds.__len__() + 1) + [0.0]
+        h[bisect.bisect_left(self.bounds, seconds)] += 1
+        h[-1] += seconds
+
+    def record(self, host, status_code, seconds, bytes_in=0, bytes_out=0, reused=False, cached=False):
+        counters = self._shard().counters
+        for name, value in (("requests", 1), ("bytes_in", bytes_in), ("bytes_out", bytes_out),
+                            ("reused", reused), ("cached", cached)):
+            if value:
+                counters[(name, host)] = counters.get((name, host), 0) + value
+        self.observe(host, status_code, seconds)
+
+    def reset(self):
+        with self.lock:
+            for counters, histograms in self.shards:
+                counters.clear()
+                histograms.clear()
+
+    def snapshot(self):
+        """
+        返回当前统计的字典，可以直接转成JSON：
+            {"hosts": {host: {计数器..., "reuse_ratio": ...}},
+             "latency": {host: {"2xx": {"count", "sum", "buckets": [[上限, 累计次数], ...], "p50", "p90", "p99"}}},
+             "pool": {...}, "dns": {...}, "scheduler": {host: {...}}}
+        scheduler 是 Scheduler.stats() 的结果，没有开启调度的时候是None
+        其他线程同时还在写，各个数字之间不保证严格一致
+        """
+        hosts, merged = {}, {}
+        # 在锁里面加，免得一个线程刚好退出、分片合并进 base，被算了两次
+        with self.lock:
+            for counters, histograms in self.shards:
+                for (name, host), value in dict(counters).items():
+                    stat = hosts.setdefault(host, dict.fromkeys(self.counter_names, 0))
+                    stat[name] += value
+                for key, h in dict(histograms).items():
+                    total = merged.get(key)
+                    merged[key] = list(h) if total is None else [a + b for a, b in zip(total, h)]
+
+        for stat in hosts.values():
+            sent = stat["requests"] - stat["cached"]
+            stat["reuse_ratio"] = stat["reused"] / sent if sent > 0 else None
+
+        latency = {}
+        for (host, status_class), h in sorted(merged.items()):
+            cumulative, buckets = 0, []
+            for bound, n in zip(self.bounds + (float("inf"),), h):
+                cumulative += n
+                buckets.append([bound, cumulative])
+            stat = {"count": cumulative, "sum": h[-1], "buckets": buckets}
+            for q in (50, 90, 99):
+                stat["p%d" % q] = self._quantile(buckets, q / 100)
+            latency.setdefault(host, {})[status_class] = stat
+
+        return {"hosts": hosts, "latency": latency, "pool": self.pool.stats() if self.pool is not None else None,
+                "dns": self._dns_stats(), "scheduler": self.scheduler.stats() if self.scheduler is not None else None}
+
+    def _dns_stats(self):
+        if self.dns_cache is None:
+            return None
+        cache = self.dns_cache
+        lookups = cache.hits + cache.misses
+        return {"size": cache.__len__(), "hits": cache.hits, "misses": cache.misses,
+                "hit_rate": cache.hits / lookups if lookups else None}
+
+    @staticmethod
+    def _quantile(buckets, q):
+        """
+        按分桶估算分位数，在所在的桶里面线性插值；落在 +Inf 桶里的只能返回最后一个有限的上限
+        """
+        total = buckets[-1][1]
+        if not total:
+            return None
+        rank = q * total
+        lower, below = 0.0, 0
+        for bound, cumulative in buckets:
+            if cumulative >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - below) / (cumulative - below)
+            lower, below = bound, cumulative
+        return lower
+
+    def to_json(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        for host in snapshot["latency"].values():
+            for stat in host.values():
+                stat["buckets"][-1][0] = "+Inf"
+        return json.dumps(snapshot, ensure_ascii=False)
+
+    def to_prometheus(self, snapshot=None, prefix="http_client"):
+        """
+        Prometheus 文本格式（text/plain; version=0.0.4）
+        """
+        snapshot = snapshot or self.snapshot()
+        lines = []
+        for name in self.counter_names:
+            lines.append("# TYPE %s_%s_total counter" % (prefix, name))
+            for host, stat in sorted(snapshot["hosts"].items()):
+                lines.append('%s_%s_total{host="%s"} %s' % (prefix, name, self._label(host), stat[name]))
+
+        name = prefix + "_request_duration_seconds"
+        lines.append("# TYPE %s histogram" % name)
+        for host, classes in snapshot["latency"].items():
+            for status_class, stat in classes.items():
+                labels = 'host="%s",status="%s"' % (self._label(host), status_class)
+                for bound, cumulative in stat["buckets"]:
+                    le = "+Inf" if bound in (float("inf"), "+Inf") else repr(float(bound))
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, le, cumulative))
+                lines.append("%s_sum{%s} %s" % (name, labels, repr(stat["sum"])))
+                lines.append("%s_count{%s} %d" % (name, labels, stat["count"]))
+
+        for group in ("pool", "dns"):
+            for key, value in (snapshot[group] or {}).items():
+                if value is not None:
+                    lines.append("# TYPE %s_%s_%s gauge" % (prefix, group, key))
+                    lines.append("%s_%s_%s %s" % (prefix, group, key, value))
+
+        scheduler = snapshot.get("scheduler") or {}
+        for key in ("queued", "in_flight", "factor", "throttled"):
+            lines.append("# TYPE %s_scheduler_%s gauge" % (prefix, key))
+            for host, stat in sorted(scheduler.items()):
+                lines.append('%s_scheduler_%s{host="%s"} %s' % (prefix, key, self._label(host), stat[key]))
+        for key in ("sum", "count"):
+            lines.append("# TYPE %s_scheduler_wait_seconds_%s counter" % (prefix, key))
+            for host, stat in sorted(scheduler.items()):
+                lines.append('%s_scheduler_wait_seconds_%s{host="%s"} %s' % (prefix, key, self._label(host),
+                                                                             stat["wait"][key]))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _label(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class RetryPolicy:
+    """
+    重试和对冲请求的策略，Session(retry=RetryPolicy(...)) 开启，默认不重试
+
+    - total：最多重试几次；只重试幂等方法（methods），并且主体要能重新读取
+    - 连接失败、超时、以及状态码在 statuses 里面的响应会重试，间隔按指数退避加全抖动：
+      random(0, min(max_backoff, backoff * 2^n))，响应带了 Retry-After 的时候至少等这么久
+    - deadline：整个调用（包括所有重试和等待）的截止时间，秒，每次尝试的超时会缩短到剩余的时间
+    - 重试预算：每个主机一开始有 budget_max 个令牌，每发一个请求存入 budget_ratio 个（最多 budget_max 个），
+      每次重试或者对冲取出一个，令牌不够就不重试，服务端整体出问题的时候重试不会把流量放大太多；另外每秒固定补充 budget_min_per_second 个
+    - hedge：GET/HEAD/OPTIONS 在 hedge_percentile 分位的首字节时间内还没收到第一个字节，就在另一个连接上再发一份，
+      哪个先回来用哪个，另一个关掉；首字节时间的样本不够 hedge_min_samples 个之前不对冲，对冲延迟不小于 hedge_min_delay
+    - final_errors 里的异常（解压超出上限）说明响应本身有问题，不重试，对冲的另一份也马上关掉
+    """
+
+    buckets = Metrics.buckets
+    final_errors = (DecompressionLimitError,)
+
+    def __init__(self, total=2, backoff=0.1, max_backoff=10, statuses=("429", "502", "503", "504"),
+                 methods=("GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"), deadline=None, budget_ratio=0.2,
+                 budget_max=10, budget_min_per_second=1, hedge=False, hedge_percentile=95, hedge_min_samples=20,
+                 hedge_min_delay=0.005, hedge_methods=("GET", "HEAD", "OPTIONS")):
+        self.total = total
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = tuple(str(x) for x in statuses)
+        self.methods = methods
+        self.deadline = deadline
+        self.budget_ratio = budget_ratio
+        self.budget_max = budget_max
+        self.budget_min_per_second = budget_min_per_second
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_methods = hedge_methods
+
+        self.budgets = {}                       # host -> [令牌数, 上次补充的时间]
+        self.ttfb = {}                          # host -> 首字节时间的分桶计数
+        self.lock = threading.Lock()
+
+    def deposit(self, host):
+        with self.lock:
+            budget = self._budget(host)
+            budget[0] = min(self.budget_max, budget[0] + self.budget_ratio)
+
+    def withdraw(self, host):
+        """
+        取一个令牌，取不到返回False
+        """
+        with self.lock:
+            budget = self._budget(host)
+            if budget[0] < 1:
+                return False
+            budget[0] -= 1
+            return True
+
+    def _budget(self, host):
+        now = time.monotonic()
+        budget = self.budgets.get(host)
+        if budget is None:
+            budget = self.budgets[host] = [self.budget_max, now]
+        budget[0] = min(self.budget_max, budget[0] + (now - budget[1]) * self.budget_min_per_second)
+        budget[1] = now
+        return budget
+
+    def observe(self, host, ttfb):
+        if ttfb is None:
+            return
+        index = bisect.bisect_left(self.buckets, ttfb)
+        with self.lock:
+            counts = self.ttfb.get(host)
+            if counts is None:
+                counts = self.ttfb[host] = [0] * (self.buckets.__len__() + 1)
+            counts[index] += 1
+
+    def hedge_delay(self, host):
+        """
+        按首字节时间的分位数估算对冲延迟，样本不够的时候返回None
+        """
+        with self.lock:
+            counts = self.ttfb.get(host)
+            counts = None if counts is None else list(counts)
+        if counts is None or sum(counts) < self.hedge_min_samples:
+            return None
+        cumulative, buckets = 0, []
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            buckets.append([bound, cumulative])
+        return max(Metrics._quantile(buckets, self.hedge_percentile / 100), self.hedge_min_delay)
+
+    def retryable(self, request):
+        return request.request_line.method in self.methods
+
+    def wait_time(self, attempt, response=None):
+        """
+        第 attempt 次重试之前等待的秒数
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * (1 << attempt)))
+        retry_after = None if response is None else self.retry_after(response)
+        return delay if retry_after is None else max(delay, retry_after)
+
+    @staticmethod
+    def retry_after(response):
+        """
+        响应的 Retry-After 换算成从现在开始还要等的秒数，可以是秒数也可以是HTTP日期，没有或者不合法的时候返回None
+        """
+        retry_after = response.headers.get(fs.Retry_After)
+        if not retry_after:
+            return None
+        retry_after = retry_after.strip()
+        if retry_after.isdigit():
+            return int(retry_after)
+        at = HTTPCache.http_date(retry_after)
+        return None if at is None else max(at - time.time(), 0)
+
+
+class HostQueue:
+    """
+    Scheduler 里面一个主机的状态：令牌桶、在途请求数、按优先级排好的等待队列、限流的降速系数和排队时间的统计
+    """
+
+    def __init__(self, lock, rate, burst, max_in_flight, buckets):
+        self.cond = threading.Condition(lock)   # 所有主机共用一把锁，每个主机各自唤醒自己的等待者
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.tokens = burst
+        self.refilled = time.monotonic()
+
+        self.factor = 1.0                       # 降速系数，速率和在途上限都乘上它
+        self.slowed_at = 0.0
+        self.paused_until = 0.0                 # Retry-After 要求暂停到什么时候（time.monotonic）
+
+        self.in_flight = 0
+        self.waiting = []                       # 堆，(优先级, 序号)，序号保证同一优先级先来先发
+        self.async_waiters = []                 # 等待的协程，[(事件循环, Future)]，见 Scheduler.acquire_async
+        self.granted = 0
+        self.throttled = 0
+        self.buckets = buckets
+        self.waits = [0] * (buckets.__len__() + 1) + [0.0]     # 和 Metrics.observe 一样，最后一个是总和
+        self.max_wait = 0.0
+
+    def limit(self, rank=0, reserved=0):
+        """
+        当前的在途上限，低优先级（rank >= 2）的请求要给更高优先级的留出 reserved 个名额
+        """
+        if self.max_in_flight is None:
+            return None
+        limit = max(1, int(self.max_in_flight * self.factor))
+        return max(1, limit - reserved) if rank >= 2 else limit
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate * self.factor)
+        self.refilled = now
+
+    def ready_in(self, now, rank, reserved):
+        """
+        排在最前面的请求还要等多少秒，0 表示现在就能发，None 表示要等在途的请求完成
+        """
+        if now < self.paused_until:
+            return self.paused_until - now
+        limit = self.limit(rank, reserved)
+        if limit is not None and self.in_flight >= limit:
+            return None
+        if self.rate is not None and self.tokens < 1:
+            return (1 - self.tokens) / (self.rate * self.factor)
+        return 0
+
+    def record_wait(self, seconds):
+        self.granted += 1
+        self.waits[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.waits[-1] += seconds
+        self.max_wait = max(self.max_wait, seconds)
+
+
+class Scheduler:
+    """
+    放在 Session.send 前面的按主机调度，Session(scheduler=Scheduler(...)) 开启，默认不调度，请求直接在调用者的线程里发出
+
+    - rate/burst：每个主机的令牌桶，每秒最多 rate 个请求，最多攒 burst 个，rate 为None不限速
+    - max_in_flight：每个主机同时在途的请求数上限（流式响应读完主体才算完成），None 不限制
+    - hosts：按主机单独设置，{"api.example.com": {"rate": 5, "burst": 5, "max_in_flight": 2}}，没写的用上面的默认值
+    - 优先级：get/post 等方法传 priority="interactive"/"default"/"background"（或者整数，越小越优先），
+      同一个主机的等待队列按优先级排，interactive 插到 background 前面；background 的请求最多只用到
+      max_in_flight - reserved 个名额，留出来的名额让后到的高优先级请求不用等 background 的请求完成
+    - 自适应降速：响应的状态码在 statuses 里面（429/503）的时候，这个主机的速率和在途上限乘以 decrease，
+      cooldown 秒内只降一次（同时在途的一批请求一起被拒绝不会连降好几次），最低降到 min_factor；
+      之后每个正常的响应加回 increase，直到恢复原样；带了 Retry-After 的话这个主机暂停发送到那个时候（最多 max_pause 秒）
+    - max_wait：在队列里最多等多少秒，超过抛出 socket.timeout，None 一直等
+    Session 的每一次发送（包括重试、对冲和 Session.pipeline 里的每个请求）都要先排队；
+    AsyncSession(scheduler=...) 用 acquire_async 排队，同一个 Scheduler 可以同时给线程和协程用
+    排队时间记在 Timings.queue，按主机的汇总见 stats()，也会出现在 Session.metrics 的 snapshot 里面
+    """
+
+    priorities = {"interactive": 0, "default": 1, "background": 2}
+    buckets = Metrics.buckets
+
+    def __init__(self, rate=None, burst=1, max_in_flight=10, hosts=None, reserved=1, statuses=("429", "503"),
+                 decrease=0.5, increase=0.05, min_factor=0.05, cooldown=1.0, max_pause=300, max_wait=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.hosts = dict(hosts or {})
+        self.reserved = reserved
+        self.statuses = tuple(str(x) for x in statuses)
+        self.decrease = decrease
+        self.increase = increase
+        self.min_factor = min_factor
+        self.cooldown = cooldown
+        self.max_pause = max_pause
+        self.max_wait = max_wait
+
+        self.queues = {}                        # host -> HostQueue
+        self.lock = threading.Lock()
+        self.seq = itertools.count()
+
+    def _queue(self, host):
+        queue = self.queues.get(host)
+        if queue is None:
+            config = self.hosts.get(host, {})
+            queue = self.queues[host] = HostQueue(self.lock, config.get("rate", self.rate),
+                                                  config.get("burst", self.burst),
+                                                  config.get("max_in_flight", self.max_in_flight), self.buckets)
+        return queue
+
+    def rank(self, priority):
+        if priority is None:
+            return self.priorities["default"]
+        if isinstance(priority, str):
+            return self.priorities[priority]
+        return priority
+
+    def acquire(self, host, priority=None, timings=None, block=True):
+        """
+        排队直到这个主机允许再发一个请求，返回排队的秒数；之后必须调用 release 还回名额
+        block 为False的时候不排队，现在不能马上发就返回None（Pipeline 手里还有没收完的响应，不能干等）
+        """
+        start = time.monotonic()
+        with self.lock:
+            queue = self._queue(host)
+            entry = (self.rank(priority), next(self.seq))
+            heapq.heappush(queue.waiting, entry)
+            try:
+                while True:
+                    waited, wait = self._attempt(host, queue, entry, start)
+                    if waited is not None:
+                        break
+                    if not block:
+                        self._leave(queue, entry)
+                        return None
+                    queue.cond.wait(wait)
+            except BaseException:
+                self._leave(queue, entry)
+                raise
+        if timings is not None:
+            timings.queue = waited
+            timings.scheduled = True
+        return waited
+
+    async def acquire_async(self, loop, host, priority=None, timings=None):
+        """
+        acquire 的协程版本，给 AsyncSession 用，排队的时候不阻塞事件循环，loop 是当前正在运行的事件循环
+        和线程共用同一个队列：release 的时候（不管在哪个线程）通过 call_soon_threadsafe 唤醒等待的协程
+        """
+        start = time.monotonic()
+        with self.lock:
+            queue = self._queue(host)
+            entry = (self.rank(priority), next(self.seq))
+            heapq.heappush(queue.waiting, entry)
+        try:
+            while True:
+                with self.lock:
+                    waited, wait = self._attempt(host, queue, entry, start)
+                    if waited is not None:
+                        break
+                    future = loop.create_future()
+                    queue.async_waiters.append((loop, future))
+                timer = None if wait is None else loop.call_later(wait, self._wake, future)
+                try:
+                    await future
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                    with self.lock:
+                        if (loop, future) in queue.async_waiters:
+                            queue.async_waiters.remove((loop, future))
+        except BaseException:
+            with self.lock:
+                self._leave(queue, entry)
+            raise
+        if timings is not None:
+            timings.queue = waited
+            timings.scheduled = True
+        return waited
+
+    def _attempt(self, host, queue, entry, start):
+        """
+        在锁里面调用：entry 排在最前面并且现在就能发的话拿走名额，返回 (排队的秒数, None)；
+        否则返回 (None, 最多等多少秒)，None 表示要等在途的请求完成
+        """
+        now = time.monotonic()
+        queue.refill(now)
+        wait = queue.ready_in(now, entry[0], self.reserved) if queue.waiting[0] == entry else None
+        if wait == 0:
+            heapq.heappop(queue.waiting)
+            if queue.rate is not None:
+                queue.tokens -= 1
+            queue.in_flight += 1
+            queue.record_wait(now - start)
+            # 名额可能不止一个，让下一个排在最前面的请求也检查一下
+            self._notify(queue)
+            return now - start, None
+        if self.max_wait is not None:
+            remaining = start + self.max_wait - now
+            if remaining <= 0:
+                raise socket.timeout("在 %s 的调度队列里等待超过了%s秒!" % (host, self.max_wait))
+            wait = remaining if wait is None else min(wait, remaining)
+        return None, wait
+
+    def _leave(self, queue, entry):
+        queue.waiting.remove(entry)
+        heapq.heapify(queue.waiting)
+        self._notify(queue)
+
+    def _notify(self, queue):
+        """
+        在锁里面调用，唤醒这个主机所有等待的线程和协程，让它们重新检查
+        """
+        queue.cond.notify_all()
+        for loop, future in queue.async_waiters:
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:
+                pass                            # 事件循环已经关闭
+        queue.async_waiters.clear()
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def release(self, host, timings=None, response=None):
+        """
+        请求完成（或者出错），还回在途名额；传了响应的话按状态码和 Retry-After 调整这个主机的速度
+        同一个 timings 只会还一次
+        """
+        if timings is not None:
+            if not timings.scheduled:
+                return
+            timings.scheduled = False
+        with self.lock:
+            queue = self._queue(host)
+            queue.in_flight -= 1
+            if response is not None:
+                now = time.monotonic()
+                if response.status_line.status_code in self.statuses:
+                    queue.throttled += 1
+                    if now - queue.slowed_at >= self.cooldown:
+                        queue.factor = max(self.min_factor, queue.factor * self.decrease)
+                        queue.slowed_at = now
+                        logger.debug("%s 返回了 %s，降速到 %.2f", host, response.status_line.status_code,
+                                     queue.factor)
+                    pause = RetryPolicy.retry_after(response)
+                    if pause:
+                        queue.paused_until = max(queue.paused_until, now + min(pause, self.max_pause))
+                else:
+                    queue.factor = min(1.0, queue.factor + self.increase)
+            self._notify(queue)
+
+    @staticmethod
+    def _quantile(buckets, q, upper):
+        # 桶里线性插值出来的值可能比实际等过的最长时间还大
+        value = Metrics._quantile(buckets, q)
+        return None if value is None else min(value, upper)
+
+    def stats(self):
+        """
+        按主机的调度状态：{host: {"queued", "in_flight", "limit", "rate", "factor", "paused", "granted", "throttled",
+                                  "wait": {"count", "sum", "max", "p50", "p99"}}}，rate 是降速之后的速率
+        """
+        now = time.monotonic()
+        result = {}
+        with self.lock:
+            for host, queue in self.queues.items():
+                cumulative, buckets = 0, []
+                for bound, n in zip(self.buckets + (float("inf"),), queue.waits):
+                    cumulative += n
+                    buckets.append([bound, cumulative])
+                result[host] = {
+                    "queued": queue.waiting.__len__(),
+                    "in_flight": queue.in_flight,
+                    "limit": queue.limit(),
+                    "rate": None if queue.rate is None else queue.rate * queue.factor,
+                    "factor": queue.factor,
+                    "paused": max(queue.paused_until - now, 0),
+                    "granted": queue.granted,
+                    "throttled": queue.throttled,
+                    "wait": {"count": queue.granted, "sum": queue.waits[-1], "max": queue.max_wait,
+                             "p50": self._quantile(buckets, 0.5, queue.max_wait),
+                             "p99": self._quantile(buckets, 0.99, queue.max_wait)},
+                }
+        return result
+
+
+class Connector:
+    """
+    建立TCP连接，实现 RFC 8305 Happy Eyeballs：
+
+    - 域名解析出来的全部地址都会尝试，IPv6 和 IPv4 交替排列
+    - 每隔 attempt_delay 秒发起下一个地址的连接，不等上一个超时；某个地址连接失败的话马上尝试下一个
+    - 哪个地址先连上就用哪个，其余正在进行的尝试全部关掉
+    - 连接失败的地址记住 failure_ttl 秒，这段时间里排到最后面，后续请求不会再先去连它
+    """
+
+    def __init__(self, attempt_delay=0.25, failure_ttl=30):
+        self.attempt_delay = attempt_delay
+        self.failure_ttl = failure_ttl
+        self.failures = {}                      # (ip, port) -> 失败记录的过期时间
+        self.lock = threading.Lock()
+
+    def connect(self, addresses, port, timeout=None):
+        """
+        addresses 是 [(family, ip), ...]，返回连接成功的阻塞套接字
+        timeout 是所有地址加起来的总超时，超时抛出 socket.timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pending = self.order(addresses, port)
+        attempts = {}                           # socket -> (family, ip)
+        error = None
+        next_start = time.monotonic()
+        # 不用 select.select：文件描述符超过1024（FD_SETSIZE）的时候它直接抛 ValueError，繁忙的进程里所有连接都会失败
+        selector = selectors.DefaultSelector()
+
+        try:
+            while True:
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    raise socket.timeout("连接超时!")
+
+                # 到时间了或者当前没有正在进行的尝试，就发起下一个地址的连接
+                if pending and (now >= next_start or not attempts):
+                    family, ip = pending.pop(0)
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    err = sock.connect_ex((ip, port))
+                    if err == 0:
+                        return self._won(sock, ip, port, attempts)
+                    if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                        attempts[sock] = (family, ip)
+                        selector.register(sock, selectors.EVENT_WRITE)
+                        next_start = now + self.attempt_delay
+                    else:
+                        sock.close()
+                        error = OSError(err, os.strerror(err))
+                        self.mark_failed(ip, port)
+                    continue
+
+                if not attempts:
+                    raise error if error is not None else OSError("没有可以连接的地址!")
+
+                wait_until = deadline
+                if pending:
+                    wait_until = next_start if deadline is None else min(next_start, deadline)
+                wait = None if wait_until is None else max(wait_until - now, 0)
+                events = selector.select(wait)
+
+                for selector_key, _ in events:
+                    sock = selector_key.fileobj
+                    selector.unregister(sock)
+                    family, ip = attempts.pop(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        return self._won(sock, ip, port, attempts)
+                    sock.close()
+                    error = OSError(err, os.strerror(err))
+                    self.mark_failed(ip, port)
+                    next_start = time.monotonic()          # 失败了就马上试下一个，不用等
+        except BaseException:
+            for sock in attempts:
+                sock.close()
+            raise
+        finally:
+            selector.close()
+
+    def order(self, addresses, port):
+        """
+        IPv6 和 IPv4 交替排列，最近连接失败过的地址排到最后面
+        """
+        now = time.monotonic()
+        with self.lock:
+            for key in [k for k, v in self.failures.items() if v <= now]:
+                del self.failures[key]
+            failed = set(self.failures)
+
+        good = [x for x in addresses if (x[1], port) not in failed]
+        bad = [x for x in addresses if (x[1], port) in failed]
+        rtn = []
+        for group in (good, bad):
+            v6 = [x for x in group if x[0] == socket.AF_INET6]
+            v4 = [x for x in group if x[0] != socket.AF_INET6]
+            for i in range(max(v6.__len__(), v4.__len__())):
+                rtn.extend(v6[i:i + 1] + v4[i:i + 1])
+        return rtn
+
+    def mark_failed(self, ip, port):
+        with self.lock:
+            self.failures[(ip, port)] = time.monotonic() + self.failure_ttl
+
+    def _won(self, sock, ip, port, attempts):
+        for other in attempts:
+            other.close()
+        attempts.clear()
+        with self.lock:
+            self.failures.pop((ip, port), None)
+        sock.setblocking(True)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+
+class TLSConfig:
+    """
+    TLS配置，SSLContext 只在第一次用到的时候创建一次，之后所有连接共用
+    创建 SSLContext 要加载系统的CA证书，开销很大，不能每个连接都创建一次
+
+    - verify：是否校验服务端证书；也可以传一个CA证书文件的路径
+    - ciphers：OpenSSL 格式的密码套件字符串
+    - alpn：ALPN 协商的协议列表
+    - cert / key / password：客户端证书
+    - session_cache_size：每个 (host, port) 保存最近一次的 SSLSession，新连接用它做会话恢复（简化握手），最多保存这么多个
+    """
+
+    def __init__(self, verify=True, ciphers=None, alpn=("http/1.1",), cert=None, key=None, password=None,
+                 minimum_version=None, session_cache_size=256):
+        self.verify = verify
+        self.ciphers = ciphers
+        self.alpn = alpn
+        self.cert = cert
+        self.key = key
+        self.password = password
+        self.minimum_version = minimum_version
+        self.session_cache_size = session_cache_size
+
+        self._context = None
+        self.sessions = OrderedDict()           # (host, port) -> ssl.SSLSession
+        self.lock = threading.Lock()
+
+    # 没有自定义配置的 Session 共用这一份，整个进程只加载一次CA证书；开启HTTP/2的 Session 共用另一份，ALPN 优先协商 h2
+    shared = None
+    shared_h2 = None
+
+    @classmethod
+    def default(cls, http2=False):
+        if http2:
+            if cls.shared_h2 is None:
+                cls.shared_h2 = cls(alpn=("h2", "http/1.1"))
+            return cls.shared_h2
+        if cls.shared is None:
+            cls.shared = cls()
+        return cls.shared
+
+    def context(self):
+        if self._context is not None:
+            return self._context
+        with self.lock:
+            if self._context is None:
+                self._context = self.build_context()
+        return self._context
+
+    def build_context(self):
+        if isinstance(self.verify, str):
+            context = ssl.create_default_context(cafile=self.verify)
+        else:
+            context = ssl.create_default_context()
+            if not self.verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+        if self.ciphers:
+            context.set_ciphers(self.ciphers)
+        if self.alpn:
+            context.set_alpn_protocols(list(self.alpn))
+        if self.cert:
+            context.load_cert_chain(self.cert, self.key, self.password)
+        if self.minimum_version is not None:
+            context.minimum_version = self.minimum_version
+        return context
+
+    def wrap(self, sock, host, port):
+        """
+        TLS握手，有之前保存的会话的话带上它尝试会话恢复
+        返回 (ssl套接字, 握手耗时)
+        """
+        with self.lock:
+            session = self.sessions.get((host, port))
+        start = time.perf_counter()
+        try:
+            tls_sock = self.context().wrap_socket(sock, server_hostname=host, session=session)
+        except ssl.SSLError:
+            # 握手失败的时候丢掉保存的会话，下一次连接重新完整握手
+            with self.lock:
+                self.sessions.pop((host, port), None)
+            raise
+        elapsed = time.perf_counter() - start
+        self.save_session(tls_sock, host, port)
+        return tls_sock, elapsed
+
+    def save_session(self, sock, host, port):
+        """
+        TLS 1.3 的会话票据是握手之后才发过来的，所以收完响应之后还要再保存一次
+        """
+        session = getattr(sock, "session", None)
+        if session is None or not self.session_cache_size:
+            return
+        with self.lock:
+            self.sessions[(host, port)] = session
+            self.sessions.move_to_end((host, port))
+            while self.sessions.__len__() > self.session_cache_size:
+                self.sessions.popitem(last=False)
+
+
+class ConnectionPool:
+    """
+    按 (protocol, host, port) 分组保存空闲连接，所有操作都在锁里面完成，多个线程可以共用一个连接池
+
+    - max_per_host：每个主机最多同时打开多少个连接，空闲的和使用中的加在一起算
+    - max_total：所有主机加起来最多同时打开多少个连接，超出时按最久未使用（LRU）的顺序关闭空闲连接
+    - idle_timeout：空闲连接的最长保留时间，秒
+    - wait_timeout：连接数达到上限时，等待其他线程归还连接的最长时间，None表示一直等
+    """
+
+    def __init__(self, max_per_host=10, max_total=100, idle_timeout=60, wait_timeout=None, timeout=None, tls=None):
+        self.max_per_host = max_per_host
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+
+        self.idle = {}                          # key -> deque[Connection]，同一主机内后进先出，优先用最热的连接
+        self.lru = OrderedDict()                # Connection -> None，所有空闲连接按归还时间排序，用于LRU淘汰
+        self.in_use = {}                        # key -> 正在使用中（包括正在建立）的连接数
+        self.active = 0                         # 所有主机正在使用中的连接数
+        self.lock = threading.Condition()
+
+        # 统计，Metrics 导出用
+        self.created = 0                        # 预留名额新建的连接数
+        self.reused = 0                         # 取出空闲连接复用的次数
+        self.waits = 0                          # 连接数到达上限、等其他线程归还连接的次数
+        self.wait_time = 0.0                    # 累计等待的秒数
+
+    def __len__(self):
+        return self.lru.__len__() + self.active
+
+    def count(self, key):
+        return self.idle.get(key, ()).__len__() + self.in_use.get(key, 0)
+
+    def get(self, key, block=True, reuse=True):
+        """
+        取出一个可以复用的空闲连接；没有的话（或者reuse为False）预留一个名额并返回None，由调用者自己新建连接
+        新建成功之后不需要再登记，新建失败要调用 cancel 把名额还回来
+        正在使用的连接数达到上限的时候，block为True就等待其他线程归还连接；
+        block为False的时候不等待，也不检查 max_per_host/max_total，总是预留名额（只会按上限关掉多出来的空闲连接），
+        在途连接数由调用者自己限制：AsyncSession 用按主机的信号量（pool.max_per_host）和全局的信号量（pool.max_total），
+        Session.h2_connection 只是把已经建好的连接登记进来、马上 release
+        取的过程中顺便把过期的、已经被对端断开的连接关掉
+        """
+        deadline = None if self.wait_timeout is None else time.monotonic() + self.wait_timeout
+        with self.lock:
+            while True:
+                conn = self._pop_idle(key) if reuse else None
+                if conn is not None:
+                    self._checkout(key)
+                    self.reused += 1
+                    return conn
+                if not block or (self.in_use.get(key, 0) < self.max_per_host and self.active < self.max_total):
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Exception("等待空闲连接超时!")
+                start = time.monotonic()
+                self.waits += 1
+                self.lock.wait(remaining)
+                self.wait_time += time.monotonic() - start
+
+            # 新建连接之前，先关掉这个主机最旧的空闲连接（reuse 为False的时候还有），再按LRU关掉一些空闲连接腾出位置
+            while self.idle.get(key) and self.count(key) >= self.max_per_host:
+                self._evict_idle(key)
+            while self.__len__() >= self.max_total and self.lru:
+                self._evict_lru()
+            self._checkout(key)
+            self.created += 1
+            return None
+
+    def cancel(self, key):
+        """
+        get 预留了名额但是连接没有建立起来
+        """
+        with self.lock:
+            self._checkin(key)
+
+    def release(self, conn):
+        """
+        请求处理完毕之后把连接还回来，不能复用的直接关闭
+        """
+        with self.lock:
+            self._checkin(conn.key)
+
+            if not conn.reusable or conn.socket is None or conn.expired(self.idle_timeout):
+                conn.close()
+                return
+
+            conn.last_used = time.monotonic()
+            self.idle.setdefault(conn.key, deque()).append(conn)
+            self.lru[conn] = None
+
+            while self.idle.get(conn.key) and self.count(conn.key) > self.max_per_host:
+                self._evict_idle(conn.key)
+            while self.__len__() > self.max_total and self.lru:
+                self._evict_lru()
+
+    def discard(self, conn):
+        """
+        出错的连接，关闭并从使用中的计数里面去掉
+        """
+        conn.reusable = False
+        self.release(conn)
+
+    def prune(self):
+        """
+        主动清理所有过期的空闲连接
+        """
+        now = time.monotonic()
+        with self.lock:
+            for conn in [c for c in self.lru if c.expired(self.idle_timeout, now)]:
+                self._remove_idle(conn)
+                conn.close()
+
+    def close(self):
+        with self.lock:
+            for conn in list(self.lru):
+                conn.close()
+            self.idle.clear()
+            self.lru.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": self.__len__(), "idle": self.lru.__len__(), "active": self.active,
+                    "hosts": (self.idle.keys() | self.in_use.keys()).__len__(), "created": self.created,
+                    "reused": self.reused, "waits": self.waits, "wait_time": self.wait_time}
+
+    def _pop_idle(self, key):
+        conns = self.idle.get(key)
+        now = time.monotonic()
+        while conns:
+            conn = conns.pop()
+            self.lru.pop(conn, None)
+            if conn.expired(self.idle_timeout, now) or conn.is_dropped():
+                conn.close()
+                continue
+            return conn
+        return None
+
+    def _checkout(self, key):
+        self.in_use[key] = self.in_use.get(key, 0) + 1
+        self.active += 1
+
+    def _checkin(self, key):
+        if self.in_use.get(key, 0) > 1:
+            self.in_use[key] -= 1
+        else:
+            self.in_use.pop(key, None)
+        self.active = max(self.active - 1, 0)
+        self.lock.notify_all()
+
+    def _remove_idle(self, conn):
+        self.lru.pop(conn, None)
+        conns = self.idle.get(conn.key)
+        if conns is not None:
+            try:
+                conns.remove(conn)
+            except ValueError:
+                pass
+            if not conns:
+                del self.idle[conn.key]
+
+    def _evict_idle(self, key):
+        """
+        关掉这个主机最久没用过的空闲连接
+        """
+        conn = self.idle[key][0]
+        self._remove_idle(conn)
+        conn.close()
+
+    def _evict_lru(self):
+        conn, _ = self.lru.popitem(last=False)
+        self._remove_idle(conn)
+        conn.close()
+
+
+class CacheEntry:
+    """
+    缓存里面的一条响应，同一个URL按 Vary 指定的请求首部可以有多个变体，每个变体一条
+    """
+
+    def __init__(self, method, status_line, headers, body, vary, request_time, response_time):
+        self.method = method
+        self.status_line = status_line
+        self.headers = headers
+        self.body = body                        # bytes，或者磁盘缓存文件的 mmap
+        self.vary = vary                        # Vary 里面每个首部（小写）在请求里的值，请求没带的是None
+        self.request_time = request_time
+        self.response_time = response_time
+        self.name = None                        # 磁盘缓存的主体文件名
+
+    @property
+    def size(self):
+        # mmap 的主体在页缓存里面，不占进程的内存，不计入内存缓存的大小
+        return 0 if isinstance(self.body, mmap.mmap) else self.body.__len__()
+
+
+class HTTPCache:
+    """
+    RFC7234 响应缓存，Session(cache=HTTPCache()) 开启，默认不缓存
+
+    - 只缓存完整接收的 GET/HEAD 响应，流式响应不缓存，但命中缓存的时候 stream=True 一样返回缓存
+    - 新鲜度按 Cache-Control 的 max-age、Expires、Age 计算，都没有的话按 Last-Modified 估算（距今时间的10%，最多一天）
+    - 按 Vary 指定的请求首部区分变体，Vary: * 不缓存
+    - 过期的响应带着 If-None-Match/If-Modified-Since 重新验证，304 的时候直接用缓存的主体
+    - 内存里按最近使用的顺序最多保存 max_entries 条、max_size 字节的主体
+    - 指定 directory 的时候同时写到磁盘，主体用 mmap 读取，进程重启之后缓存仍然有效
+    - POST/PUT/DELETE 等请求成功之后，同一个URL的缓存作废
+    """
+
+    cacheable_codes = ("200", "203", "204", "300", "301", "308", "404", "405", "410", "414", "501")
+    unsafe_methods = ("POST", "PUT", "DELETE", "PATCH")
+    max_heuristic = 86400                       # 按 Last-Modified 估算的新鲜期最长一天
+
+    def __init__(self, max_entries=1024, max_size=64 << 20, directory=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.directory = directory
+        self.entries = OrderedDict()            # URL -> [CacheEntry, ...]
+        self.count = 0
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0                           # 直接返回缓存的次数
+        self.revalidated = 0                    # 304 之后返回缓存的次数
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return self.count
+
+    def fetch(self, request):
+        """
+        发送之前查缓存，返回 (response, entry)
+        有新鲜的缓存时 response 就是缓存的响应，不用再发送了
+        缓存过期但是可以验证的时候返回 entry，并且在请求里面加上条件首部
+        """
+        method = request.request_line.method
+        if method not in ("GET", "HEAD") or fs.Range in request.headers:
+            # 范围请求不从缓存里面取，分段下载要的是 206
+            return None, None
+        cc = self.cache_control(request.headers.get(fs.Cache_Control))
+        if "no-store" in cc:
+            return None, None
+
+        url = self.url(request)
+        with self.lock:
+            entry = self._match(url, request)
+            if entry is None:
+                self.misses += 1
+                return None, None
+
+            no_cache = "no-cache" in cc or (request.headers.get(fs.Pragma) or "").lower() == "no-cache"
+            if not no_cache and self._fresh(entry, cc):
+                self.hits += 1
+                self.entries.move_to_end(url)
+                return self.response(entry, method), None
+
+        # 用户自己带了条件首部的话，304 原样返回给用户
+        if any(request.headers.get(x) is not None for x in (fs.If_None_Match, fs.If_Modified_Since)):
+            return None, None
+        etag = entry.headers.get(fs.ETag)
+        last_modified = entry.headers.get(fs.Last_Modified)
+        if etag is None and last_modified is None:
+            return None, None
+        if etag is not None:
+            request.headers[fs.If_None_Match] = etag
+        if last_modified is not None:
+            request.headers[fs.If_Modified_Since] = last_modified
+        return None, entry
+
+    def update(self, request, response, entry=None, request_time=None):
+        """
+        收到响应之后更新缓存，返回最终交给用户的响应
+        entry 是 fetch 返回的待验证条目，收到 304 的时候更新它的首部并返回缓存的主体
+        """
+        method = request.request_line.method
+        code = response.status_line.status_code
+        url = self.url(request)
+        response_time = time.time()
+        request_time = request_time or response_time
+
+        if method in self.unsafe_methods:
+            if code[:1] in ("2", "3"):
+                self.invalidate(url)
+            return response
+
+        if entry is not None and code == "304":
+            with self.lock:
+                for k in response.headers:
+                    if k.lower() not in ("content-length", "content-encoding", "transfer-encoding", "set-cookie"):
+                        entry.headers[k] = response.headers[k]
+                entry.request_time, entry.response_time = request_time, response_time
+                self.revalidated += 1
+                if self.directory is not None and url in self.entries:
+                    self._save_meta(url)
+                return self.response(entry, method)
+
+        if self.storable(request, response):
+            self.store(url, request, response, request_time, response_time)
+        return response
+
+    def storable(self, request, response):
+        code = response.status_line.status_code
+        if response.raw is not None or response.complete is False or code in ("206", "304") or code[:1] == "1":
+            return False
+        if "no-store" in self.cache_control(request.headers.get(fs.Cache_Control)):
+            return False
+        cc = self.cache_control(response.headers.get(fs.Cache_Control))
+        if "no-store" in cc or (response.headers.get(fs.Vary) or "").strip() == "*":
+            return False
+        explicit = "max-age" in cc or response.headers.get(fs.Expires) is not None
+        if code not in self.cacheable_codes and not explicit:
+            return False
+        # 既没有新鲜期也没有验证器的响应存下来也用不上
+        return explicit or response.headers.get(fs.ETag) is not None \
+            or response.headers.get(fs.Last_Modified) is not None
+
+    def store(self, url, request, response, request_time, response_time):
+        headers = response.headers.copy()
+        headers.pop(fs.Set_Cookie, None)
+        names = [x.strip().lower() for x in (headers.get(fs.Vary) or "").split(",") if x.strip()]
+        vary = {name: request.headers.get(name) for name in names}
+        method = request.request_line.method
+        body = response.body.bytes() if method == "GET" else b""
+        entry = CacheEntry(method, (response.status_line.http_version, response.status_line.status_code,
+                                    response.status_line.reason_phrase),
+                           headers, body, vary, request_time, response_time)
+
+        with self.lock:
+            variants = self._variants(url) or []
+            for old in [x for x in variants if x.vary == vary and x.method == method]:
+                variants.remove(old)
+                self._forget(old)
+            if self.directory is not None:
+                self._save_body(url, entry)
+            variants.append(entry)
+            self.entries[url] = variants
+            self.entries.move_to_end(url)
+            self.count += 1
+            self.size += entry.size
+            if self.directory is not None:
+                self._save_meta(url)
+            self._evict()
+
+    def invalidate(self, url=None):
+        """
+        作废某个URL（不传就是全部）的缓存，磁盘上的也一起删除
+        """
+        with self.lock:
+            if url is None:
+                self.entries.clear()
+                self.count = self.size = 0
+                if self.directory is not None:
+                    for name in os.listdir(self.directory):
+                        os.remove(os.path.join(self.directory, name))
+                return
+
+            variants = self.entries.pop(url, None)
+            for entry in variants or ():
+                self._forget(entry)
+            if self.directory is not None:
+                for entry in variants or self._load(url) or ():
+                    self._remove(entry.name)
+                self._remove(os.path.basename(self._path(url, ".meta")))
+
+    def response(self, entry, method="GET"):
+        """
+        用缓存条目构造一个新的 Response，主体直接引用缓存的数据，不拷贝
+        """
+        response = Response()
+        response.status_line.http_version, response.status_line.status_code, response.status_line.reason_phrase = \
+            entry.status_line
+        response.headers = entry.headers.copy()
+        response.headers[fs.Age] = str(int(self.current_age(entry)))
+        if method == "GET":
+            response.body.parse(memoryview(entry.body) if isinstance(entry.body, mmap.mmap) else entry.body)
+        response.from_cache = True
+        response.complete = True
+        return response
+
+    @staticmethod
+    def url(request):
+        info = request.conn_info
+        return "%s://%s:%s%s" % (info["protocol"], info["host"], info["port"], request.request_line.request_uri)
+
+    @staticmethod
+    def cache_control(value):
+        """
+        把 Cache-Control 解析成字典，比如 "max-age=60, no-cache" -> {"max-age": "60", "no-cache": None}
+        """
+        directives = {}
+        for item in (value or "").split(","):
+            name, eq, arg = item.strip().partition("=")
+            if name:
+                directives[name.lower()] = arg.strip().strip('"') if eq else None
+        return directives
+
+    @staticmethod
+    def http_date(value):
+        try:
+            return email.utils.parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    def freshness_lifetime(self, entry):
+        """
+        RFC7234 Section 4.2.1
+        """
+        headers = entry.headers
+        cc = self.cache_control(headers.get(fs.Cache_Control))
+        if "max-age" in cc:
+            return self._seconds(cc["max-age"])
+        date = self.http_date(headers.get(fs.Date)) or entry.response_time
+        expires = headers.get(fs.Expires)
+        if expires is not None:
+            expires = self.http_date(expires)
+            return 0 if expires is None else max(expires - date, 0)
+        last_modified = self.http_date(headers.get(fs.Last_Modified))
+        if last_modified is not None and entry.status_line[1] in self.cacheable_codes:
+            return min(max(date - last_modified, 0) * 0.1, self.max_heuristic)
+        return 0
+
+    def current_age(self, entry, now=None):
+        """
+        RFC7234 Section 4.2.3
+        """
+        now = now or time.time()
+        date = self.http_date(entry.headers.get(fs.Date)) or entry.response_time
+        apparent_age = max(0, entry.response_time - date)
+        age_value = self._seconds(entry.headers.get(fs.Age) or "0")
+        corrected_age_value = age_value + (entry.response_time - entry.request_time)
+        return max(apparent_age, corrected_age_value) + (now - entry.response_time)
+
+    def _fresh(self, entry, request_cc):
+        if "no-cache" in self.cache_control(entry.headers.get(fs.Cache_Control)):
+            return False
+        lifetime = self.freshness_lifetime(entry)
+        if "max-age" in request_cc:
+            lifetime = min(lifetime, self._seconds(request_cc["max-age"]))
+        age = self.current_age(entry)
+        if "min-fresh" in request_cc:
+            age += self._seconds(request_cc["min-fresh"])
+        return lifetime > age
+
+    def _variants(self, url):
+        """
+        取出一个URL的所有变体，内存里面没有的话再去磁盘上找
+        """
+        variants = self.entries.get(url)
+        if variants is None:
+            variants = self._load(url)
+            if not variants:
+                return None
+            self.entries[url] = variants
+            self.count += variants.__len__()
+            self.size += sum(x.size for x in variants)
+        return variants
+
+    def _match(self, url, request):
+        variants = self._variants(url)
+        if variants is None:
+            return None
+        self._evict()
+        method = request.request_line.method
+        for entry in reversed(variants):
+            if method != "HEAD" and entry.method != method:
+                continue
+            if all(request.headers.get(k) == v for k, v in entry.vary.items()):
+                return entry
+        return None
+
+    def _evict(self):
+        """
+        超出数量或者大小的时候，从最久没用过的URL开始淘汰，磁盘上的文件保留
+        """
+        while self.entries.__len__() > 1 and (self.count > self.max_entries or self.size > self.max_size):
+            _, variants = self.entries.popitem(last=False)
+            for entry in variants:
+                self._forget(entry)
+
+    def _forget(self, entry):
+        self.count -= 1
+        self.size -= entry.size
+
+    @staticmethod
+    def _seconds(value):
+        try:
+            return max(int(value), 0)
+        except (TypeError, ValueError):
+            return 0
+
+    # 下面是磁盘缓存：每个URL一个 .meta 文件保存所有变体的首部，每个变体的主体单独一个文件
+    def _path(self, url, suffix):
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest() + suffix)
+
+    def _save_body(self, url, entry):
+        key = repr((entry.method, sorted(entry.vary.items(), key=lambda x: x[0]))).encode()
+        entry.name = os.path.basename(self._path(url, "-" + hashlib.sha1(key).hexdigest()[:16] + ".body"))
+        path = os.path.join(self.directory, entry.name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(entry.body)
+        os.replace(path + ".tmp", path)
+        entry.body = self._map(path)
+
+    def _save_meta(self, url):
+        meta = [{
+            "method": x.method, "status_line": x.status_line, "headers": list(x.headers.multi_items()), "vary": x.vary,
+            "request_time": x.request_time, "response_time": x.response_time, "name": x.name,
+        } for x in self.entries.get(url, ())]
+        path = self._path(url, ".meta")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"url": url, "variants": meta}, f)
+        os.replace(path + ".tmp", path)
+
+    def _load(self, url):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(url, ".meta")) as f:
+                meta = json.load(f)
+            if meta["url"] != url:
+                return None
+            variants = []
+            for x in meta["variants"]:
+                entry = CacheEntry(x["method"], tuple(x["status_line"]), self._headers(x["headers"]),
+                                   self._map(os.path.join(self.directory, x["name"])), x["vary"],
+                                   x["request_time"], x["response_time"])
+                entry.name = x["name"]
+                variants.append(entry)
+            return variants
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def _headers(items):
+        headers = Headers()
+        for k, v in items:
+            headers.add(k, v)
+        return headers
+
+    @staticmethod
+    def _map(path):
+        with open(path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except (OSError, TypeError):
+            pass
+
+
+class RedirectCache:
+    """
+    301/308 永久跳转的缓存：原来的URL -> (跳转后的URL, 状态码)，按最近使用淘汰，最多 max_size 条
+    Session 发请求之前先查这里，已知搬走了的地址直接请求新地址，不用每次都多一次往返
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def __len__(self):
+        return self.entries.__len__()
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+                self.hits += 1
+            return entry
+
+    def store(self, url, target, code):
+        with self.lock:
+            self.entries[url] = (target, code)
+            self.entries.move_to_end(url)
+            while self.entries.__len__() > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, url=None):
+        with self.lock:
+            if url is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(url, None)
+
+
+class Session:
+
+    """
+    Session对象是持续不变的，而Request对象是每一次发包都重新创建的
+    每一次都需要重新创建Request对象，是因为残留的变量实在太多了，一不小心可能会将上一次请求报文的内容又给继续带上去
+    并且为了更贴切地表示每一次发送的请求报文都是不同的个体，每条请求报文各占用一个对象，这是比较合适的
+    """
+    hook_events = ("on_dns", "on_connect", "on_tls", "on_request_sent", "on_first_byte", "on_complete")
+
+    def __init__(self, max_per_host=10, max_total=100, idle_timeout=60, wait_timeout=None, timeout=None, tls=None,
+                 decompress=True, max_decompressed_size=None, cache=None, hooks=None, http2=False, retry=None,
+                 max_redirects=10, scheduler=None):
+        self.cookies = CookieJar()                # 将cookies保存，记录客户端状态
+        # self.request = Request()                      # 真正用来首发请求报文的是这个，这玩意每次都需要创建新的，用完即丢
+
+        # 连接池，按 (protocol, host, port) 保存空闲的持久连接，切换主机的时候不会再把旧连接丢掉
+        # 每个请求都是从连接池里面取出连接、用完归还，Session 本身不保存套接字，所以可以在多个线程之间共用
+        self.pool = ConnectionPool(max_per_host=max_per_host, max_total=max_total, idle_timeout=idle_timeout,
+                                   wait_timeout=wait_timeout)
+
+        # 默认超时，get/post 等方法可以用 timeout 参数单独指定
+        self.timeout = Timeout.of(timeout) or Timeout()
+        self.connector = Connector()
+
+        # TLS配置，SSLContext 和 TLS会话缓存都在这里面，不传的话所有 Session 共用一份默认配置
+        self.tls = tls or TLSConfig.default(http2)
+
+        # HTTP/2：True 的时候 https 通过ALPN协商，服务端选了 h2 就在一个连接上多路复用所有请求；
+        # "h2c" 的时候明文的 http 也直接用HTTP/2（prior knowledge），服务端必须支持
+        # HTTP/2 连接不放进连接池，每个主机一个，协商结果是 http/1.1 的主机记下来，之后直接走连接池
+        self.http2 = http2
+        self.h2_connections = {}                # (protocol, host, port) -> http2.H2Connection
+        self.h1_hosts = set()
+        self.h2_pending = {}                    # 正在建立的HTTP/2连接，(protocol, host, port) -> Future
+        self.h2_lock = threading.Lock()
+
+        # 自动带上 Accept-Encoding，并按 Content-Encoding 解压响应主体，max_decompressed_size 是解压后主体的大小上限
+        self.decompress = decompress
+        self.max_decompressed_size = max_decompressed_size
+
+        # 响应缓存，传入 HTTPCache 对象开启（传 True 使用默认设置的内存缓存），默认不缓存
+        self.cache = HTTPCache() if cache is True else cache
+
+        # 按主机限速、限制在途数量、按优先级排队，见 Scheduler，传 True 使用默认设置（每个主机最多10个在途请求，不限速）
+        self.scheduler = Scheduler() if scheduler is True else scheduler
+
+        # 汇总统计，见 Metrics，snapshot()/to_prometheus()/to_json() 导出
+        self.metrics = Metrics(self.pool, Util.dns_cache, scheduler=self.scheduler)
+
+        # 自动跟随跳转，最多跳 max_redirects 次，传0不跳转；301/308 永久跳转记在 redirects 里面，下次直接请求新地址
+        self.max_redirects = max_redirects
+        self.redirects = RedirectCache()
+
+        # 重试和对冲请求，见 RetryPolicy，传 True 使用默认设置（不对冲）
+        self.retry = RetryPolicy() if retry is True else retry
+        self.hedge_executor = None
+
+        # 事件钩子，事件名 -> 回调列表，回调的参数都是 (request, response, timings)，还没收到响应的时候 response 是None
+        self.hooks = {x: [] for x in self.hook_events}
+        for event, func in (hooks or {}).items():
+            self.add_hook(event, func)
+
+        # 将上一个请求包保存下来，方便调试。多线程共用的时候只表示最近完成的那一个，不要依赖它
+        self.last_request = None
+        self.last_response = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        关闭连接池里面所有的空闲连接，以及所有的HTTP/2连接
+        """
+        self.pool.close()
+        with self.h2_lock:
+            for conn in self.h2_connections.values():
+                conn.close()
+            self.h2_connections.clear()
+        if self.hedge_executor is not None:
+            self.hedge_executor.shutdown(wait=False)
+            self.hedge_executor = None
+
+    def add_hook(self, event, func):
+        """
+        注册事件回调，事件见 hook_events，回调抛出的异常只记日志，不影响请求
+        """
+        if event not in self.hooks:
+            raise Exception("不支持的事件: %s" % event)
+        self.hooks[event].append(func)
+
+    def remove_hook(self, event, func):
+        self.hooks[event].remove(func)
+
+    def emit(self, event, request, response=None, timings=None):
+        for func in self.hooks[event]:
+            try:
+                func(request, response, timings)
+            except Exception:
+                logger.exception("钩子 %s 出错", event)
+
+    def recv_head(self, conn, parser, timings=None):
+        """
+        接收并解析响应报文头，首部之后多收到的数据留在连接的接收缓冲区里面，交给 recv_body 继续处理
+        返回False表示首部还没收完整服务端就断开了连接
+        """
+        while not parser.head_done:
+            pending = conn.pending()
+            if timings is not None and timings.first_byte_at is None and pending:
+                timings.first_byte_at = time.perf_counter()
+            if pending:
+                consumed, _ = parser.feed(pending)
+                conn.consume(consumed)
+            elif not conn.fill():
+                conn.reusable = False
+                return False       # 如果服务端已经断开连接，那就没必要再继续接收了
+        return True
+
+    def recv_body(self, conn, response, parser, decoder=None):
+        """
+        接收响应主体，收到的 bytearray 直接交给 Body，不再拷贝
+        返回主体是否完整
+        """
+        reader = BodyReader(conn, parser, decoder=decoder)
+        response.body.parse(reader.read())
+        return reader.complete
+
+    def release(self, conn, response, parser, complete, request=None):
+        """
+        响应接收完毕，把连接还回连接池，并且记录耗时、触发 on_complete
+        只有报文长度明确且完整接收的时候，连接才能还回连接池；长度不明确的响应只能读到对端关闭为止，连接也就不能再用了
+        """
+        response.complete = complete
+        timings = response.timings
+        if timings is not None:
+            now = time.perf_counter()
+            timings.transfer = None if timings.head_at is None else now - timings.head_at
+            timings.total = now - timings.start
+            timings.bytes_in = conn.bytes_in - timings.conn_bytes_in
+            # 先摘掉连接再看是否被取消，对冲请求取消的一方要么拿不到这个连接，要么连接不会还回连接池
+            timings.conn = None
+            if timings.cancelled:
+                conn.reusable = False
+        if not complete or parser.framing == "eof" or conn.pending():
+            conn.reusable = False
+        if conn.tls is not None and conn.socket is not None:
+            self.tls.save_session(conn.socket, conn.key[1], conn.key[2])
+        try:
+            conn.update(response)
+        finally:
+            self.pool.release(conn)
+        self.finish(conn.key[1], request, response)
+
+    def finish(self, host, request, response):
+        """
+        还回调度名额、记录统计、打日志、触发 on_complete
+        """
+        timings = response.timings
+        if timings is None:
+            return
+        if self.scheduler is not None:
+            self.scheduler.release(host, timings, response)
+        self.metrics.record(host, response.status_line.status_code, timings.total, timings.bytes_in,
+                            timings.bytes_out, timings.reused)
+        logger.debug("%s %s -> %s，%d字节，用时 %.1fms，%s连接", request.request_line.method if request else "",
+                     request.request_line.request_uri if request else "", response.status_line.status_code,
+                     timings.bytes_in, timings.total * 1000, "复用" if timings.reused else "新建")
+        self.emit("on_complete", request, response, timings)
+
+    def new_connection(self, request, timeout=None, timings=None):
+        """
+        新建一个到目标主机的连接，域名解析出来的所有地址都会按 Happy Eyeballs 的方式尝试
+        """
+        host, ip, port = request.conn_info["host"], request.conn_info["ip"], request.conn_info["port"]
+        timeout = timeout or self.timeout
+        deadline = None if timeout.connect is None else time.monotonic() + timeout.connect
+
+        # 解析请求的时候选中的地址排在最前面，其余地址作为备选
+        if ip == host:
+            addresses = [(socket.AF_INET6 if ":" in ip else socket.AF_INET, ip)]
+        else:
+            addresses = Util.dns_cache.resolve(host, rotate=False)
+            addresses = [x for x in addresses if x[1] == ip] + [x for x in addresses if x[1] != ip]
+
+        start = time.perf_counter()
+        sock = self.connector.connect(addresses, port, timeout.connect)
+        if timings is not None:
+            timings.connect = time.perf_counter() - start
+            self.emit("on_connect", request, None, timings)
+
+        # 如果是https，TLS握手也算在连接超时里面
+        handshake_time = None
+        if request.conn_info["protocol"] == "https":
+            try:
+                if deadline is not None:
+                    sock.settimeout(max(deadline - time.monotonic(), 0.001))
+                sock, handshake_time = self.tls.wrap(sock, host, port)
+            except BaseException:
+                sock.close()
+                raise
+            if timings is not None:
+                timings.tls = handshake_time
+                self.emit("on_tls", request, None, timings)
+
+        sock.settimeout(timeout.read)
+        conn = Connection((request.conn_info["protocol"], host, port), sock)
+        if handshake_time is not None:
+            conn.tls = {
+                "version": sock.version(),
+                "cipher": sock.cipher()[0],
+                "alpn": sock.selected_alpn_protocol(),
+                "handshake_time": handshake_time,
+                "resumed": sock.session_reused,
+            }
+        return conn
+
+    def send(self, request, timeout=None, reuse=True, timings=None):
+        """
+        优先从连接池里面取出一个到同一主机的空闲连接，没有的话再新建
+        复用的空闲连接有可能在我们发送的同时被服务端关掉了，发送失败的话换一个新连接重发一次
+        返回发送所用的连接，接收响应的时候还要用它
+        """
+        ip, port = request.conn_info["ip"], request.conn_info["port"]
+        timeout = timeout or self.timeout
+        logger.debug("发送 %s %s 到 %s:%s", request.request_line.method, request.request_line.request_uri, ip, port)
+
+        key = (request.conn_info["protocol"], request.conn_info["host"], port)
+        conn = self.pool.get(key, reuse=reuse)
+        if conn is not None:
+            conn.fresh = False
+            try:
+                conn.set_timeout(timeout)
+                self.send_request(conn, request, timings)
+                return conn
+            except socket.timeout:
+                self.pool.discard(conn)
+                raise
+            except OSError:
+                # 生成器之类的流式主体已经被读掉了，没法重发
+                self.pool.discard(conn)
+                if not request.body.rewind():
+                    raise
+                logger.debug("复用的连接发送失败，换新连接重发 %s", key)
+                self.metrics.incr("retries", key[1])
+            conn = self.pool.get(key, reuse=False)
+
+        try:
+            conn = self.new_connection(request, timeout, timings)
+        except BaseException:
+            self.pool.cancel(key)
+            raise
+        conn.fresh = True
+
+        try:
+            conn.set_timeout(timeout)
+            self.send_request(conn, request, timings)
+        except BaseException:
+            self.pool.discard(conn)
+            raise
+        return conn
+
+    def send_request(self, conn, request, timings=None):
+        sent = conn.bytes_out
+        conn.send_request(request)
+        if timings is not None:
+            timings.conn = conn
+            timings.sent_at = time.perf_counter()
+            timings.bytes_out = conn.bytes_out - sent
+            timings.reused = not conn.fresh
+            timings.conn_bytes_in = conn.bytes_in
+            self.emit("on_request_sent", request, None, timings)
+
+    def proc(self, request, stream=False, timeout=None):
+        """
+        应该在这里调用send和recv函数，发送和接收就只管发送接收，处理业务逻辑应该就在这里完成
+        包括重定向跳转和储存cookies的过程应该最好也就在这里处理
+        stream为True的时候只接收响应头，主体通过 Response.iter_content / readinto / save_to 按需读取
+        timeout 可以是 Timeout 对象或者数字，不传的话使用 Session 的默认设置
+        跳转的规则见 redirect_request，最多跳 max_redirects 次，中间的响应按顺序放在最终响应的 history 里面
+        :return:
+        """
+        timeout = Timeout.of(timeout) or self.timeout
+
+        # 已知永久跳转走的URL直接换成跳转后的地址，省掉一次往返
+        hops = 0
+        while self.max_redirects:
+            cached = self.redirects.lookup(HTTPCache.url(request))
+            if cached is None or (cached[1] == "301" and request.request_line.method not in ("GET", "HEAD")):
+                break
+            hops += 1
+            if hops > self.max_redirects:
+                raise Exception("重定向次数超过了%d次!" % self.max_redirects)
+            request = self.redirect_request(request, cached[1], cached[0])
+
+        history = []
+        while True:
+            response = self.exchange(request, stream, timeout)
+            target = self.redirect_target(request, response)
+            if target is None or not self.max_redirects:
+                response.history = history
+                return response
+            if history.__len__() + hops >= self.max_redirects:
+                response.close()
+                raise Exception("重定向次数超过了%d次!" % self.max_redirects)
+
+            code = response.status_line.status_code
+            if code in ("301", "308"):
+                self.redirects.store(HTTPCache.url(request), target, code)
+            logger.debug("%s %s -> %s", code, HTTPCache.url(request), target)
+            history.append(response)
+            request = self.redirect_request(request, code, target)
+
+    def exchange(self, request, stream, timeout):
+        """
+        发一次请求（不跳转）：加上压缩协商和cookies，查缓存，发送，存cookies
+        """
+        if self.decompress and fs.Accept_Encoding not in request.headers:
+            request.headers[fs.Accept_Encoding] = ContentDecoder.accept_encoding
+        self.add_cookies(request)
+
+        timings = Timings()
+        timings.dns = request.dns_time
+        if request.dns_time is not None:
+            self.emit("on_dns", request, None, timings)
+
+        # 先查缓存，新鲜的缓存直接返回，过期的缓存在请求里面带上条件首部去验证
+        response, entry = None, None
+        if self.cache is not None:
+            response, entry = self.cache.fetch(request)
+        if response is not None:
+            timings.total = time.perf_counter() - timings.start
+            response.timings = timings
+            self.metrics.record(request.conn_info["host"], response.status_line.status_code, timings.total,
+                                cached=True)
+            self.emit("on_complete", request, response, timings)
+        else:
+            request_time = time.time()
+            try:
+                if self.retry is None:
+                    response = self.transfer(request, stream, timeout, timings)
+                else:
+                    response = self.transfer_with_retry(request, stream, timeout, timings)
+            except BaseException:
+                self.metrics.incr("errors", request.conn_info["host"])
+                raise
+            if self.cache is not None:
+                response = self.cache.update(request, response, entry, request_time)
+
+        self.last_response = response
+        self.last_request = request
+
+        # 检测set-cookies，跳转之前就要存好，跳转后的请求可能要带上
+        self.cookies.extract(request, response)
+        return response
+
+    redirect_codes = ("301", "302", "303", "307", "308")
+
+    @classmethod
+    def redirect_target(cls, request, response):
+        """
+        跳转的目标地址，Location 可以是绝对地址也可以是相对地址，按当前请求的URL补全；不是跳转的响应返回None
+        304 之类没有 Location 的 3xx 不是跳转
+        """
+        location = response.headers.get(fs.Location)
+        if response.status_line.status_code not in cls.redirect_codes or not location:
+            return None
+        return urljoin(HTTPCache.url(request), location.strip()).partition("#")[0]
+
+    @staticmethod
+    def redirect_request(request, code, url, resolve=True):
+        """
+        按 RFC7231 Section 6.4 / RFC7538 生成跳转之后的请求：
+
+        - 303 除了 HEAD 以外都改成 GET；301/302 的 POST 按照浏览器的惯例改成 GET；改成 GET 的时候丢掉主体和相关首部
+        - 307/308 保持原来的方法和主体，主体没法重新读取的时候不能跳转
+        - 同一个源（协议、主机、端口都相同）的跳转直接沿用原来的连接信息，不再做DNS解析，发送的时候从连接池里复用连接
+        - 跳到别的源的时候去掉 Authorization；Cookie 和条件首部每一跳都重新生成
+        resolve 为False的时候跨源的跳转不做DNS解析，由调用者自己填写ip（AsyncSession 用异步DNS解析）
+        """
+        method = request.request_line.method
+        body = request.body
+        if (code == "303" and method != "HEAD") or (code in ("301", "302") and method == "POST"):
+            method, body = "GET", None
+        elif not body.rewind():
+            raise Exception("请求主体没法重新读取，不能跟随 %s 跳转到 %s" % (code, url))
+
+        info = request.conn_info
+        new = Request()
+        new.parse_uri(url, resolve=False)
+        same_origin = (new.conn_info["protocol"], new.conn_info["host"], new.conn_info["port"]) == \
+            (info["protocol"], info["host"], info["port"])
+        if same_origin:
+            new.conn_info["ip"] = info["ip"]
+        elif resolve and not new.conn_info["ip"]:
+            start = time.perf_counter()
+            new.conn_info["ip"] = Util.get_dns(new.conn_info["host"])
+            new.dns_time = time.perf_counter() - start
+
+        new.headers = request.headers.copy()
+        new.headers[fs.Host] = new.conn_info["host"]
+        new.priority = request.priority
+        for name in (fs.Cookie, fs.If_None_Match, fs.If_Modified_Since):
+            new.headers.pop(name, None)
+        if not same_origin:
+            new.headers.pop(fs.Authorization, None)
+            new.headers.pop(fs.Proxy_Authorization, None)
+        if body is None:
+            for name in (fs.Content_Length, fs.Content_Type, fs.Transfer_Encoding, fs.Content_Encoding):
+                new.headers.pop(name, None)
+        else:
+            new.body = body
+        new.request_line.build(method, new.conn_info["request_uri"])
+        return new
+
+    def add_cookies(self, request):
+        """
+        把cookie罐里匹配的cookie加到请求的 Cookie 首部，用户自己带了 Cookie 首部的话拼在后面
+        """
+        cookie = self.cookies.header(request)
+        if cookie is not None:
+            if fs.Cookie in request.headers:
+                cookie = request.headers[fs.Cookie] + "; " + cookie
+            request.headers[fs.Cookie] = cookie
+
+    def transfer(self, request, stream=False, timeout=None, timings=None):
+        """
+        发送请求并接收响应，只管收发，不处理缓存、cookies和跳转
+        开启了 Scheduler 的时候先排队拿到名额再发送，响应接收完毕（finish）或者出错的时候还回去
+        """
+        timeout = timeout or self.timeout
+        timings = timings or Timings()
+        if self.scheduler is None:
+            return self.roundtrip(request, stream, timeout, timings)
+
+        host = request.conn_info["host"]
+        self.scheduler.acquire(host, request.priority, timings)
+        try:
+            return self.roundtrip(request, stream, timeout, timings)
+        except BaseException:
+            self.scheduler.release(host, timings)
+            raise
+
+    def roundtrip(self, request, stream, timeout, timings):
+        key = (request.conn_info["protocol"], request.conn_info["host"], request.conn_info["port"])
+        if self.http2 and key not in self.h1_hosts and (key[0] == "https" or self.http2 == "h2c"):
+            response = self.transfer_h2(key, request, stream, timeout, timings)
+            if response is not None:
+                return response
+
+        # 复用的连接上什么都没收到就断开了，说明服务端在我们发送的同时关掉了它，换一个新连接重发一次
+        reuse = True
+        while True:
+            timings.first_byte_at = None
+            conn = self.send(request, timeout, reuse, timings)
+
+            # 创建Response对象用来存储返回的这些数据
+            response = Response()
+            response.tls = conn.tls
+            parser = ResponseParser(response, request.request_line.method)
+
+            # 接收响应报文头
+            try:
+                ok = self.recv_head(conn, parser, timings)
+            except socket.timeout:
+                self.pool.discard(conn)
+                raise
+            except OSError:
+                self.pool.discard(conn)
+                if conn.fresh or timings.cancelled or not request.body.rewind():
+                    raise
+                reuse = False
+                self.metrics.incr("retries", conn.key[1])
+                continue
+            except BaseException:
+                self.pool.discard(conn)
+                raise
+
+            if not ok and timings.cancelled:
+                self.pool.discard(conn)
+                raise ConnectionAbortedError("请求已经取消")
+            if not ok and not parser.head and not conn.fresh and request.body.rewind():
+                self.pool.discard(conn)
+                reuse = False
+                self.metrics.incr("retries", conn.key[1])
+                continue
+            if not ok:
+                self.pool.discard(conn)
+                raise ConnectionResetError("服务端没有返回完整的响应头就关闭了连接")
+            break
+
+        timings.head_at = time.perf_counter()
+        if timings.first_byte_at is not None:
+            timings.ttfb = timings.first_byte_at - timings.sent_at
+        response.timings = timings
+        self.emit("on_first_byte", request, response, timings)
+
+        decoder = None
+        if self.decompress and not parser.done:
+            decoder = ContentDecoder.create(parser.header(fs.Content_Encoding), self.max_decompressed_size)
+
+        if stream and not parser.done and response.status_line.status_code[:1] != "3":
+            # 流式响应，主体留给调用者自己读，读完的时候才把连接还回连接池
+            response.raw = BodyReader(conn, parser,
+                                      lambda complete: self.release(conn, response, parser, complete, request), decoder)
+        else:
+            complete = False
+            try:
+                # 在这里继续接收主体（如果有主体的话）
+                complete = parser.done or self.recv_body(conn, response, parser, decoder)
+            finally:
+                self.release(conn, response, parser, complete, request)
+        return response
+
+    def transfer_with_retry(self, request, stream, timeout, timings):
+        """
+        按 RetryPolicy 发送：失败或者返回了可重试的状态码就退避之后重试，可以对冲的请求首字节太慢的时候再发一份
+        """
+        policy, host = self.retry, request.conn_info["host"]
+        deadline = None if policy.deadline is None else time.monotonic() + policy.deadline
+        retryable = policy.retryable(request)
+        policy.deposit(host)
+
+        attempt = 0
+        while True:
+            attempt_timeout = self._attempt_timeout(timeout, deadline)
+            error, response = None, None
+            try:
+                if policy.hedge and request.request_line.method in policy.hedge_methods:
+                    response = self.hedged_transfer(request, stream, attempt_timeout, timings)
+                else:
+                    response = self.transfer(request, stream, attempt_timeout, timings)
+            except policy.final_errors:
+                raise
+            except (OSError, socket.timeout) as e:
+                error = e
+
+            if error is None:
+                policy.observe(host, response.timings.ttfb)
+                if response.status_line.status_code not in policy.statuses:
+                    return response
+
+            # 判断还能不能再试一次
+            if not retryable or attempt >= policy.total or not request.body.rewind():
+                if error is not None:
+                    raise error
+                return response
+            delay = policy.wait_time(attempt, response)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                if error is not None:
+                    raise error
+                return response
+            if not policy.withdraw(host):
+                logger.debug("%s 的重试预算用完了，不再重试", host)
+                if error is not None:
+                    raise error
+                return response
+
+            if response is not None:
+                response.close()
+            logger.debug("%s %s 第 %d 次重试，等待 %.3f 秒：%s", request.request_line.method,
+                         request.request_line.request_uri, attempt + 1, delay,
+                         error if error is not None else response.status_line.status_code)
+            self.metrics.incr("retries", host)
+            time.sleep(delay)
+            attempt += 1
+            timings = Timings()
+            timings.dns = request.dns_time
+
+    @staticmethod
+    def _attempt_timeout(timeout, deadline):
+        if deadline is None:
+            return timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("超过了整个调用的截止时间!")
+        return Timeout(connect=remaining if timeout.connect is None else min(timeout.connect, remaining),
+                       read=remaining if timeout.read is None else min(timeout.read, remaining),
+                       total=remaining if timeout.total is None else min(timeout.total, remaining))
+
+    def hedged_transfer(self, request, stream, timeout, timings):
+        """
+        先发一份，超过对冲延迟还没收到第一个字节的话，在另一个连接上再发一份，哪个先成功用哪个，另一个关掉
+        两次发送在线程池里面进行，调用者的线程只负责等待
+        """
+        policy, host = self.retry, request.conn_info["host"]
+        delay = policy.hedge_delay(host)
+        if delay is None:
+            return self.transfer(request, stream, timeout, timings)
+        if self.hedge_executor is None:
+            with self.h2_lock:
+                if self.hedge_executor is None:
+                    self.hedge_executor = ThreadPoolExecutor(thread_name_prefix="hedge")
+
+        executor = self.hedge_executor
+        attempts = {executor.submit(self.transfer, request, stream, timeout, timings): timings}
+        done, _ = wait(attempts, timeout=delay)
+        if not done and timings.first_byte_at is None and policy.withdraw(host):
+            hedge_timings = Timings()
+            hedge_timings.dns = request.dns_time
+            attempts[executor.submit(self.transfer, request, stream, timeout, hedge_timings)] = hedge_timings
+            self.metrics.incr("hedges", host)
+            logger.debug("%s %s 超过 %.3f 秒没有响应，发出对冲请求", request.request_line.method,
+                         request.request_line.request_uri, delay)
+
+        error = None
+        while attempts:
+            done, _ = wait(attempts, return_when=FIRST_COMPLETED)
+            for future in done:
+                del attempts[future]
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    if isinstance(future.exception(), policy.final_errors):
+                        # 再等另一份也是一样的结果，不用等了
+                        for loser, loser_timings in attempts.items():
+                            self._cancel(loser, loser_timings)
+                        raise future.exception()
+                    continue
+                for loser, loser_timings in attempts.items():
+                    self._cancel(loser, loser_timings)
+                return future.result()
+        raise error
+
+    @staticmethod
+    def _cancel(future, timings):
+        """
+        关掉对冲请求里面输掉的一方：还在收发的把套接字 shutdown（阻塞在 recv 上的线程会马上返回），已经返回的流式响应直接关闭
+        """
+        timings.cancelled = True
+        conn = timings.conn
+        if future.done():
+            conn = None
+        if isinstance(conn, Connection) and conn.socket is not None:
+            conn.reusable = False
+            try:
+                conn.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        elif conn is not None:
+            conn.close()
+        future.add_done_callback(lambda f: f.exception() is None and f.result().close())
+
+    def h2_connection(self, key, request, timeout, timings, fresh=False):
+        """
+        取出到这个主机的HTTP/2连接，没有的话新建一个
+        https 的ALPN协商结果不是 h2 的话，把新建的连接放进连接池给HTTP/1.1用，返回None
+        同一个主机同一时间只建一个连接，其他线程等在这个主机的 Future 上，建好之后直接复用；
+        建连接（TCP连接和TLS握手）的时候不持有 h2_lock，一个很慢或者连不上的主机不会挡住其他主机的请求
+        """
+        while True:
+            with self.h2_lock:
+                conn = self.h2_connections.get(key)
+                if conn is not None and conn.available and not fresh:
+                    return conn
+                if key in self.h1_hosts:
+                    return None
+                pending = self.h2_pending.get(key)
+                if pending is None:
+                    if conn is not None:
+                        if not conn.active:
+                            conn.close()
+                        del self.h2_connections[key]
+                    pending = self.h2_pending[key] = Future()
+                    break
+            # 别的线程正在建这个主机的连接，等它的结果，建好的连接不能用的话再来一遍
+            conn = pending.result()
+            if conn is None or conn.available:
+                return conn
+            fresh = False
+
+        conn = None
+        try:
+            sock_conn = self.new_connection(request, timeout, timings)
+            if key[0] == "https" and (sock_conn.tls or {}).get("alpn") != "h2":
+                logger.debug("%s:%s 不支持HTTP/2，改用HTTP/1.1", key[1], key[2])
+                # 连接已经建好了，只是登记一下再马上还回去当空闲连接，不用等名额，超出上限的话 release 的时候会关掉多余的空闲连接
+                self.pool.get(key, block=False, reuse=False)
+                self.pool.release(sock_conn)
+            else:
+                conn = http2.H2Connection(key, sock_conn.socket, sock_conn.tls)
+        except BaseException as e:
+            with self.h2_lock:
+                del self.h2_pending[key]
+            pending.set_exception(e)
+            raise
+        with self.h2_lock:
+            del self.h2_pending[key]
+            if conn is None:
+                self.h1_hosts.add(key)
+            else:
+                self.h2_connections[key] = conn
+        pending.set_result(conn)
+        return conn
+
+    def transfer_h2(self, key, request, stream, timeout, timings):
+        """
+        通过HTTP/2发送请求，流被拒绝、或者连接在请求发出去之前就断了（ConnectionResetError）的时候换一个新连接重发一次
+        服务端不支持HTTP/2的时候返回None，由调用者走HTTP/1.1
+        """
+        headers = [(":method", request.request_line.method), (":scheme", key[0]),
+                   (":authority", request.headers.get(fs.Host) or key[1]), (":path", request.request_line.request_uri)]
+        for name, value in request.headers.multi_items():
+            if name.lower() not in http2.connection_headers:
+                headers.append((name.lower(), str(value)))
+
+        body = request.body
+        fresh = False
+        while True:
+            conn = self.h2_connection(key, request, timeout, timings, fresh)
+            if conn is None:
+                return None
+            timings.reused = conn.requests > 0
+            if body.stream is None:
+                content = body.content if body.content.__len__() else None
+            else:
+                content = Connection._iter_stream(body.stream)
+            h2_stream = None
+            try:
+                h2_stream = conn.request(headers, content, timeout.read)
+                timings.conn = h2_stream
+                timings.sent_at = time.perf_counter()
+                timings.bytes_out = h2_stream.bytes_out
+                self.emit("on_request_sent", request, None, timings)
+                status, response_headers = h2_stream.wait_response(timeout.read)
+            except ConnectionResetError:
+                if h2_stream is not None:
+                    h2_stream.close()
+                if fresh or not body.rewind():
+                    raise
+                fresh = True
+                self.metrics.incr("retries", key[1])
+                continue
+            except BaseException:
+                # 超时等其他错误：流还开着的话发 RST_STREAM，已经收到的数据归还窗口，不然会一直占着连接的并发数和接收窗口
+                if h2_stream is not None:
+                    h2_stream.close()
+                raise
+            break
+
+        response = Response()
+        response.tls = conn.tls
+        response.status_line.http_version = "HTTP/2"
+        response.status_line.status_code = status
+        for name, value in response_headers:
+            response.headers.add(name.decode("latin-1"), value.decode("latin-1"))
+
+        timings.first_byte_at = h2_stream.first_byte_at
+        timings.head_at = time.perf_counter()
+        timings.ttfb = timings.first_byte_at - timings.sent_at
+        response.timings = timings
+        self.emit("on_first_byte", request, response, timings)
+
+        decoder = None
+        if self.decompress and request.request_line.method != "HEAD":
+            decoder = ContentDecoder.create(response.headers.get(fs.Content_Encoding), self.max_decompressed_size)
+
+        def release(complete):
+            response.complete = complete
+            for name, value in h2_stream.trailers or ():
+                response.trailers.add(name.decode("latin-1"), value.decode("latin-1"))
+            timings.transfer = time.perf_counter() - timings.head_at
+            timings.total = time.perf_counter() - timings.start
+            timings.bytes_in = h2_stream.bytes_in
+            self.finish(key[1], request, response)
+
+        reader = H2BodyReader(h2_stream, timeout.read, release, decoder)
+        if stream and response.status_line.status_code[:1] != "3":
+            response.raw = reader
+        else:
+            response.body.parse(reader.read())
+        return response
+
+    def map(self, requests, max_workers=10, per_host=None, return_exceptions=False):
+        """
+        用线程池并发发送一批请求，哪个先完成就先返回哪个，每次返回 (原始的请求描述, 响应)
+        requests 里面每一项可以是：
+            "http://..."                                  GET请求
+            ("POST", "http://...")                         指定方法
+            ("POST", "http://...", {"data": {...}})        再加上 get/post 等方法的参数
+        per_host 限制同一个主机同时在途的请求数，默认等于连接池的 max_per_host，
+        超出的请求先留在队列里，不会占着线程干等，其他主机的请求照常发送
+        return_exceptions 为True的时候，出错的请求把异常对象当作响应返回，否则直接抛出
+        """
+        per_host = self.pool.max_per_host if per_host is None else per_host
+
+        queues = OrderedDict()                  # key -> deque[(item, method, uri, kwargs)]
+        for item in requests:
+            if isinstance(item, str):
+                method, uri, kwargs = "GET", item, {}
+            else:
+                method, uri, kwargs = item[0], item[1], (item[2] if item.__len__() > 2 else {})
+            key = self._host_key(uri)
+            queues.setdefault(key, deque()).append((item, method, uri, kwargs))
+
+        in_flight = {}                          # key -> 在途请求数
+        futures = {}                            # Future -> (key, item)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        def submit():
+            # 轮流从每个主机的队列里取请求，直到线程占满或者每个主机都到了上限
+            while futures.__len__() < max_workers:
+                submitted = False
+                for key in list(queues):
+                    if futures.__len__() >= max_workers:
+                        break
+                    if in_flight.get(key, 0) >= per_host:
+                        continue
+                    item, method, uri, kwargs = queues[key].popleft()
+                    if not queues[key]:
+                        del queues[key]
+                    in_flight[key] = in_flight.get(key, 0) + 1
+                    future = executor.submit(self.request, method, uri, **kwargs)
+                    futures[future] = (key, item)
+                    submitted = True
+                if not submitted:
+                    return
+
+        try:
+            submit()
+            while futures:
+                done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, item = futures.pop(future)
+                    in_flight[key] -= 1
+                    submit()
+                    try:
+                        yield item, future.result()
+                    except Exception as e:
+                        if not return_exceptions:
+                            raise
+                        yield item, e
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def fetch_all(self, uris, max_workers=10, per_host=None, return_exceptions=False, **kwargs):
+        """
+        并发GET一批URI，哪个先完成就先返回哪个，每次返回 (uri, 响应)，kwargs 会传给每一个 get 请求
+        """
+        results = self.map([("GET", uri, kwargs) for uri in uris], max_workers=max_workers, per_host=per_host,
+                           return_exceptions=return_exceptions)
+        for item, response in results:
+            yield item[1], response
+
+    @staticmethod
+    def _host_key(uri):
+        request = Request()
+        request.parse_uri(uri, resolve=False)
+        return request.conn_info["protocol"], request.conn_info["host"], request.conn_info["port"]
+
+    def prepare(self, method, uri, **kwargs):
+        """
+        生成一个可以反复发送的请求模板，参数与 get/post 等方法相同，详见 PreparedRequest
+        """
+        return PreparedRequest(self, method.upper(), uri, **kwargs)
+
+    def download(self, uri, path, segments=4, retries=2, timeout=None, headers=None):
+        """
+        把 uri 下载到 path，服务端支持范围请求的时候分成 segments 段并发下载，可以断点续传，返回文件大小，详见 Download
+        """
+        return Download(self, uri, path, segments, retries, timeout, headers).run()
+
+    def pipeline(self, origin, depth=16, timeout=None):
+        """
+        同一个主机的一批幂等请求在一个连接上管线化发送，详见 Pipeline
+        """
+        return Pipeline(self, origin, depth, timeout)
+
+    def request(self, method, uri, **kwargs):
+        """
+        通用的发送方法，method 是 GET/POST 等，其余参数与 get/post 等方法相同
+        """
+        request = Request()
+        request.build(method.upper(), uri, **kwargs)
+        return self.proc(request, stream=kwargs.get("stream", False), timeout=kwargs.get("timeout"))
+
+    def get(self, uri, **kwargs):
+        request = Request()
+        request.build("GET", uri, **kwargs)
+        return self.proc(request, stream=kwargs.get("stream", False), timeout=kwargs.get("timeout"))
+
+    def post(self, uri, **kwargs):
+        request = Request()
+        request.build("POST", uri, **kwargs)
+        return self.proc(request, stream=kwargs.get("stream", False), timeout=kwargs.get("timeout"))
+
+    def put(self, uri, **kwargs):
+        request = Request()
+        request.build("PUT", uri, **kwargs)
+        return self.proc(request, stream=kwargs.get("stream", False), timeout=kwargs.get("timeout"))
+
+    def delete(self, uri, **kwargs):
+        request = Request()
+        request.build("DELETE", uri, **kwargs)
+        return self.proc(request, stream=kwargs.get("stream", False), timeout=kwargs.get("timeout"))
+
+    def options(self, uri, **kwargs):
+        request = Request()
+        request.build("OPTIONS", uri, **kwargs)
+        return self.proc(request, stream=kwargs.get("stream", False), timeout=kwargs.get("timeout"))
+
+    def head(self, uri, **kwargs):
+        request = Request()
+        request.build("HEAD", uri, **kwargs)
+        return self.proc(request, stream=kwargs.get("stream", False), timeout=kwargs.get("timeout"))
+
+    def connect(self):
+        pass
+
+    def trace(self):
+        pass
 
-s = Session()
-resp = s.get("http://www.httpbin.org/get?a=啊啊啊")
-print(resp.body.text())
 
+if __name__ == "__main__":
+    s = Session()
+    resp = s.get("http://www.httpbin.org/get?a=啊啊啊")
+    print(resp.body.text())
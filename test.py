@@ -93,3 +93,288 @@ def test12():
 
 # test12()
 
+
+
+# 测试连接池，在两个主机之间来回切换，连接不会被丢掉重建
+def test13():
+    s = Session(max_per_host=2, max_total=10, idle_timeout=30)
+    for i in range(3):
+        s.get("http://www.httpbin.org/get")
+        s.get("http://www.baidu.com/")
+    print(s.pool.idle.keys())
+    s.close()
+# test13()
+
+
+# chunked分块传输的响应
+def test14():
+    s = Session()
+    resp = s.get("http://www.httpbin.org/stream/5")
+    print(resp.body.text())
+    print(resp.trailers)
+# test14()
+
+
+# 流式下载，主体直接从套接字写进文件，不会整个读进内存
+def test15():
+    s = Session()
+    resp = s.get("http://www.runoob.com/wp-content/themes/runoob/assets/img/runoob-logo.png", stream=True)
+    print(resp.save_to("runoob-logo.png"))
+
+    resp = s.get("http://www.httpbin.org/stream/5", stream=True)
+    for line in resp.iter_lines():
+        print(line)
+# test15()
+
+
+# 上传大文件，文件对象边读边发，生成器按chunked发送
+def test16():
+    s = Session()
+    with open("runoob-logo.png", "rb") as f:
+        resp = s.put("http://www.httpbin.org/put", content=f)
+    print(resp.body.text())
+
+    resp = s.put("http://www.httpbin.org/put", content=(str(i).encode() for i in range(10)))
+    print(resp.body.text())
+# test16()
+
+
+# 异步并发请求
+def test17():
+    import asyncio
+    from async_http_client import AsyncSession
+
+    async def main():
+        async with AsyncSession(max_per_host=5) as s:
+            responses = await asyncio.gather(*[s.get("http://www.httpbin.org/get", params={"i": i}) for i in range(20)])
+            for resp in responses:
+                print(resp.body.text())
+
+    asyncio.run(main())
+# test17()
+
+
+# 多线程批量请求，哪个先完成先返回哪个
+def test18():
+    s = Session(max_per_host=4)
+    urls = ["http://www.httpbin.org/get?i=%d" % i for i in range(10)] + ["http://www.baidu.com/"]
+    for uri, resp in s.fetch_all(urls, max_workers=8):
+        print(uri, resp.status_line.status_code)
+# test18()
+
+
+# DNS缓存预热，查看缓存的地址
+def test19():
+    print(Util.dns_cache.prewarm(["www.httpbin.org", "www.baidu.com", "no-such-host.invalid"]))
+    print(Util.dns_cache.resolve("www.baidu.com"))
+    print(Util.get_dns("www.baidu.com"), Util.get_dns("www.baidu.com"))
+# test19()
+
+
+# 超时设置，httpbin 的 /delay/3 会在3秒后才返回
+def test20():
+    s = Session(timeout=Timeout(connect=3, read=5, total=10))
+    print(s.get("http://www.httpbin.org/delay/1").body.text())
+    try:
+        s.get("http://www.httpbin.org/delay/3", timeout=1)
+    except OSError as e:
+        print("超时了", e)
+# test20()
+
+
+# https 会话恢复，第二个连接的握手应该是简化握手
+def test21():
+    s = Session(tls=TLSConfig(alpn=["http/1.1"]))
+    for i in range(2):
+        resp = s.get("https://www.baidu.com/", headers={"Connection": "close"})
+        print(resp.tls)
+# test21()
+
+
+# 自动解压，httpbin 的 /gzip /deflate /brotli 返回压缩过的主体
+def test22():
+    s = Session()
+    for path in ("gzip", "deflate", "brotli"):
+        resp = s.get("http://www.httpbin.org/" + path)
+        print(resp.headers.get("Content-Encoding"), resp.body.text()[:60])
+    resp = s.get("http://www.httpbin.org/gzip", stream=True)
+    for line in resp.iter_lines():
+        print(line)
+
+    # 压缩炸弹：64MB 的0压缩之后只有几KB，解压上限设成1MB，每种编码都要在解压出1MB多一点的时候就停下来
+    import zlib
+    raw = b"\0" * (64 << 20)
+    gz = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    bombs = {"gzip": gz.compress(raw) + gz.flush()}
+    if "br" in ContentDecoder.codings:
+        import brotli
+        bombs["br"] = brotli.compress(raw)
+    if "zstd" in ContentDecoder.codings:
+        import zstandard
+        bombs["zstd"] = zstandard.ZstdCompressor().compress(raw)
+    for coding, data in bombs.items():
+        decoder = ContentDecoder.create(coding, 1 << 20)
+        try:
+            decoder.decompress(data)
+        except DecompressionLimitError as e:
+            print(coding, data.__len__(), e, decoder.totals)
+# test22()
+
+
+# 响应缓存，httpbin 的 /cache/60 带 max-age=60，/etag 会按 If-None-Match 返回304
+def test23():
+    s = Session(cache=HTTPCache(directory="cache"))
+    for i in range(3):
+        resp = s.get("http://www.httpbin.org/cache/60")
+        print(resp.status_line.status_code, resp.from_cache, resp.headers.get("Age"))
+    for i in range(2):
+        resp = s.get("http://www.httpbin.org/etag/abc")
+        print(resp.status_line.status_code, resp.from_cache)
+    print(s.cache.hits, s.cache.revalidated, s.cache.misses)
+# test23()
+
+
+# cookie罐，httpbin 的 /cookies/set 会设置cookie并跳转到 /cookies
+def test24():
+    s = Session()
+    resp = s.get("http://www.httpbin.org/cookies/set?a=1&b=2")
+    print(resp.body.text())
+    print(list(s.cookies))
+    s.cookies.save("cookies.txt")
+    s2 = Session()
+    s2.cookies.load("cookies.txt")
+    print(s2.get("http://www.httpbin.org/cookies").body.text())
+# test24()
+
+
+# 首部名字不区分大小写，同名首部可以有多个值
+def test25():
+    h = Headers()
+    h.parse(b"Content-Length:5\r\nSet-Cookie: a=1\r\nset-cookie: b=2")
+    print(h["content-length"], h.get_all("Set-Cookie"), h["SET-COOKIE"])
+    h += {"X-Test": "1"}
+    print(h.bytes())
+    resp = Session().get("http://www.httpbin.org/response-headers?X-A=1&X-A=2")
+    print(resp.headers.get_all("x-a"), resp.headers["content-type"])
+# test25()
+
+
+# 请求模板，URL解析、DNS解析、首部序列化只做一次，之后每次只换查询参数
+def test26():
+    s = Session()
+    p = s.prepare("GET", "http://www.httpbin.org/get", headers={"X-Test": "1"})
+    for i in range(3):
+        print(p.send(params={"i": i, "q": "中文 空格"}).body.text())
+# test26()
+
+
+# 日志和事件钩子，每个响应都带有 timings
+def test27():
+    import logging
+    logging.basicConfig(level=logging.DEBUG)
+    s = Session(hooks={"on_complete": lambda request, response, timings: print(timings.as_dict())})
+    s.add_hook("on_first_byte", lambda request, response, timings: print("ttfb", timings.ttfb))
+    for i in range(2):
+        resp = s.get("http://www.httpbin.org/get")
+        print(resp.timings.reused, resp.timings.bytes_in, resp.timings.bytes_out)
+# test27()
+
+
+# Session 的汇总统计，按主机的计数器和延迟直方图，可以导出成 Prometheus 文本或者JSON
+def test28():
+    s = Session()
+    for i in range(5):
+        s.get("http://www.httpbin.org/get")
+    snapshot = s.metrics.snapshot()
+    print(snapshot["hosts"], snapshot["pool"], snapshot["dns"])
+    print(s.metrics.to_prometheus())
+# test28()
+
+
+# 管线化，一批请求在一个连接上连着发出去，响应按顺序返回
+def test29():
+    s = Session()
+    with s.pipeline("http://www.httpbin.org") as p:
+        for i in range(10):
+            p.get("/get", params={"i": i})
+    for resp in p.responses:
+        print(resp.status_line.status_code, resp.timings.ttfb)
+# test29()
+
+
+# HTTP/2，https 通过ALPN协商，所有请求在一个连接上多路复用（需要安装 h2）
+def test30():
+    from concurrent.futures import ThreadPoolExecutor
+    s = Session(http2=True)
+    resp = s.get("https://www.httpbin.org/get")
+    print(resp.status_line.http_version, resp.tls["alpn"], resp.body.text())
+    with ThreadPoolExecutor(10) as executor:
+        for resp in executor.map(lambda i: s.get("https://www.httpbin.org/get", params={"i": i}), range(10)):
+            print(resp.status_line.status_code, resp.timings.reused)
+    print(len(s.h2_connections))
+# test30()
+
+
+# 分段并发下载，支持断点续传
+def test31():
+    s = Session()
+    size = s.download("http://www.httpbin.org/range/102400", "range.bin", segments=4)
+    print(size, os.path.getsize("range.bin"))
+# test31()
+
+
+# 重试和对冲请求，httpbin 的 /status/503 一直返回503，重试几次之后返回最后一次的响应
+def test32():
+    s = Session(retry=RetryPolicy(total=3, backoff=0.2, deadline=5, hedge=True))
+    resp = s.get("http://www.httpbin.org/status/503")
+    print(resp.status_line.status_code, s.metrics.snapshot()["hosts"])
+    for i in range(30):
+        s.get("http://www.httpbin.org/get")
+    print(s.retry.hedge_delay("www.httpbin.org"), s.metrics.snapshot()["hosts"])
+# test32()
+
+
+# 重定向：相对地址按 urljoin 解析，307/308 保留方法和请求体，301/308 会被缓存
+def test33():
+    s = Session(max_redirects=5)
+    resp = s.get("http://www.httpbin.org/relative-redirect/3")
+    print(resp.status_line.status_code, [r.status_line.status_code for r in resp.history])
+    resp = s.post("http://www.httpbin.org/redirect-to", params={"url": "/post", "status_code": 307}, data={"a": 1})
+    print(resp.status_line.status_code, resp.body.text())
+    try:
+        s.get("http://www.httpbin.org/redirect/10")
+    except Exception as e:
+        print(e)
+# test33()
+
+
+# 按主机调度：每秒最多5个请求、最多2个同时在途，interactive 的请求插到 background 前面，429/503 自动降速
+def test34():
+    from concurrent.futures import ThreadPoolExecutor
+    s = Session(scheduler=Scheduler(rate=5, burst=2, max_in_flight=2))
+    with ThreadPoolExecutor(10) as executor:
+        crawl = [executor.submit(s.get, "http://www.httpbin.org/get", params={"i": i}, priority="background")
+                 for i in range(10)]
+        resp = s.get("http://www.httpbin.org/get", priority="interactive")
+        print("interactive", resp.timings.queue, resp.timings.total)
+        for future in crawl:
+            print("background", future.result().timings.queue)
+    print(s.scheduler.stats())
+
+    # 管线化和 AsyncSession 走同一个调度器
+    with s.pipeline("http://www.httpbin.org") as p:
+        for i in range(5):
+            p.get("/get", params={"i": i})
+    print("pipeline", [r.timings.queue for r in p.responses])
+
+    import asyncio
+    from async_http_client import AsyncSession
+
+    async def main():
+        async with AsyncSession(scheduler=s.scheduler) as a:
+            responses = await asyncio.gather(*[a.get("http://www.httpbin.org/get", params={"i": i}) for i in range(5)])
+            print("async", [r.timings.queue for r in responses])
+
+    asyncio.run(main())
+    print(s.scheduler.stats())
+# test34()